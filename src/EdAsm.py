@@ -38,35 +38,31 @@ from lib import audio
 
 def assemble(options):
 
-    download_bytes, download_str, download_type, version = \
+    # The download includes the two version bytes
+    full_download_bytes, download_type, version = \
         token_assembler.assemble_file(options.srcPath, options.debug)
 
-    if (len(download_bytes) == 0):
+    if (len(full_download_bytes) == 0):
         print("ERROR - No output produced")
         return
 
     # some sort of output
     print("Assembly completed of %s type file: %s -- created %d bytes of tokens and header" %
-          (download_type, options.srcPath, len(download_str)))
-
-    versionNumber = (version[0] << 4) + version[1]
-    versionString = chr(versionNumber) + chr(255 - versionNumber)
-    # print(versionNumber, ord(versionString[0]), ord(versionString[1]), download_type)
-
-    full_download_str = versionString + download_str
-    full_download_bytes = [versionNumber, 255 - versionNumber]
-    full_download_bytes.extend(download_bytes)
+          (download_type, options.srcPath, len(full_download_bytes) - 2))
     print(len(full_download_bytes))
 
     if (options.binFile is not None):
         if (options.preamble):
-            download_str = full_download_str
-        print("Writing %d bytes to file: %s" % (len(download_str), options.binFile.name))
-        options.binFile.write(download_str)
+            download_bytes = full_download_bytes
+        else:
+            download_bytes = full_download_bytes[2:]
+        print("Writing %d bytes to file: %s" % (len(download_bytes), options.binFile.name))
+        options.binFile.write(download_bytes)
         options.binFile.close()
 
     if (options.wavFilename is not None):
         audioFile = audio.Output(".", options.wavFilename)
+        audioFile.SetProcesses(options.jobs)
         audioFile.WriteWav(full_download_bytes)
 
 
@@ -100,6 +96,11 @@ def ProcessCommandArgs(args):
                         dest="wavFilename", default=None,
                         help="Output a wav file of the assembled code.")
 
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        dest="jobs",
+                        help="Number of processes to use when creating the wav file " +
+                        "(default:%(default)s). Helps with large firmware downloads.")
+
     parser.add_argument("-b", "--bin", type=argparse.FileType('wb', 0),
                         dest="binFile", default=None,
                         help="Output a binary file of the assembled code.")
@@ -26,77 +26,231 @@ import argparse
 import os
 import os.path
 import re
+import json
+import base64
+import socket
+import stat
+import threading
 
 from lib import io, util, audio
 from lib import parser, program
-from lib import optimiser, compiler
-from lib import token_assembler
-from lib import hl_parser
+from lib import library
+from lib import compilation
+from lib import api
+from lib import cache
 
 # To disable the log output, put use=False as the only parameter
 LOG = util.SimpleLog(use=True)
 
 INT_ERROR_RE = re.compile("internal error")
 
-def main(args):
+def GetLibrary(args):
+    if (args.libraryPath is not None):
+        return library.Library(args.libraryPath)
+    else:
+        return None
+
+
+def GetResultCache(args):
+    if (args.cachePath is not None):
+        return cache.ResultCache(args.cachePath, args.cacheMBytes * 1024 * 1024)
+    else:
+        return None
+
+
+def CompileFile(args, context, fragments, makeListing):
+    """Compile the source file. Returns an api.CompileResult with the rtc,
+       listing and binary, the listing is written as soon as it's made. The
+       listing text is only made if makeListing is set."""
+    result = api.CompileResult(args.srcPath.name)
 
     # Do the parsing first
     p = program.Program()
-    rtc = parser.Parse(args.srcPath.name, p)
-    # LOG.log("PAR rtc:{:d}".format(rtc))
+    result.rtc = parser.Parse(args.srcPath.name, p, context)
+    # context.log.log("PAR rtc:{:d}".format(rtc))
 
-    if (rtc == 0):
-        rtc = optimiser.Optimise(p)
-        # LOG.log("OPT rtc:{:d}".format(rtc))
-        if (rtc == 0):
-            rtc, statements = compiler.Compile(p, args.compilerOpt)
-            # LOG.log("COM rtc:{:d}".format(rtc))
+    if (result.rtc == 0):
+        result.rtc, statements = api.CompileParsed(p, args.compilerOpt, fragments, context)
 
+        if ((statements is not None) and makeListing):
+            result.listing = "".join([str(s) + "\n" for s in statements])
             if (args.listing is not None):
-                for s in statements:
-                    args.listing.write(s + "\n")
+                args.listing.write(result.listing)
                 args.listing.close()
 
-    if (rtc == 0):
+    if (result.rtc == 0):
+        # the download includes the two version bytes
+        result.rtc, full_download_bytes = api.Assemble(statements, fragments, context)
+        if (result.rtc == 0):
+            result.binary = bytes(full_download_bytes)
+
+    return result
+
+
+def main(args, context):
+
+    fragments = GetLibrary(args)
+    results = GetResultCache(args)
+
+    # The messages are replayed from the JSON output, so other sinks and dumps always compile
+    if ((context.out.GetSink() != io.SINK.JSON) or (context.out.GetInfoDumpMask() != 0)):
+        results = None
+
+    key = None
+    result = None
+    if (results is not None):
+        try:
+            fh = open(args.srcPath.name, "rb")
+            key = results.Key(b"".join(fh.readlines()), args.compilerOpt, context.out.GetMaxLevel())
+            fh.close()
+            result = results.Get(key, args.srcPath.name)
+        except (IOError, OSError):
+            # the parser will report it
+            pass
+
+    if (result is not None):
+        # compiled before, so only the outputs are made
+        context.out.Replay(result.error, result.messages)
+        if ((result.listing is not None) and (args.listing is not None)):
+            args.listing.write(result.listing)
+            args.listing.close()
+        changed = False
+    else:
+        # a cached result always has the listing, a later compile may want it
+        result = CompileFile(args, context, fragments, (args.listing is not None) or (key is not None))
+        output = context.out.GetJson()
+        result.error = output["error"]
+        result.messages = list(output["messages"])
+        changed = True
+
+    rtc = result.rtc
+    if (rtc == 0) and (not args.checkOnly) and ((not args.nowav) or (args.descriptor is not None)):
+        full_download_bytes = bytearray(result.binary)
+        versionNumber = full_download_bytes[0]
+
+        if (args.descriptor is not None):
+            # the client will synthesise the audio from this
+            json.dump(audio.Encoder().CreateDescriptor(full_download_bytes), args.descriptor)
+            args.descriptor.close()
+
+        if (not args.nowav):
+            absSrcPath = os.path.abspath(args.srcPath.name)
+            path = os.path.dirname(absSrcPath)
+            a = audio.Output(path)
+
+            context.out.DebugRaw("WavPath:", a.GetWavPath())
+            context.out.SetWavFilename(a.GetWavPath())
 
-        # clear global memory
-        hl_parser.reset_devices_and_locations()
-        token_assembler.reset_tokens()
+            # print(len(full_download_bytes))
 
-        # print(statements)
-        dBytes, dString, dType, version = token_assembler.assemble_lines(statements, False)
-        # print("Size:", len(dBytes), len(dString), dType, version)
-        if (len(dBytes) == 0 or dType == 0 or version == 0):
-            rtc = 1
-        elif (not args.checkOnly) and (not args.nowav):
-            versionNumber = (version[0] << 4) + version[1]
-            versionString = chr(versionNumber) + chr(255 - versionNumber)
-            # print(versionNumber, ord(versionString[0]), ord(versionString[1]), download_type)
+            context.log.log("WAV size:{:d} ver:{:d} name:{:s}".format(len(full_download_bytes),
+                                                                          versionNumber,
+                                                                          a.GetWavPath()))
 
-            if (not args.nowav):
-                absSrcPath = os.path.abspath(args.srcPath.name)
-                path = os.path.dirname(absSrcPath)
-                a = audio.Output(path)
+            if (result.wav is None):
+                result.wav = bytes(a.CreateWav(full_download_bytes))
+                changed = True
+            a.WriteWavBytes(result.wav)
 
-                io.Out.DebugRaw("WavPath:", a.GetWavPath())
-                io.Out.SetWavFilename(a.GetWavPath())
+            if (args.binary is not None):
+                args.binary.write(full_download_bytes)
+                args.binary.close()
 
-                full_download_str = versionString + dString
-                full_download_bytes = [versionNumber, 255 - versionNumber]
-                full_download_bytes.extend(dBytes)
-                # print(len(full_download_bytes))
+    if ((key is not None) and changed):
+        results.Add(key, result)
 
-                LOG.log("WAV size:{:d} ver:{:d} name:{:s}".format(len(full_download_bytes),
-                                                                      versionNumber,
-                                                                      a.GetWavPath()))
+    return rtc
 
-                a.WriteWav(full_download_bytes)
 
-                if (args.binary is not None):
-                    args.binary.write(full_download_str)
-                    args.binary.close()
+def CompileRequest(request, args, fragments, results):
+    """Compile the source of one server request, with api.CompileSource()"""
+    options = dict(request.get("options", {}))
+    options.update({"level": args.outputLevel, "reraise": args.reraise, "library": fragments,
+                    "cache": results})
 
-    return rtc
+    result = api.CompileSource(request.get("source", ""), options, request.get("filename", "SOURCE.py"))
+
+    reply = {"id": request.get("id"), "rtc": result.rtc,
+             "output": {"error": result.error, "messages": result.messages, "wavFilename": None}}
+    if (result.listing is not None):
+        reply["listing"] = result.listing
+    if (result.binary is not None):
+        reply["binary"] = base64.b64encode(result.binary).decode("ascii")
+    if (result.wav is not None):
+        reply["wav"] = base64.b64encode(result.wav).decode("ascii")
+    if (result.descriptor is not None):
+        reply["descriptor"] = result.descriptor
+
+    return reply
+
+
+def ServeStream(inFile, outFile, args, fragments, results):
+    """Reply to each request line from inFile with a line on outFile"""
+    for line in iter(inFile.readline, ""):
+        if (not line.strip()):
+            continue
+
+        request = {}
+        try:
+            request = json.loads(line)
+            reply = CompileRequest(request, args, fragments, results)
+        except (Exception, SystemExit) as e:
+            # a bad request or a fatal error - the server carries on
+            reply = {"id": request.get("id") if isinstance(request, dict) else None, "rtc": 1,
+                     "output": {"error": True, "messages": ["ERR: Bad request: {}".format(e)],
+                                "wavFilename": None}}
+
+        LOG.log("SERVE id:{} rtc:{:d}".format(reply["id"], reply["rtc"]))
+        outFile.write(json.dumps(reply) + "\n")
+        outFile.flush()
+
+
+def ServeConnection(conn, args, fragments, results):
+    try:
+        ServeStream(conn.makefile("r"), conn.makefile("w"), args, fragments, results)
+    except socket.error:
+        # the client went away
+        pass
+    finally:
+        conn.close()
+
+
+def Serve(args):
+    """Compile server. Requests are JSON, one per line, from stdin (-S) or
+       from connections to a Unix socket (-U), each connection served by its
+       own thread as every request is compiled in its own context. A request is
+         {"id": ..., "filename": ..., "source": ..., "options": {...}}
+       with the options in api.DEFAULT_OPTIONS (but the level and library
+       are from the command line). The reply line is
+         {"id": ..., "rtc": ..., "output": <as -o json>, "listing": ...,
+          "binary": <base64>, "wav": <base64>, "descriptor": ...}
+       with only the outputs that were asked for."""
+    fragments = GetLibrary(args)
+    results = GetResultCache(args)
+
+    if (args.socketPath is None):
+        # replies go to stdout, so anything else printed goes to stderr
+        replies = sys.stdout
+        sys.stdout = sys.stderr
+        ServeStream(sys.stdin, replies, args, fragments, results)
+        return
+
+    if (os.path.exists(args.socketPath) and stat.S_ISSOCK(os.stat(args.socketPath).st_mode)):
+        os.remove(args.socketPath)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socketPath)
+    server.listen(5)
+
+    try:
+        while True:
+            conn, addr = server.accept()
+            worker = threading.Thread(target=ServeConnection, args=(conn, args, fragments, results))
+            worker.daemon = True
+            worker.start()
+    finally:
+        server.close()
+        os.remove(args.socketPath)
 
 
 def ProcessCommandArgs(args):
@@ -115,12 +269,12 @@ def ProcessCommandArgs(args):
 
     testChoices = ("pass", "fail")
 
-    version = "1.2.11"
+    version = api.VERSION
     parser = argparse.ArgumentParser(prog="EdPy.py", description="Full Ed.Py compiler, version %s - from source to wav file." % (version,))
     parser.add_argument("langPath", metavar="LANG", type=argparse.FileType('r'),
                         help="Path to a language file")
-    parser.add_argument("srcPath", metavar="SRC", type=argparse.FileType('r'),
-                        help="Path to the source to be compiled")
+    parser.add_argument("srcPath", metavar="SRC", type=argparse.FileType('r'), nargs='?',
+                        help="Path to the source to be compiled (not used by a server)")
     parser.add_argument("-v", action="version", version="%(prog)s " + version)
 
     parser.add_argument("-c", dest="checkOnly", action="store_true",
@@ -149,6 +303,30 @@ def ProcessCommandArgs(args):
     parser.add_argument("-w", dest="nowav", action="store_true",
                         help="don't output the wav file")
 
+    parser.add_argument("-j", dest="descriptor", metavar="DESCRIPTOR", type=argparse.FileType('w'),
+                        help="save a JSON descriptor of the download, for client side " +
+                        "synthesis of the wav (use with -w to skip the wav file)")
+
+    parser.add_argument("-L", dest="libraryPath", metavar="LIBDIR", default=None,
+                        help="keep the internal Ed. functions pre-assembled in LIBDIR " +
+                        "and link them into later compiles")
+
+    parser.add_argument("-C", dest="cachePath", metavar="CACHEDIR", default=None,
+                        help="keep compile results in CACHEDIR, so compiling the same source " +
+                        "again only makes the outputs (only with -o json)")
+
+    parser.add_argument("-M", dest="cacheMBytes", metavar="MBYTES", type=int,
+                        default=cache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="the most the results in CACHEDIR can use, the least recently " +
+                        "used are removed past this (default %(default)s)")
+
+    parser.add_argument("-S", dest="server", action="store_true",
+                        help="run as a compile server, with JSON requests and replies " +
+                        "(one per line) on stdin and stdout")
+
+    parser.add_argument("-U", dest="socketPath", metavar="SOCKET", default=None,
+                        help="run as a compile server on the Unix domain socket SOCKET")
+
     # TODO: Change defaults back to normal ones for web app
     parser.add_argument("-o", type=util.LowerStr, default="json",  # default="console",
                         choices=list(zip(*outputChoices))[0],
@@ -167,6 +345,12 @@ def ProcessCommandArgs(args):
 
     sinkNumber = [x[1] for x in outputChoices if x[0] == parsed.o][0]
     outputLevel = [x[1] for x in levelChoices if x[0] == parsed.l][0]
+    parsed.outputLevel = outputLevel
+
+    if (parsed.socketPath is not None):
+        parsed.server = True
+    if (parsed.srcPath is None and not parsed.server):
+        parser.error("SRC is needed unless running as a server")
 
     io.Out.SetLangFileHandle(parsed.langPath)
     io.Out.SetSink(sinkNumber)
@@ -189,6 +373,11 @@ if __name__ == '__main__':
     parsed = ProcessCommandArgs(sys.argv[1:])
     io.Out.DebugRaw("Command line args", parsed)
 
+    if parsed.server:
+        Serve(parsed)
+        LOG.close()
+        sys.exit(0)
+
     if parsed.x:
         if parsed.x == "pass":
             # want to output a wav file and json which has error = False
@@ -212,8 +401,10 @@ if __name__ == '__main__':
             io.Out.FatalRaw("Invalid special option: {}".format(parsed.x))
 
     else:
-        # normal processing
-        rtc = main(parsed)
+        # normal processing, in the context that io.Out was set up in
+        context = compilation.Current()
+        context.log = LOG
+        rtc = main(parsed, context)
 
     totalOutput = ""
     totalProgram = []
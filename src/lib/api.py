@@ -0,0 +1,223 @@
+#!/usr/bin/env python2
+# * **************************************************************** **
+# File: api.py
+# Requires: Python 2.7+ (but not Python 3.0+)
+# Note: For history, changes and dates for this file, consult git.
+# Author: Brian Danilko, Likeable Software (brian@likeablesoftware.com)
+# Copyright 2015-2017 Microbric Pty Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (in the doc/licenses directory)
+# for more details.
+#
+# * **************************************************************** */
+
+
+""" Module providing the whole compile, from source text to the download and wav, in memory. """
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+from . import io
+from . import audio
+from . import program
+from . import parser
+from . import optimiser
+from . import compiler
+from . import hl_parser
+from . import token_assembler
+from . import compilation
+from . import version
+
+VERSION = version.VERSION
+
+# The options for CompileSource(), and what they are if not given
+DEFAULT_OPTIONS = {
+    "compilerOpt": True,        # use the compiler optimisations
+    "checkOnly": False,         # only check the program, no binary, wav or descriptor
+    "listing": False,           # the assembler listing
+    "binary": True,             # the download bytes
+    "wav": False,               # the wav file
+    "descriptor": False,        # the audio.Encoder descriptor of the wav
+    "level": io.LEVEL.WARN,     # the most detailed messages to keep
+    "reraise": False,           # re-raise exceptions after reporting them
+    "library": None,            # a library.Library of the internal functions (uses its directory)
+    "cache": None,              # a cache.ResultCache of earlier results (uses its directory)
+}
+
+
+class CompileResult(object):
+    """The outcome of CompileSource(). Outputs that weren't asked for, or
+       that the compile didn't get to, are None."""
+
+    def __init__(self, filename=None):
+        self.filename = filename        # the name the source was compiled as
+        self.rtc = 1
+        self.error = True
+        self.messages = []              # as in the JSON output
+        self.listing = None             # the assembler listing, one string
+        self.binary = None              # the download bytes, including the version bytes
+        self.wav = None                 # the wav file bytes
+        self.descriptor = None          # dictionary (json compatible)
+
+
+def CompileParsed(p, compilerOpt, fragments, context):
+    """Optimise and compile the parsed program. Returns (rtc, statements),
+       statements is None if the compiler wasn't reached"""
+    statements = None
+
+    rtc = optimiser.Optimise(p, context)
+    # context.log.log("OPT rtc:{:d}".format(rtc))
+    if (rtc == 0):
+        rtc, statements = compiler.Compile(p, compilerOpt, fragments, context)
+        # context.log.log("COM rtc:{:d}".format(rtc))
+
+    return rtc, statements
+
+
+def Assemble(statements, fragments, context):
+    """Assemble the compiled statements. Returns (rtc, download), the
+       download includes the two version bytes"""
+
+    with context:
+        # clear the assembler state
+        hl_parser.reset_devices_and_locations()
+        token_assembler.reset_tokens()
+
+    # print(statements)
+    full_download_bytes, dType, version = token_assembler.assemble_lines(statements, False, fragments,
+                                                                         context)
+    # print("Size:", len(full_download_bytes), dType, version)
+    if (len(full_download_bytes) == 0 or dType == 0 or version == 0):
+        return 1, full_download_bytes
+
+    return 0, full_download_bytes
+
+
+def CompileSource(text, options=None, filename="SOURCE.py"):
+    """Compile the Ed.Py program in text (unicode or utf-8 bytes) and return a
+       CompileResult. options is a dictionary of the DEFAULT_OPTIONS to change.
+       The compile is in its own compilation.CompilationContext and nothing is
+       read or written outside of memory, except the library and cache if they
+       are given. Raises ValueError for an unknown or bad option."""
+    opts = dict(DEFAULT_OPTIONS)
+    if (options is not None):
+        opts.update(options)
+    CheckOptions(opts)
+
+    if (not isinstance(text, bytes)):
+        text = text.encode("utf-8")
+
+    results = opts["cache"]
+    full = None
+    if (results is not None):
+        key = results.Key(text, opts["compilerOpt"], opts["level"])
+        full = results.Get(key, filename)
+
+    if (full is None):
+        fatal, full = Build(text, filename, opts)
+        if ((results is not None) and (not fatal)):
+            results.Add(key, full)
+
+    elif (opts["wav"] and (not opts["checkOnly"]) and (full.wav is None) and (full.binary is not None)):
+        # an earlier compile didn't want the wav
+        full.wav = bytes(audio.Encoder().CreateWav(bytearray(full.binary)))
+        results.Add(key, full)
+
+    return Select(full, opts)
+
+
+def CheckOptions(opts):
+    """Raise ValueError if opts has an option that isn't in DEFAULT_OPTIONS,
+       or a level that isn't an io.LEVEL"""
+    for name in opts:
+        if (name not in DEFAULT_OPTIONS):
+            raise ValueError("Unknown compile option: {}".format(name))
+
+    level = opts["level"]
+    if (isinstance(level, bool) or (not isinstance(level, int)) or (not io.LEVEL.isValid(level))):
+        raise ValueError("Bad level option: {!r}".format(level))
+
+
+def Build(text, filename, opts):
+    """Compile text in a new context. Returns (fatal, result), the result
+       has all of the outputs except the descriptor (and the wav if it wasn't
+       wanted). After a fatal error it only has the messages, the last
+       being the fatal error."""
+    context = compilation.CompilationContext()
+    context.useFiles = False
+    context.out.SetSink(io.SINK.JSON)
+    context.out.SetMaxLevel(opts["level"])
+    context.out.SetReRaise(opts["reraise"])
+
+    full = CompileResult(filename)
+    fatal = False
+    try:
+        full.rtc = BuildStages(text, filename, opts, context, full)
+    except SystemExit:
+        fatal = True
+        full = CompileResult(filename)
+
+    output = context.out.GetJson()
+    full.error = output["error"]
+    full.messages = output["messages"]
+    return fatal, full
+
+
+def BuildStages(text, filename, opts, context, full):
+    """The stages of Build(), filling in full. Returns the rtc."""
+    context.out.Top(io.TS.PARSE_START, "Starting parse of file:{0}", filename)
+    p = program.Program()
+    rtc = parser.ParseString(text, filename, p, context)
+    if (rtc != 0):
+        return rtc
+
+    rtc, statements = CompileParsed(p, opts["compilerOpt"], opts["library"], context)
+    # the text is only made if it's wanted, a cached result always has it
+    if ((statements is not None) and (opts["listing"] or (opts["cache"] is not None))):
+        full.listing = "".join([str(s) + "\n" for s in statements])
+    if (rtc != 0):
+        return rtc
+
+    rtc, download = Assemble(statements, opts["library"], context)
+    if (rtc != 0):
+        return rtc
+
+    full.binary = bytes(download)
+    if (opts["wav"] and not opts["checkOnly"]):
+        full.wav = bytes(audio.Encoder().CreateWav(download))
+
+    return 0
+
+
+def Select(full, opts):
+    """The result with only the outputs that opts asks for"""
+    result = CompileResult(full.filename)
+    result.rtc = full.rtc
+    result.error = full.error
+    result.messages = list(full.messages)
+
+    if (opts["listing"]):
+        result.listing = full.listing
+
+    if (full.rtc == 0 and not opts["checkOnly"]):
+        if (opts["binary"]):
+            result.binary = full.binary
+        if (opts["descriptor"]):
+            result.descriptor = audio.Encoder().CreateDescriptor(bytearray(full.binary))
+        if (opts["wav"]):
+            result.wav = full.wav
+
+    return result
+
+
+# Only to be used as a module
+if __name__ == '__main__':
+    io.Out.FatalRaw("This file is a module and can not be run as a script!")
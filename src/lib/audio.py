@@ -24,11 +24,21 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
+import base64
+import multiprocessing
 import wave
 import tempfile
 import os.path
+import re
+import struct
 import sys
 
+# NumPy is optional. When it is available (and USE_NUMPY is set) the whole
+# download is synthesised with a few vectorised operations. It is only
+# imported when it's wanted, as the import is slow (see ImportNumpy).
+numpy = None
+numpyChecked = False
+
 DOWNLOAD_BYTES_BETWEEN_PAUSES = 1536
 DOWNLOAD_PAUSE_MSECS = 2000
 
@@ -45,6 +55,45 @@ SAMPLES_PER_QUANTA = WAVE_SAMPLE_RATE_HZ / 2000
 
 PULSE_AUDIO = True
 
+# Use the NumPy backend (if NumPy can be imported). Both audio modes are
+# table driven in pure python, which is faster, so it's off by default.
+USE_NUMPY = False
+
+# The length, in midQuantas, of the gap after the pulse of each symbol.
+# A byte is sent as a START, then 8 data bits (lsb first), then a STOP.
+START_QUANTAS = 6
+ZERO_QUANTAS = 0
+ONE_QUANTAS = 2
+STOP_QUANTAS = 8
+
+# The levels that a ramping symbol can start from. A zero symbol ends at
+# the 'near' level, every other symbol ends at the middle level.
+MIDDLE_LEVEL = (128, 128)
+NEAR_LEVEL = (0, 255)
+
+# 500 milliseconds (1000 midQuantas) of silence at the beginning and end
+LEAD_SILENCE_QUANTAS = 1000
+
+# Version of the client side synthesis descriptor (see Encoder.CreateDescriptor)
+DESCRIPTOR_VERSION = 1
+
+# Number of bits set in each byte value - a one bit is a longer symbol than a zero
+BITS_SET = [bin(b).count("1") for b in range(256)]
+
+
+def ImportNumpy():
+    """Import NumPy the first time it's needed. Returns the module, or None
+       if it isn't available"""
+    global numpy, numpyChecked
+    if (not numpyChecked):
+        numpyChecked = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
 # ############ main audio creator class ###############################################
 
 # i2b is function for converting int to byte
@@ -53,131 +102,343 @@ if sys.version_info[0] == 2:
 else:
     i2b = lambda x: bytes([x])
 
-class Output(object):
-    """Create a wav file"""
-
-    def __init__(self, dir, nameOverride=None):
-        """Create an audio file within a directory (typically creating a new name)"""
-        self.directory = dir
-        if nameOverride:
-            self.filename = nameOverride
-            self.fileHandle = open(self.filename, "wb")
-        else:
-            self.fileHandle = tempfile.NamedTemporaryFile(mode="wb",
-                                                          prefix="tok", suffix=".wav",
-                                                          dir=self.directory, delete=False)
-            self.filename = self.fileHandle.name
+class Encoder(object):
+    """Convert download bytes into wav frames"""
 
+    def __init__(self, pulseAudio=None):
         self.sampleRate = 44100
         self.samplesPerQuanta = self.sampleRate / 2000
         self.lastLeft = 128
         self.lastRight = 128
         self.downloadBytesBetweenPauses = 1536
         self.downloadPauseMsecs = 2000
+        self.processes = 1
+
+        # Pulse frames only depend on the sample rate, so they are built
+        # once and cached. Cleared whenever the sample rate changes.
+        self.symbolCache = {}
+        self.byteTable = None
+        self.rampCache = {}
+        self.rampByteTables = {}
 
-        if (PULSE_AUDIO):
+        if (pulseAudio is None):
+            pulseAudio = PULSE_AUDIO
+        self.pulseAudio = pulseAudio
+
+        if (pulseAudio):
             self.audio_func = self.createAudioWithPulses
             self.silence_func = self.createSilenceWithPulses
+            self.segment_func = self.createSegmentWithPulses
         else:
-            self.audio_func = self.createAudioRamping
+            self.audio_func = self.createAudioFromRampTable
             self.silence_func = self.createSilenceRamping
+            self.segment_func = self.createSegmentRamping
+        self.frames_func = self.genFramesSerial
+
+        if (USE_NUMPY and ImportNumpy() is not None):
+            self.frames_func = self.genFramesNumpy
+
+        # used again if SetProcesses goes back to a single process
+        self.singleFramesFunc = self.frames_func
 
 
     def SetSampleRate(self, sampleRate):
         self.sampleRate = sampleRate
         self.samplesPerQuanta = self.sampleRate / 2000
+        self.symbolCache = {}
+        self.byteTable = None
+        self.rampCache = {}
+        self.rampByteTables = {}
+
+    def SetProcesses(self, processes):
+        """Synthesise the segments between pauses in processes worker
+           processes. 1 (the default) does it all in this process."""
+        self.processes = processes
+        if (processes > 1):
+            self.frames_func = self.genFramesParallel
+        else:
+            self.frames_func = self.singleFramesFunc
+
+    def GetFrameCount(self, binString):
+        """Return the exact number of frames that binString will become"""
+        spq = self.samplesPerQuanta
+        count = len(binString)
+        ones = 0
+        for data in binString:
+            ones += BITS_SET[data]
+
+        frames = 2 * LEAD_SILENCE_QUANTAS * spq
+        frames += 2 * spq * (2 * spq)
+        frames += count * ((2 + START_QUANTAS) + 8 * (2 + ZERO_QUANTAS) + (2 + STOP_QUANTAS)) * spq
+        frames += ones * (ONE_QUANTAS - ZERO_QUANTAS) * spq
+        if (count > 0):
+            pauses = (count - 1) // self.downloadBytesBetweenPauses
+            frames += pauses * self.downloadPauseMsecs * (2 + ZERO_QUANTAS) * spq
+
+        return frames
+
+    def CreateWavHeader(self, frameCount):
+        """The RIFF header (as written by the wave module) for 8-bit stereo PCM"""
+        dataBytes = frameCount * 2
+        return b"RIFF" + struct.pack("<L", 36 + dataBytes) + b"WAVE" + \
+            b"fmt " + struct.pack("<LHHLLHH", 16, 1, 2, self.sampleRate, self.sampleRate * 2, 2, 8) + \
+            b"data" + struct.pack("<L", dataBytes)
+
+    def GenerateWav(self, binaryData):
+        """Generator of a complete wav file for binaryData. The header is
+           yielded first, then the frames as they are synthesised."""
+        yield self.CreateWavHeader(self.GetFrameCount(binaryData))
 
-    def GetWavPath(self):
-        return os.path.join(self.directory, self.filename)
-
-    def CreateDebugWav(self):
-        waveWriter = wave.open(self.fileHandle)
-        waveWriter.setnchannels(2)
-        waveWriter.setsampwidth(1)
-        waveWriter.setframerate(self.sampleRate)
-        waveWriter.setcomptype("NONE", "")
-
-        # now generate the test file
-        data = chr(255) + chr(0) + \
-            chr(128) + chr(128) + \
-            chr(0) + chr(255) + \
-            chr(128) + chr(128)
-        count = 2000
-        while count > 0:
-            waveWriter.writeframes(data)
-            count -= 1
-
-        waveWriter.close()
-
-    # def WriteProgramWav(self, binaryString):
-    #     self.WriteWav(TOKEN_DOWNLOAD_STR + TOKEN_VERSION_STR + binaryString)
-
-    # def WriteFirmwareWav(self, binaryString):
-    #     self.WriteWav(FIRMWARE_DOWNLOAD_STR + FIRMWARE_VERSION_STR + binaryString)
-
-    def WriteWav(self, binaryData):
-        waveWriter = wave.open(self.fileHandle)
-        waveWriter.setnchannels(2)
-        waveWriter.setsampwidth(1)
-        waveWriter.setframerate(self.sampleRate)
-        waveWriter.setcomptype("NONE", "")
+        self.lastLeft = 128
+        self.lastRight = 128
+        for frames in self.frames_func(binaryData):
+            yield frames
+
+    def StreamWav(self, binaryData, outFile):
+        """Write a complete wav file for binaryData to outFile, which only needs
+           a write() method (stdout, a pipe, a BytesIO, socket.makefile(), etc.)"""
+        for chunk in self.GenerateWav(binaryData):
+            outFile.write(chunk)
+
+    def CreateWav(self, binaryData):
+        """Return a complete wav file for binaryData. The exact size is known
+           up front, so it's one buffer which is filled in place."""
+        frameCount = self.GetFrameCount(binaryData)
+        header = self.CreateWavHeader(frameCount)
+        wav = bytearray(len(header) + frameCount * 2)
+        view = memoryview(wav)
+
+        view[:len(header)] = header
+        index = len(header)
 
         self.lastLeft = 128
         self.lastRight = 128
-        self.ConvertWithPause(binaryData, waveWriter)
-        waveWriter.close()
+        for frames in self.frames_func(binaryData):
+            view[index:index + len(frames)] = frames
+            index += len(frames)
+
+        if (index != len(wav)):
+            raise ValueError("Wav frame count was %d, not %d" % ((index - len(header)) // 2, frameCount))
+
+        return wav
+
+    def CreateDescriptor(self, binaryData):
+        """Return a (json compatible) description of the wav for binaryData:
+           the download bytes and every timing parameter needed to
+           synthesise the audio on the client. See DescriptorToWav()."""
+        return {
+            "descriptorVersion": DESCRIPTOR_VERSION,
+            "sampleRate": self.sampleRate,
+            "samplesPerQuanta": self.samplesPerQuanta,
+            "pulseAudio": self.pulseAudio,
+            "ramp": list(RAMP),
+            "quantas": {"start": START_QUANTAS, "zero": ZERO_QUANTAS,
+                        "one": ONE_QUANTAS, "stop": STOP_QUANTAS,
+                        "leadSilence": LEAD_SILENCE_QUANTAS},
+            "bytesBetweenPauses": self.downloadBytesBetweenPauses,
+            "pauseMsecs": self.downloadPauseMsecs,
+            "data": base64.b64encode(bytes(bytearray(binaryData))).decode("ascii"),
+        }
+
+    def CreateFrames(self, binString):
+        """Return the frames for the whole download as one byte string"""
+        return b"".join(self.frames_func(binString))
+
+    def GetPulseSymbol(self, midQuantas):
+        """Return the (cached) pulse frames for one symbol"""
+        if (midQuantas not in self.symbolCache):
+            self.symbolCache[midQuantas] = self.createAudioWithPulses(midQuantas, self.sampleRate)
+        return self.symbolCache[midQuantas]
+
+    def GetByteTable(self):
+        """Return a table, indexed by byte value, of the pulse frames for
+           the complete byte (start, data bits lsb first, and stop)"""
+        if (self.byteTable is None):
+            start = self.GetPulseSymbol(START_QUANTAS)
+            bits = (self.GetPulseSymbol(ZERO_QUANTAS), self.GetPulseSymbol(ONE_QUANTAS))
+            stop = self.GetPulseSymbol(STOP_QUANTAS)
+
+            self.byteTable = []
+            for value in range(256):
+                frames = [start]
+                for bit in range(8):
+                    frames.append(bits[(value >> bit) & 1])
+                frames.append(stop)
+                self.byteTable.append(b"".join(frames))
+
+        return self.byteTable
+
+    def GetRampSymbol(self, level, midQuantas):
+        """Return the (cached) ramping frames for one symbol that starts at
+           level, and the level that it ends at"""
+        key = (level, midQuantas)
+        if (key not in self.rampCache):
+            self.lastLeft, self.lastRight = level
+            frames = self.createAudioRamping(midQuantas, self.sampleRate)
+            self.rampCache[key] = (frames, (self.lastLeft, self.lastRight))
+        return self.rampCache[key]
+
+    def GetRampByteTable(self, level):
+        """Return a table, indexed by byte value, of the ramping frames for
+           the complete byte when it starts at level. Every byte ends with
+           a stop, so at the middle level."""
+        if (level not in self.rampByteTables):
+            table = []
+            for value in range(256):
+                symbols = [START_QUANTAS]
+                for bit in range(8):
+                    symbols.append((ONE_QUANTAS, ZERO_QUANTAS)[((value >> bit) & 1) == 0])
+                symbols.append(STOP_QUANTAS)
+
+                frames = []
+                symbolLevel = level
+                for midQuantas in symbols:
+                    symbolFrames, symbolLevel = self.GetRampSymbol(symbolLevel, midQuantas)
+                    frames.append(symbolFrames)
+                table.append(b"".join(frames))
+            self.rampByteTables[level] = table
+
+        return self.rampByteTables[level]
+
+    def GetSegments(self, binString):
+        """Split binString into the segments that are sent between pauses"""
+        between = self.downloadBytesBetweenPauses
+        return [binString[index:index + between] for index in range(0, len(binString), between)]
+
+    def genFrames(self, binString, segmentFrames):
+        """Generator of the frames, a segment (between pauses) at a time.
+           segmentFrames is an iterator of the frames for each segment."""
+        yield self.silence_func(LEAD_SILENCE_QUANTAS, self.sampleRate) + \
+            self.createZeros(self.samplesPerQuanta)
 
-    def ConvertWithPause(self, binString, waveWriter):
         index = 0
-        preamble = 0
-        pauseCount = 0
-
-        # 500 milliseconds (1000 midQuantas) of silence at the beginning
-        waveWriter.writeframes(self.silence_func(1000, self.sampleRate))
-
-        preamble = 0
-        while (preamble < self.samplesPerQuanta):
-            waveWriter.writeframes(self.audio_func(0, self.sampleRate))
-            preamble += 1
-
-        while (index < len(binString)):
-            if (pauseCount == self.downloadBytesBetweenPauses):
-                preamble = 0
-                while (preamble < self.downloadPauseMsecs):
-                    waveWriter.writeframes(self.audio_func(0, self.sampleRate))
-                    preamble += 1
-                pauseCount = 0
-
-            data = binString[index]
-
-            # start
-            waveWriter.writeframes(self.audio_func(6, self.sampleRate))
-
-            # now the actual data -- big endian or little endian
-            mask = 1
-            ones = 0
-            while (mask <= 0x80):
-                if (data & mask):
-                    waveWriter.writeframes(self.audio_func(2, self.sampleRate))
-                    ones += 1
-                else:
-                    waveWriter.writeframes(self.audio_func(0, self.sampleRate))
-                mask <<= 1
-
-            # add stop - BBB Changed to 8 - differs from start
-            waveWriter.writeframes(self.audio_func(8, self.sampleRate))
-
+        for frames in segmentFrames:
+            if (index > 0):
+                yield self.createZeros(self.downloadPauseMsecs)
+
+            yield frames
+            # a segment always ends with a stop, leaving the middle level
+            self.lastLeft = 128
+            self.lastRight = 128
             index += 1
-            pauseCount += 1
 
         # added to end as well - to ensure entire data is played. - ## BBB
-        preamble = 0
-        while (preamble < self.samplesPerQuanta):
-            waveWriter.writeframes(self.audio_func(0, self.sampleRate))
-            preamble += 1
+        yield self.createZeros(self.samplesPerQuanta) + \
+            self.silence_func(LEAD_SILENCE_QUANTAS, self.sampleRate)
+
+    def genFramesSerial(self, binString):
+        return self.genFrames(binString, (self.segment_func(segment)
+                                          for segment in self.GetSegments(binString)))
+
+    def genFramesParallel(self, binString):
+        """Every segment follows zeros (the preamble or a pause), so they can
+           be synthesised independently and then put back in order."""
+        jobs = [(self.pulseAudio, self.sampleRate, list(segment))
+                for segment in self.GetSegments(binString)]
+
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for frames in self.genFrames(binString, pool.imap(EncodeSegment, jobs)):
+                yield frames
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def createZeros(self, count):
+        """count zero symbols"""
+        if (self.pulseAudio):
+            return self.GetPulseSymbol(ZERO_QUANTAS) * count
+        elif (count == 0):
+            return b""
+        else:
+            # only the first zero depends on the current level, the rest start 'near'
+            first = self.audio_func(ZERO_QUANTAS, self.sampleRate)
+            return first + self.audio_func(ZERO_QUANTAS, self.sampleRate) * (count - 1)
+
+    def createSegmentWithPulses(self, segment):
+        byteTable = self.GetByteTable()
+        return b"".join([byteTable[data] for data in segment])
+
+    def createSegmentRamping(self, segment):
+        if (len(segment) == 0):
+            return b""
+
+        # the segment follows zeros so the first byte starts from the 'near'
+        # level, and every other byte follows a stop
+        first = self.GetRampByteTable(NEAR_LEVEL)
+        byteTable = self.GetRampByteTable(MIDDLE_LEVEL)
+        self.lastLeft, self.lastRight = MIDDLE_LEVEL
+
+        return first[segment[0]] + b"".join([byteTable[data] for data in segment[1:]])
+
+    def genFramesNumpy(self, binString):
+        """Vectorised version of genFramesSerial.
+           The output is byte for byte the same for either audio mode,
+           but is all produced in one go."""
+        silenceSamples = LEAD_SILENCE_QUANTAS * self.samplesPerQuanta
+        between = self.downloadBytesBetweenPauses
+
+        # Every byte becomes a start, 8 data bits (lsb first, so the same
+        # order as the mask loop in createSegmentRamping) and a stop.
+        data = numpy.asarray(binString, dtype=numpy.uint8).reshape(-1, 1)
+        bits = numpy.unpackbits(data, axis=1)[:, ::-1]
+        mids = numpy.empty((len(data), 10), dtype=numpy.int64)
+        mids[:, 0] = START_QUANTAS
+        mids[:, 1:9] = numpy.where(bits, ONE_QUANTAS, ZERO_QUANTAS)
+        mids[:, 9] = STOP_QUANTAS
+        mids = mids.reshape(-1)
+
+        # the pauses in front of every group of between bytes, and the
+        # preamble of zeros at both ends
+        pauses = numpy.arange(between, len(data), between) * 10
+        mids = numpy.insert(mids, numpy.repeat(pauses, self.downloadPauseMsecs), ZERO_QUANTAS)
+        preamble = numpy.zeros(self.samplesPerQuanta, dtype=numpy.int64) + ZERO_QUANTAS
+        mids = numpy.concatenate((preamble, mids, preamble))
+
+        lengths = (2 + mids) * self.samplesPerQuanta
+        offsets = numpy.cumsum(lengths) - lengths + silenceSamples
+        totalSamples = int(lengths.sum()) + 2 * silenceSamples
+
+        frames = numpy.empty((totalSamples, 2), dtype=numpy.uint8)
+        frames.fill(128)
+
+        # A ramp depends on the level left by the previous symbol, which is
+        # only ever 'near' (after a zero) or 'middle' (after anything else).
+        afterZero = numpy.zeros(len(mids), dtype=bool)
+        afterZero[1:] = (mids[:-1] == ZERO_QUANTAS)
+
+        for midQuantas in (ZERO_QUANTAS, ONE_QUANTAS, START_QUANTAS, STOP_QUANTAS):
+            for prevZero in (False, True):
+                where = offsets[(mids == midQuantas) & (afterZero == prevZero)]
+                if (len(where) == 0):
+                    continue
+                wave = self.numpyWave(self.audio_func, midQuantas, prevZero)
+                frames[where[:, numpy.newaxis] + numpy.arange(len(wave))] = wave
+
+        # the silence at the start and end
+        wave = self.numpyWave(self.silence_func, LEAD_SILENCE_QUANTAS, False)
+        frames[:len(wave)] = wave
+        wave = self.numpyWave(self.silence_func, LEAD_SILENCE_QUANTAS, True)
+        frames[totalSamples - silenceSamples:totalSamples - silenceSamples + len(wave)] = wave
+
+        yield frames.tobytes()
+
+    def numpyWave(self, func, midQuantas, prevZero):
+        """Frames from func as a (samples, 2) array, without the trailing
+           middle level samples (the frame buffer is already filled with them)"""
+        if (prevZero):
+            self.lastLeft, self.lastRight = 0, 255
+        else:
+            self.lastLeft, self.lastRight = 128, 128
+
+        wave = numpy.frombuffer(func(midQuantas, self.sampleRate), dtype=numpy.uint8).reshape(-1, 2)
+        self.lastLeft, self.lastRight = 128, 128
 
-        # 500 milliseconds (1000 midQuantas) of silence at the end
-        waveWriter.writeframes(self.silence_func(1000, self.sampleRate))
+        notMiddle = numpy.nonzero((wave != 128).any(axis=1))[0]
+        if (len(notMiddle) == 0):
+            return wave[:0]
+        return wave[:notMiddle[-1] + 1]
 
     def createAudioRamping(self, midQuantas, sample_rate):
         data = b""
@@ -194,20 +455,20 @@ class Output(object):
 
         return data
 
+    def createAudioFromRampTable(self, midQuantas, sample_rate):
+        """createAudioRamping() through the table of ramping symbols. The
+           level left by the last symbol is the state."""
+        frames, level = self.GetRampSymbol((self.lastLeft, self.lastRight), midQuantas)
+        self.lastLeft, self.lastRight = level
+        return frames
+
     def createAudioWithPulses(self, midQuantas, sample_rate):
-        data = b""
         samples_per_quanta = sample_rate / 2000
         total_samples = 2 * samples_per_quanta + (midQuantas * samples_per_quanta)
 
-        # write far
-        data += i2b(255) + i2b(0)
-        # write near
-        data += i2b(0) + i2b(255)
-
-        count = 2
-        while count < total_samples:
-            data += i2b(128) + i2b(128)
-            count += 1
+        # write far, then near, then the middle for the rest
+        data = i2b(255) + i2b(0) + i2b(0) + i2b(255)
+        data += (i2b(128) + i2b(128)) * (total_samples - 2)
 
         return data
 
@@ -216,16 +477,10 @@ class Output(object):
         return self.ramp(128, 128, midQuantas * samples_per_quanta)
 
     def createSilenceWithPulses(self, midQuantas, sample_rate):
-        data = b""
         samples_per_quanta = sample_rate / 2000
         total_samples = midQuantas * samples_per_quanta
 
-        count = 0
-        while count < total_samples:
-            data += i2b(128) + i2b(128)
-            count += 1
-
-        return data
+        return (i2b(128) + i2b(128)) * total_samples
 
     def ramp(self, newLeft, newRight, samples):
         # print "ramp", samples
@@ -255,3 +510,264 @@ class Output(object):
         self.lastLeft = newLeft
         self.lastRight = newRight
         return data
+
+
+class Output(Encoder):
+    """Create a wav file"""
+
+    def __init__(self, dir, nameOverride=None):
+        """Create an audio file within a directory (typically creating a new name)"""
+        Encoder.__init__(self)
+
+        self.directory = dir
+        if nameOverride:
+            self.filename = nameOverride
+            self.fileHandle = open(self.filename, "wb")
+        else:
+            self.fileHandle = tempfile.NamedTemporaryFile(mode="wb",
+                                                          prefix="tok", suffix=".wav",
+                                                          dir=self.directory, delete=False)
+            self.filename = self.fileHandle.name
+
+    def GetWavPath(self):
+        return os.path.join(self.directory, self.filename)
+
+    def CreateDebugWav(self):
+        waveWriter = wave.open(self.fileHandle)
+        waveWriter.setnchannels(2)
+        waveWriter.setsampwidth(1)
+        waveWriter.setframerate(self.sampleRate)
+        waveWriter.setcomptype("NONE", "")
+
+        # now generate the test file
+        data = chr(255) + chr(0) + \
+            chr(128) + chr(128) + \
+            chr(0) + chr(255) + \
+            chr(128) + chr(128)
+        count = 2000
+        while count > 0:
+            waveWriter.writeframes(data)
+            count -= 1
+
+        waveWriter.close()
+
+    # def WriteProgramWav(self, binaryString):
+    #     self.WriteWav(TOKEN_DOWNLOAD_STR + TOKEN_VERSION_STR + binaryString)
+
+    # def WriteFirmwareWav(self, binaryString):
+    #     self.WriteWav(FIRMWARE_DOWNLOAD_STR + FIRMWARE_VERSION_STR + binaryString)
+
+    def WriteWav(self, binaryData):
+        self.WriteWavBytes(self.CreateWav(binaryData))
+
+    def WriteWavBytes(self, wav):
+        """Write a wav file that was already created"""
+        self.fileHandle.write(wav)
+        self.fileHandle.flush()
+
+    def ConvertWithPause(self, binString, waveWriter):
+        waveWriter.writeframes(self.CreateFrames(binString))
+
+
+# ############ parallel synthesis ###############################################
+
+# Encoders for the worker processes, indexed on (pulseAudio, sampleRate)
+segmentEncoders = {}
+
+
+def EncodeSegment(job):
+    """Worker process function to synthesise one segment"""
+    pulseAudio, sampleRate, segment = job
+    if ((pulseAudio, sampleRate) not in segmentEncoders):
+        encoder = Encoder(pulseAudio)
+        encoder.SetSampleRate(sampleRate)
+        segmentEncoders[(pulseAudio, sampleRate)] = encoder
+
+    return segmentEncoders[(pulseAudio, sampleRate)].segment_func(segment)
+
+
+# ############ client side synthesis ###############################################
+
+def DescriptorToWav(descriptor):
+    """Reference decoder for Encoder.CreateDescriptor(). Only uses the values in
+       the descriptor, so is a model for client side synthesis, and must
+       give exactly the same wav as Output.WriteWav()."""
+    if (descriptor["descriptorVersion"] != DESCRIPTOR_VERSION):
+        raise ValueError("Unknown descriptor version: %s" % (descriptor["descriptorVersion"]))
+
+    spq = descriptor["samplesPerQuanta"]
+    quantas = descriptor["quantas"]
+    ramp = descriptor["ramp"]
+    between = descriptor["bytesBetweenPauses"]
+    data = bytearray(base64.b64decode(descriptor["data"]))
+
+    # the symbols, as midQuantas
+    symbols = [quantas["zero"]] * spq
+    for index in range(len(data)):
+        if (index > 0 and (index % between) == 0):
+            symbols.extend([quantas["zero"]] * descriptor["pauseMsecs"])
+
+        symbols.append(quantas["start"])
+        for bit in range(8):
+            if (data[index] & (1 << bit)):
+                symbols.append(quantas["one"])
+            else:
+                symbols.append(quantas["zero"])
+        symbols.append(quantas["stop"])
+    symbols.extend([quantas["zero"]] * spq)
+
+    # the samples as (left, right) levels
+    frames = bytearray()
+    level = [128, 128]
+
+    def changeLevel(left, right, samples):
+        if (descriptor["pulseAudio"]):
+            frames.extend(bytearray([left, right]) * samples)
+        else:
+            for percent in ramp:
+                frames.append(level[0] + ((left - level[0]) * percent) // 100)
+                frames.append(level[1] + ((right - level[1]) * percent) // 100)
+            frames.extend(bytearray([left, right]) * (samples - len(ramp)))
+        level[0], level[1] = left, right
+
+    silence = quantas["leadSilence"] * spq
+    changeLevel(128, 128, silence)
+    for midQuantas in symbols:
+        if (descriptor["pulseAudio"]):
+            changeLevel(255, 0, 1)
+            changeLevel(0, 255, 1)
+            changeLevel(128, 128, (2 + midQuantas) * spq - 2)
+        else:
+            changeLevel(255, 0, spq)
+            changeLevel(0, 255, spq)
+            if (midQuantas > 0):
+                changeLevel(128, 128, midQuantas * spq)
+    changeLevel(128, 128, silence)
+
+    sampleRate = descriptor["sampleRate"]
+    header = b"RIFF" + struct.pack("<L", 36 + len(frames)) + b"WAVE" + \
+        b"fmt " + struct.pack("<LHHLLHH", 16, 1, 2, sampleRate, sampleRate * 2, 2, 8) + \
+        b"data" + struct.pack("<L", len(frames))
+
+    return header + bytes(frames)
+
+
+# ############ demodulation ###############################################
+
+# A sample is part of a 'far' level if the left channel is at least this.
+# The mid level is 128, and the 'near' level and the ramps down to the
+# mid level stay well below it.
+FAR_THRESHOLD = 192
+
+# Translation table to turn the left channel into b"1" (far) and b"0" bytes
+FAR_TABLE = bytes(bytearray([ord("1") if b >= FAR_THRESHOLD else ord("0") for b in range(256)]))
+
+FAR_RUN = re.compile(b"1+")
+
+
+class Decoder(object):
+    """Recover the download bytes from a wav created by Encoder/Output.
+       Independent of the encoder, so it is a check of any encoder backend."""
+
+    def __init__(self):
+        self.sampleRate = None
+        self.samplesPerQuanta = None
+
+    def ReadWav(self, path):
+        """Decode the wav file at path"""
+        with open(path, "rb") as wavFile:
+            return self.DecodeWav(wavFile.read())
+
+    def DecodeWav(self, wavData):
+        """Return the download bytes (as a bytearray) in wavData, a complete
+           wav file. Raises ValueError if it can't be decoded."""
+        return self.DecodeSymbols(self.GetSymbols(self.GetFrames(wavData)))
+
+    def GetFrames(self, wavData):
+        """Parse the RIFF header and return the frames of 8-bit stereo PCM"""
+        wavData = bytes(wavData)
+        if (wavData[0:4] != b"RIFF" or wavData[8:12] != b"WAVE"):
+            raise ValueError("Not a wav file")
+
+        fmt = None
+        index = 12
+        while (index + 8 <= len(wavData)):
+            chunkId = wavData[index:index + 4]
+            chunkSize = struct.unpack("<L", wavData[index + 4:index + 8])[0]
+            index += 8
+            if (chunkId == b"fmt "):
+                fmt = struct.unpack("<HHLLHH", wavData[index:index + 16])
+            elif (chunkId == b"data"):
+                if (fmt is None):
+                    raise ValueError("Wav data chunk is before the fmt chunk")
+                if (fmt[0] != 1 or fmt[1] != 2 or fmt[5] != 8):
+                    raise ValueError("Wav is not 8-bit stereo PCM")
+
+                self.sampleRate = fmt[2]
+                self.samplesPerQuanta = self.sampleRate // 2000
+                return wavData[index:index + chunkSize]
+            index += chunkSize + (chunkSize & 1)
+
+        raise ValueError("Wav has no data chunk")
+
+    def GetSymbols(self, frames):
+        """Return a list of (frame, midQuantas) for every pulse in frames.
+           The gap of a symbol is measured from the start of its far level
+           to the start of the next one. The last pulse (a trailer zero)
+           has nothing after it, so it is not returned."""
+        spq = self.samplesPerQuanta
+        left = frames[0::2].translate(FAR_TABLE)
+        right = frames[1::2]
+
+        starts = []
+        for run in FAR_RUN.finditer(left):
+            start = run.start()
+            if (bytearray(right[start:start + 1])[0] >= 256 - FAR_THRESHOLD):
+                raise ValueError("Bad pulse at frame %d" % (start))
+            starts.append(start)
+
+        symbols = []
+        for index in range(len(starts) - 1):
+            gap = starts[index + 1] - starts[index]
+            midQuantas = (gap + spq // 2) // spq - 2
+            if (abs(gap - (2 + midQuantas) * spq) > spq // 4):
+                raise ValueError("Pulse gap of %d frames at frame %d is not a whole number of quantas" %
+                                 (gap, starts[index]))
+            symbols.append((starts[index], midQuantas))
+
+        return symbols
+
+    def DecodeSymbols(self, symbols):
+        """Decode (frame, midQuantas) symbols into bytes. Zero symbols between
+           bytes (preamble, pauses and trailer) are skipped."""
+        data = bytearray()
+        index = 0
+        while (index < len(symbols)):
+            frame, midQuantas = symbols[index]
+            if (midQuantas == ZERO_QUANTAS):
+                index += 1
+                continue
+            if (midQuantas != START_QUANTAS):
+                raise ValueError("Expected a start symbol at frame %d, found %d midQuantas" %
+                                 (frame, midQuantas))
+            if (index + 9 >= len(symbols)):
+                raise ValueError("Byte starting at frame %d is incomplete" % (frame))
+
+            value = 0
+            for bit in range(8):
+                frame, midQuantas = symbols[index + 1 + bit]
+                if (midQuantas == ONE_QUANTAS):
+                    value |= 1 << bit
+                elif (midQuantas != ZERO_QUANTAS):
+                    raise ValueError("Expected a data bit at frame %d, found %d midQuantas" %
+                                     (frame, midQuantas))
+
+            frame, midQuantas = symbols[index + 9]
+            if (midQuantas != STOP_QUANTAS):
+                raise ValueError("Expected a stop symbol at frame %d, found %d midQuantas" %
+                                 (frame, midQuantas))
+
+            data.append(value)
+            index += 10
+
+        return data
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+# * **************************************************************** **
+# File: cache.py
+# Requires: Python 2.7+ (but not Python 3.0+)
+# Note: For history, changes and dates for this file, consult git.
+# Author: Brian Danilko, Likeable Software (brian@likeablesoftware.com)
+# Copyright 2015-2017 Microbric Pty Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (in the doc/licenses directory)
+# for more details.
+#
+# * **************************************************************** */
+
+
+""" Module keeping the results of earlier compiles, so the same program isn't compiled twice. """
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import os
+import os.path
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from . import io
+from . import util
+from . import api
+from . import library
+from . import version
+
+# Change when the layout of an api.CompileResult changes
+RESULT_FORMAT = 1
+RESULT_EXT = ".res"
+
+# The modules that make a result, from the source to the messages and audio
+RESULT_MODULES = library.FRAGMENT_MODULES + ("library", "api", "audio", "io")
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class ResultCache(object):
+    """api.CompileResults kept in a directory, by a hash of everything that
+       goes into them. The least recently used are removed when the directory
+       grows past maxBytes. Writes are to a temporary file which is then
+       renamed, so processes sharing the directory never see a partial one."""
+
+    def __init__(self, path, maxBytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.maxBytes = maxBytes
+
+    def Key(self, source, compilerOpt, level):
+        """The result depends on the source bytes, the compiler version (and
+           the source of the modules that make it) and optimisations, the Ed.
+           code and values and the level of messages"""
+        h = hashlib.sha1()
+        h.update(repr((RESULT_FORMAT, api.VERSION, bool(compilerOpt), level,
+                       library.Fingerprint())).encode("utf-8"))
+        h.update(version.SourceHash(*RESULT_MODULES).encode("utf-8"))
+        h.update(source)
+        return h.hexdigest()
+
+    def GetResultPath(self, key):
+        return os.path.join(self.path, key + RESULT_EXT)
+
+    def Get(self, key, filename):
+        """Return the result for key, or None if there isn't one. A result
+           whose messages name a different source file is no use either."""
+        resultPath = self.GetResultPath(key)
+        try:
+            fh = open(resultPath, "rb")
+            try:
+                result = pickle.load(fh)
+            finally:
+                fh.close()
+        except Exception:
+            # not there (or unreadable) - it will be compiled again
+            return None
+
+        if (result.filename != filename):
+            for message in result.messages:
+                if (result.filename in message):
+                    return None
+            result.filename = filename
+
+        try:
+            # it's now the most recently used
+            os.utime(resultPath, None)
+        except OSError:
+            pass
+
+        return result
+
+    def Add(self, key, result):
+        """Write the result and then remove the least recently used results
+           if the directory is too large. A result that is larger than the
+           whole cache isn't kept."""
+        try:
+            if (not os.path.isdir(self.path)):
+                os.makedirs(self.path)
+
+            fd, tmpPath = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+            fh = os.fdopen(fd, "wb")
+            try:
+                pickle.dump(result, fh, pickle.HIGHEST_PROTOCOL)
+                size = fh.tell()
+            finally:
+                fh.close()
+
+            if (size > self.maxBytes):
+                os.remove(tmpPath)
+                io.Out.DebugRaw("Result {} is too large to cache ({} bytes)".format(key, size))
+                return
+
+            util.SetNewFileMode(tmpPath)
+            os.rename(tmpPath, self.GetResultPath(key))
+
+        except (IOError, OSError) as e:
+            # Only slows down the next compile
+            io.Out.DebugRaw("Could not save result {}: {}".format(key, e))
+            return
+
+        self.Evict(key)
+
+    def Evict(self, keep=None):
+        """Remove the least recently used results until the directory is
+           no larger than maxBytes. The result for keep is never removed."""
+        keepName = None
+        if (keep is not None):
+            keepName = keep + RESULT_EXT
+        entries = []
+        total = 0
+        try:
+            for name in os.listdir(self.path):
+                if (name.endswith(RESULT_EXT)):
+                    try:
+                        st = os.stat(os.path.join(self.path, name))
+                    except OSError:
+                        # removed by another process
+                        continue
+                    entries.append((st.st_mtime, st.st_size, name))
+                    total += st.st_size
+        except OSError:
+            return
+
+        entries.sort()
+        for mtime, size, name in entries:
+            if (total <= self.maxBytes):
+                break
+            if (name == keepName):
+                continue
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+
+# Only to be used as a module
+if __name__ == '__main__':
+    io.Out.FatalRaw("This file is a module and can not be run as a script!")
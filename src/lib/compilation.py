@@ -0,0 +1,112 @@
+#!/usr/bin/env python2
+# * **************************************************************** **
+# File: compilation.py
+# Requires: Python 2.7+ (but not Python 3.0+)
+# Note: For history, changes and dates for this file, consult git.
+# Author: Brian Danilko, Likeable Software (brian@likeablesoftware.com)
+# Copyright 2015-2017 Microbric Pty Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (in the doc/licenses directory)
+# for more details.
+#
+# * **************************************************************** */
+
+
+""" Module keeping the state of one compile, so that compiles can run side by side. """
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+
+from . import util
+
+# Per thread stack of the active contexts
+active = threading.local()
+
+defaultContext = None
+defaultLock = threading.Lock()
+
+
+class CompilationContext(object):
+    """Everything that a compile changes as it runs: the output sink (what
+       io.Out refers to), the assembler token stream and fragment library,
+       the device tables and the log. Parse(), Optimise(), Compile() and
+       assemble_lines() take a context, and the code underneath them finds
+       it with Current(). A context is only used by one thread at a time."""
+
+    def __init__(self, out=None, log=None):
+        if (out is None):
+            # io uses this module, so import it when it's needed
+            from . import io
+            out = io.OutClass()
+
+        self.out = out
+        self.log = log if log is not None else util.SimpleLog(use=False)
+
+        # False keeps the whole compile in memory (the converted Ed. routines
+        # aren't read from or written to their file)
+        self.useFiles = True
+
+        # token_assembler
+        self.tokenStream = None
+        self.library = None
+
+        # hl_parser
+        self.devices = {}
+        self.locations = {}
+        self.modRegs = {}
+        self.modRegTable = None
+
+    def __enter__(self):
+        stack = getattr(active, "stack", None)
+        if (stack is None):
+            stack = active.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        active.stack.pop()
+        return False
+
+
+def GetDefault():
+    """The context used when none is active, as for the command line tools"""
+    global defaultContext
+
+    if (defaultContext is None):
+        with defaultLock:
+            if (defaultContext is None):
+                defaultContext = CompilationContext()
+
+    return defaultContext
+
+
+def Current():
+    """The context of the compile running in this thread"""
+    stack = getattr(active, "stack", None)
+    if (stack):
+        return stack[-1]
+    else:
+        return GetDefault()
+
+
+def Use(context):
+    """context to use in a with statement, the current one if it's None"""
+    if (context is None):
+        return Current()
+    else:
+        return context
+
+
+# Only to be used as a module
+if __name__ == '__main__':
+    print("This file is a module and can not be run as a script!")
@@ -29,26 +29,45 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-import re
-
 # from . import util
 from . import io
 from . import program
 from . token_bits import *
 from . import edpy_values
+from . import hl_parser
+from . hl_parser import Instruction
+from . import compilation
 
 # When accessing variables on the stack, must go past the return frame
 RETURN_FRAME_OFFSET = 3
 
 VERBOSE = True
 
-JUMP_OPT_RE = re.compile("bra (\:+\w+)\s*")
-JUMP_TARGET_RE = re.compile("(\:+\w+)\s*")
-STACK_WRITE_RE = re.compile("stwaw (\$?\w+)\s*")
-STACK_READ_RE = re.compile("straw (\$?\w+)\s*")
-STACK_CHANGE_RE = re.compile("st(inc|dec) \$(\d+)\s*")
-STACK_ACCESS_RE = re.compile("st(w|r)aw \$(\d+)\s*")
-RET_RE = re.compile("ret\s*")
+# Operands for CompileState.AddInstruction, as the (type, value) pairs
+# that hl_parser.lex_line would make from the text
+ACC = ("modreg", "_cpu:acc")
+CALC = ("var", "_CALC")
+
+
+def Const(value):
+    return ("const", value)
+
+
+def Var(name):
+    return ("var", name)
+
+
+def ModReg(name):
+    return ("modreg", name)
+
+
+def Arg(value):
+    return ("arg", str(value))
+
+
+# Stack ops whose constant operand the optimisations follow
+STACK_OPS = frozenset(("stinc", "stdec", "straw", "stwaw"))
+
 
 def CompileError_NO_RET(number, internalError=None, line=0):
     if (internalError):
@@ -90,8 +109,22 @@ class CompileState(object):
         self.controlLabels = []
 
     def AddStatement(self, statement):
+        # text lines only: comments, directives and blanks. Instructions use AddInstruction
         self.statements.append(statement)
 
+    def AddInstruction(self, op, *operands):
+        # operands are (type, value) pairs, so the assembler doesn't re-parse the text
+        self.statements.append(hl_parser.make_instruction(op, *operands))
+
+    def AddLabel(self, label):
+        self.statements.append(hl_parser.make_label(label))
+
+    def AddJump(self, op, label):
+        self.AddInstruction(op, ("label", label[1:]))
+
+    def AddStackOp(self, op, offset):
+        self.AddInstruction(op, Const(offset))
+
     def NextInternalLabel(self):
         label = ":_int_%04d" % (self.nextLabel)
         self.nextLabel += 1
@@ -141,13 +174,13 @@ class CompileState(object):
         # print("Start OptimiseJumps")
 
         for l in self.statements:
+            isInstruction = isinstance(l, Instruction)
             if (possibleOpt):
-                if (l.startswith('#')):
+                if ((not isInstruction) and l.startswith('#')):
                     optPassList.append(l)
                     optFailList.append(l)
-                elif (l.startswith(':')):
-                    m = JUMP_TARGET_RE.match(l)
-                    if (m.group(1) == target):
+                elif (isInstruction and (l.label is not None)):
+                    if (l.label == target):
                         # successfull optimisation
                         # print("OPT PASS - target", target, "found!")
                         newList.extend(optPassList)
@@ -170,12 +203,11 @@ class CompileState(object):
                     optFailList = []
                     possibleOpt = False
             else:
-                m = JUMP_OPT_RE.match(l)
-                if (m is not None):
+                if (isInstruction and (l.op == "bra") and (l.parts[1][0] == "label")):
                     possibleOpt = True
-                    # print("Found", m.group(1))
-                    target = m.group(1)
-                    optPassList.append("# OPTIMISED OUT (JUMP): " + l)
+                    target = l.parts[1][1]
+                    # print("Found", target)
+                    optPassList.append("# OPTIMISED OUT (JUMP): " + str(l))
                     optFailList.append(l)
                 else:
                     newList.append(l)
@@ -197,27 +229,26 @@ class CompileState(object):
         # print("Start OptimiseReadsFromStack")
 
         for l in self.statements:
+            isInstruction = isinstance(l, Instruction)
             if (possibleOpt):
-                if (l.startswith('#')):
+                if ((not isInstruction) and l.startswith('#')):
                     newList.append(l)
                     continue
                 else:
-                    m = STACK_READ_RE.match(l)
-                    if ((m is not None) and (m.group(1) == target)):
+                    if (isInstruction and (l.op == "straw") and (l.parts[1] == target)):
                         # successfull optimisation
                         # print("OPT PASS - target", target, "found!")
-                        newList.append("# OPTIMISED OUT (STACK_READ): " + l)
+                        newList.append("# OPTIMISED OUT (STACK_READ): " + str(l))
                         saved += 1
                     else:
                         newList.append(l)
 
                     possibleOpt = False
             else:
-                m = STACK_WRITE_RE.match(l)
-                if (m is not None):
+                if (isInstruction and (l.op == "stwaw")):
                     possibleOpt = True
-                    # print("Found", m.group(1))
-                    target = m.group(1)
+                    target = l.parts[1]
+                    # print("Found", target)
                 newList.append(l)
 
         if (saved):
@@ -238,18 +269,20 @@ class CompileState(object):
 
         # scan to collect data
         for l in self.statements:
-            if (l.startswith("::_fun_")):
-                name = l[7:]
+            if (not isinstance(l, Instruction)):
+                continue
+            label = l.label
+            if ((label is not None) and label.startswith(":_fun_")):
+                name = label[6:]
                 # print("Function found:", l)
-                function = l
+                function = name
                 stackOffset = 0
                 stackReads = set()
                 stackWrites = set()
                 if (self.funcReturnsValue[name]):
                     stackReads.add(3)
 
-            elif (l.startswith(":_end_")):
-                name = l[6:]
+            elif ((label is not None) and label.startswith("_end_")):
                 # print("Function end found:", l)
                 if (function is not None):
                     removeWrite = []
@@ -260,69 +293,60 @@ class CompileState(object):
                     fData[function] = removeWrite
                     function = None
 
-            else:
-                if (function is None):
+            elif ((function is not None) and (l.op in STACK_OPS)):
+                op = l.op
+                (type_, offset) = l.parts[1]
+                if (type_ != "const" or offset < 0):
                     continue
-                m = STACK_CHANGE_RE.match(l)
-                if (m is not None):
-                    if (m.group(1) == "inc"):
-                        stackOffset += int(m.group(2))
-                    else:
-                        stackOffset -= int(m.group(2))
+                if (op == "stinc"):
+                    stackOffset += offset
+                    # print("New stack offset:", stackOffset)
+                elif (op == "stdec"):
+                    stackOffset -= offset
                     # print("New stack offset:", stackOffset)
                 else:
-                    m = STACK_ACCESS_RE.match(l)
-                    if (m is not None):
-                        stackLocation = int(m.group(2)) - stackOffset
-                        if (stackLocation >= 0):
-                            if (m.group(1) == 'r'):
-                                stackReads.add(stackLocation)
-                                # print("Stack read:", stackLocation)
-                            else:
-                                stackWrites.add(stackLocation)
-                                # print("Stack write:", stackLocation)
+                    stackLocation = offset - stackOffset
+                    if (stackLocation >= 0):
+                        if (op == "straw"):
+                            stackReads.add(stackLocation)
+                            # print("Stack read:", stackLocation)
                         else:
-                            pass
-                            # print("Stack out of range:", stackLocation)
+                            stackWrites.add(stackLocation)
+                            # print("Stack write:", stackLocation)
+                    else:
+                        pass
+                        # print("Stack out of range:", stackLocation)
 
         # do the optimisations
         # print(fData)
 
         for l in self.statements:
-            if (l.startswith("::_fun_")):
-                function = l
+            if (not isinstance(l, Instruction)):
                 newList.append(l)
+                continue
+            label = l.label
+            if ((label is not None) and label.startswith(":_fun_")):
+                function = label[6:]
 
-            elif (l.startswith(":_end_")):
+            elif ((label is not None) and label.startswith("_end_")):
                 function = None
-                newList.append(l)
 
-            else:
-                if (function is None):
-                    newList.append(l)
-                    continue
-                m = STACK_CHANGE_RE.match(l)
-                if (m is not None):
-                    if (m.group(1) == "inc"):
-                        stackOffset += int(m.group(2))
-                    else:
-                        stackOffset -= int(m.group(2))
-                    newList.append(l)
-                else:
-                    if (stackOffset != 0):
-                        newList.append(l)
-                        continue
-                    m = STACK_ACCESS_RE.match(l)
-                    if (m is not None):
-                        stackLocation = int(m.group(2)) - stackOffset
-                        if (stackLocation >= 0):
-                            if (m.group(1) == 'w'):
-                                # print("Stack write:", stackLocation)
-                                if (stackLocation in fData[function]):
-                                    newList.append("# OPTIMISED OUT (STACK_WRITE): " + l)
-                                    saved += 1
-                                    continue
-                    newList.append(l)
+            elif ((function is not None) and (l.op in STACK_OPS)):
+                op = l.op
+                (type_, offset) = l.parts[1]
+                if (type_ == "const" and offset >= 0):
+                    if (op == "stinc"):
+                        stackOffset += offset
+                    elif (op == "stdec"):
+                        stackOffset -= offset
+                    elif ((op == "stwaw") and (stackOffset == 0)):
+                        # print("Stack write:", offset)
+                        if (offset in fData[function]):
+                            newList.append("# OPTIMISED OUT (STACK_WRITE): " + str(l))
+                            saved += 1
+                            continue
+
+            newList.append(l)
 
         if (saved):
             self.statements = newList
@@ -338,13 +362,16 @@ class CompileState(object):
         # print("Start OptimiseDoubleReturns")
 
         for l in self.statements:
-            if (l.startswith(":")):
+            if (not isinstance(l, Instruction)):
+                newList.append(l)
+                continue
+
+            if (l.label is not None):
                 lastWasReturn = False
 
-            m = RET_RE.match(l)
-            if (m != None):
+            elif (l.op == "ret"):
                 if (lastWasReturn):
-                    l = "# OPTIMISED OUT (DBL-RET): " + l
+                    l = "# OPTIMISED OUT (DBL-RET): " + str(l)
                     saved += 1
                     # print("OPT PASS - found double return")
                 else:
@@ -373,12 +400,13 @@ class CompileState(object):
         # print("Start OptimiseUselessStackOps")
 
         for l in self.statements:
+            isInstruction = isinstance(l, Instruction)
             if (possibleOpt):
-                if (l.startswith('#')):
+                if ((not isInstruction) and l.startswith('#')):
                     optPassList.append(l)
                     optFailList.append(l)
                     continue
-                elif (l.startswith(":")):
+                elif (isInstruction and (l.label is not None)):
                     # possible opt failed
                     newList.extend(optFailList)
                     newList.append(l)
@@ -387,11 +415,10 @@ class CompileState(object):
                     possibleOpt = False
 
                 else:
-                    m = STACK_WRITE_RE.match(l)
-                    if ((m is not None) and (m.group(1) == target)):
+                    if (isInstruction and (l.op == "stwaw") and (l.parts[1] == target)):
                         # successfull optimisation
                         # print("OPT PASS - target", target, "found!")
-                        optPassList.append("# OPTIMISED OUT (USELESS_STACK_OP): " + l)
+                        optPassList.append("# OPTIMISED OUT (USELESS_STACK_OP): " + str(l))
                         newList.extend(optPassList)
                         saved += 2
                     else:
@@ -402,13 +429,12 @@ class CompileState(object):
                     optFailList = []
                     possibleOpt = False
             else:
-                m = STACK_READ_RE.match(l)
-                if (m is not None):
+                if (isInstruction and (l.op == "straw")):
                     possibleOpt = True
-                    # print("Found", m.group(1))
-                    target = m.group(1)
+                    target = l.parts[1]
+                    # print("Found", target)
 
-                    optPassList.append("# OPTIMISED OUT (USELESS_STACK_OP): " + l)
+                    optPassList.append("# OPTIMISED OUT (USELESS_STACK_OP): " + str(l))
                     optFailList.append(l)
 
                 else:
@@ -575,7 +601,7 @@ def CheckSpecialUAdd(programIR, functionName, line, compileState):
         if (vInfo[tName][0] == 'T'):
             # assignment to a TUNE STRING -- must be from a StrConst or another tuneString
             if (line.operand.IsStrConst() and (len(line.operand.strConst) == 1)):
-                compileState.AddStatement("movb ${} %_cpu:acc".format(ord(line.operand.strConst[0])))
+                compileState.AddInstruction("movb", Const(ord(line.operand.strConst[0])), ACC)
                 StoreAccIntoByteVariable(line.target, functionName, compileState)
                 return True
 
@@ -606,17 +632,17 @@ def CompileUassign(programIR, functionName, line, compileState):
         (tType, tName, tOffset, info) = GetVariableInfo(functionName, line.target, compileState)
         if (tType == "G"):
             if (line.operand.IsIntConst()):
-                compileState.AddStatement("movw ${} @{}".format(line.operand.constant, tName))
+                compileState.AddInstruction("movw", Const(line.operand.constant), Var(tName))
                 return
             else:
                 if (line.operand.IsSimpleVar()):
                     (oType, oName, oOffset, info) = GetVariableInfo(functionName, line.operand, compileState)
                     if (oType == "G"):
-                        compileState.AddStatement("movw @{} @{}".format(oName, tName))
+                        compileState.AddInstruction("movw", Var(oName), Var(tName))
                         return
 
     if (line.operand.IsIntConst()):
-        compileState.AddStatement("movw ${} %_cpu:acc".format(line.operand.constant))
+        compileState.AddInstruction("movw", Const(line.operand.constant), ACC)
     elif (line.operand.IsStrConst()):
         # Should have been handled in the CheckSpecialUAdd() function
         CompileError_NO_RET(32, "StrConstant not allowed here")
@@ -628,25 +654,25 @@ def CompileUassign(programIR, functionName, line, compileState):
         # Nothing to do for UAdd
         pass
     elif (line.operation == "USub"):
-        compileState.AddStatement("mulw $-1")
+        compileState.AddInstruction("mulw", Const(-1))
     elif (line.operation == "Not"):
         wasZeroLabel = compileState.NextInternalLabel()
         endLabel = compileState.NextInternalLabel()
-        compileState.AddStatement("brz {}".format(wasZeroLabel))
-        compileState.AddStatement("movw $0 %_cpu:acc")  # set to 0
-        compileState.AddStatement("bra {}".format(endLabel))
-        compileState.AddStatement("{}".format(wasZeroLabel))
-        compileState.AddStatement("movw $1 %_cpu:acc")  # set to 1
-        compileState.AddStatement("{}".format(endLabel))
+        compileState.AddJump("brz", wasZeroLabel)
+        compileState.AddInstruction("movw", Const(0), ACC)  # set to 0
+        compileState.AddJump("bra", endLabel)
+        compileState.AddLabel(wasZeroLabel)
+        compileState.AddInstruction("movw", Const(1), ACC)  # set to 1
+        compileState.AddLabel(endLabel)
     else:  # Invert
-        compileState.AddStatement("notw %_cpu:acc")
+        compileState.AddInstruction("notw", ACC)
 
     StoreAccIntoWordVariable(line.target, functionName, compileState)
 
 
 def SetTempoAtStart(tempo, compileState):
     compileState.AddStatement("# Set intial tempo")
-    compileState.AddStatement("movw ${} {}".format(tempo, "%68"))
+    compileState.AddInstruction("movw", Const(tempo), ModReg("68"))
     return
 
 
@@ -660,37 +686,37 @@ def CompileBassign(programIR, functionName, line, compileState):
 
     if (line.right.IsIntConst()):
         if (line.left.IsIntConst()):
-            compileState.AddStatement("movw ${} %_cpu:acc".format(line.left.constant))
+            compileState.AddInstruction("movw", Const(line.left.constant), ACC)
         else:
             LoadWordVariableIntoAcc(line.left, functionName, compileState)
 
         if (line.operation == "Add"):
-            compileState.AddStatement("addw ${}".format(line.right.constant))
+            compileState.AddInstruction("addw", Const(line.right.constant))
         elif (line.operation == "Sub"):
-            compileState.AddStatement("subw ${}".format(line.right.constant))
+            compileState.AddInstruction("subw", Const(line.right.constant))
         elif (line.operation == "Mult"):
-            compileState.AddStatement("mulw ${}".format(line.right.constant))
+            compileState.AddInstruction("mulw", Const(line.right.constant))
         elif (line.operation == "Div"):
-            compileState.AddStatement("divw ${}".format(line.right.constant))
+            compileState.AddInstruction("divw", Const(line.right.constant))
         elif (line.operation == "Mod"):
-            compileState.AddStatement("modw ${}".format(line.right.constant))
+            compileState.AddInstruction("modw", Const(line.right.constant))
         elif (line.operation == "Pow"):
             compileState.AddStatement("# IMPLEMENT POWER")
         elif (line.operation == "LShift"):
-            compileState.AddStatement("shlw ${}".format(line.right.constant))
+            compileState.AddInstruction("shlw", Const(line.right.constant))
         elif (line.operation == "RShift"):
-            compileState.AddStatement("shrw ${}".format(line.right.constant))
+            compileState.AddInstruction("shrw", Const(line.right.constant))
         elif (line.operation == "BitOr"):
-            compileState.AddStatement("orw ${}".format(line.right.constant))
+            compileState.AddInstruction("orw", Const(line.right.constant))
         elif (line.operation == "BitXor"):
-            compileState.AddStatement("xorw ${}".format(line.right.constant))
+            compileState.AddInstruction("xorw", Const(line.right.constant))
         elif (line.operation == "BitAnd"):
-            compileState.AddStatement("andw ${}".format(line.right.constant))
+            compileState.AddInstruction("andw", Const(line.right.constant))
         elif (line.operation == "FloorDiv"):
-            compileState.AddStatement("divw ${}".format(line.right.constant))
+            compileState.AddInstruction("divw", Const(line.right.constant))
 
         elif (line.operation in ("Lt", "LtE", "Gt", "GtE", "Eq", "NotEq")):
-            compileState.AddStatement("cmpw ${}".format(line.right.constant))
+            compileState.AddInstruction("cmpw", Const(line.right.constant))
             FinishCompare(line.operation, compileState)
 
         else:
@@ -699,47 +725,47 @@ def CompileBassign(programIR, functionName, line, compileState):
     else:
 
         LoadWordVariableIntoAcc(line.right, functionName, compileState)
-        compileState.AddStatement("movw %_cpu:acc @_CALC")
+        compileState.AddInstruction("movw", ACC, CALC)
 
         if (line.left.IsIntConst()):
-            compileState.AddStatement("movw ${} %_cpu:acc".format(line.left.constant))
+            compileState.AddInstruction("movw", Const(line.left.constant), ACC)
         else:
             LoadWordVariableIntoAcc(line.left, functionName, compileState)
 
         # now left is in ACC, right is in @_CALC
         if (line.operation in ("Lt", "LtE", "Gt", "GtE", "Eq", "NotEq")):
-            compileState.AddStatement("cmpw @_CALC")
+            compileState.AddInstruction("cmpw", CALC)
             FinishCompare(line.operation, compileState)
 
         else:
             # do operation in ACC
             if (line.operation == "Add"):
-                compileState.AddStatement("addw @_CALC")
+                compileState.AddInstruction("addw", CALC)
             elif (line.operation == "Sub"):
-                compileState.AddStatement("subw @_CALC")
+                compileState.AddInstruction("subw", CALC)
             elif (line.operation == "Mult"):
-                compileState.AddStatement("mulw @_CALC")
+                compileState.AddInstruction("mulw", CALC)
             elif (line.operation == "Div"):
-                compileState.AddStatement("divw @_CALC")
+                compileState.AddInstruction("divw", CALC)
             elif (line.operation == "Mod"):
-                compileState.AddStatement("modw @_CALC")
+                compileState.AddInstruction("modw", CALC)
             elif (line.operation == "Pow"):
                 compileState.AddStatement("# IMPLEMENT POWER")
             elif (line.operation == "LShift"):
-                compileState.AddStatement("shlw @_CALC")
+                compileState.AddInstruction("shlw", CALC)
             elif (line.operation == "RShift"):
-                compileState.AddStatement("shrw @_CALC")
+                compileState.AddInstruction("shrw", CALC)
             elif (line.operation == "BitOr"):
-                compileState.AddStatement("orw @_CALC")
+                compileState.AddInstruction("orw", CALC)
             elif (line.operation == "BitXor"):
-                compileState.AddStatement("xorw @_CALC")
+                compileState.AddInstruction("xorw", CALC)
             elif (line.operation == "BitAnd"):
-                compileState.AddStatement("andw @_CALC")
+                compileState.AddInstruction("andw", CALC)
             elif (line.operation == "FloorDiv"):
-                compileState.AddStatement("divw @_CALC")
+                compileState.AddInstruction("divw", CALC)
 
             elif (line.operation in ("Lt", "LtE", "Gt", "GtE", "Eq", "NotEq")):
-                compileState.AddStatement("cmpw @_CALC")
+                compileState.AddInstruction("cmpw", CALC)
                 FinishCompare(line.operation, compileState)
 
             else:
@@ -764,23 +790,23 @@ def FinishCompare(op, compileState):
     # other are same
 
     if (op == "Lt"):
-        compileState.AddStatement("brle {}".format(noLabel))
+        compileState.AddJump("brle", noLabel)
     elif (op == "LtE"):
-        compileState.AddStatement("brl {}".format(noLabel))
+        compileState.AddJump("brl", noLabel)
     elif (op == "Gt"):
-        compileState.AddStatement("brge {}".format(noLabel))
+        compileState.AddJump("brge", noLabel)
     elif (op == "GtE"):
-        compileState.AddStatement("brgr {}".format(noLabel))
+        compileState.AddJump("brgr", noLabel)
     elif (op == "Eq"):
-        compileState.AddStatement("brne {}".format(noLabel))
+        compileState.AddJump("brne", noLabel)
     elif (op == "NotEq"):
-        compileState.AddStatement("bre {}".format(noLabel))
+        compileState.AddJump("bre", noLabel)
 
-    compileState.AddStatement("movw $1 %_cpu:acc")
-    compileState.AddStatement("bra {}".format(endLabel))
-    compileState.AddStatement("{}".format(noLabel))
-    compileState.AddStatement("movw $0 %_cpu:acc")
-    compileState.AddStatement("{}".format(endLabel))
+    compileState.AddInstruction("movw", Const(1), ACC)
+    compileState.AddJump("bra", endLabel)
+    compileState.AddLabel(noLabel)
+    compileState.AddInstruction("movw", Const(0), ACC)
+    compileState.AddLabel(endLabel)
 
 
 # INLINE FUNCTIONS!
@@ -828,7 +854,7 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
                 compileState.AddStatement("# ORD:" + str(line))
             vFrom = line.args[0]
             LoadByteVariableIntoAcc(vFrom, caller, compileState)
-            compileState.AddStatement("conv")
+            compileState.AddInstruction("conv")
             StoreAccIntoWordVariable(vTo, caller, compileState)
         return True
 
@@ -842,10 +868,10 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
             vFrom = line.args[0]
 
             if (vFrom.IsIntConst()):
-                compileState.AddStatement("movb ${} %_cpu:acc".format(vFrom.constant))
+                compileState.AddInstruction("movb", Const(vFrom.constant), ACC)
             else:
                 LoadWordVariableIntoAcc(vFrom, caller, compileState)
-                compileState.AddStatement("convl")
+                compileState.AddInstruction("convl")
             StoreAccIntoByteVariable(vTo, caller, compileState)
         return True
 
@@ -859,7 +885,7 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
             vFrom = line.args[0]
 
             LoadWordVariableIntoAcc(vFrom, caller, compileState)
-            compileState.AddStatement("shrw $8")
+            compileState.AddInstruction("shrw", Const(8))
             StoreAccIntoWordVariable(vTo, caller, compileState)
         return True
 
@@ -870,7 +896,7 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
         vTo = line.target
         modRegHex = CreateModRegHex(line.args[0], line.args[1])
         if (vTo is not None):
-            compileState.AddStatement("movw %{} %_cpu:acc".format(modRegHex))
+            compileState.AddInstruction("movw", ModReg(modRegHex), ACC)
             StoreAccIntoWordVariable(vTo, caller, compileState)
         return True
 
@@ -881,8 +907,8 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
         vTo = line.target
         modRegHex = CreateModRegHex(line.args[0], line.args[1])
         if (vTo is not None):
-            compileState.AddStatement("movb %{} %_cpu:acc".format(modRegHex))
-            compileState.AddStatement("conv")
+            compileState.AddInstruction("movb", ModReg(modRegHex), ACC)
+            compileState.AddInstruction("conv")
             StoreAccIntoWordVariable(vTo, caller, compileState)
         return True
 
@@ -897,7 +923,7 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
         if (bit < 0 or bit > 7):
             CompileError_NO_RET(9, "Bit constant is out of range")
 
-        compileState.AddStatement("bitclr {} %{}".format(bit, modRegHex))
+        compileState.AddInstruction("bitclr", Arg(bit), ModReg(modRegHex))
         return True
 
     elif (callee == "Ed.SetModuleRegisterBit"):
@@ -911,7 +937,7 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
         if (bit < 0 or bit > 7):
             CompileError_NO_RET(11, "Bit constant is out of range")
 
-        compileState.AddStatement("bitset {} %{}".format(bit, modRegHex))
+        compileState.AddInstruction("bitset", Arg(bit), ModReg(modRegHex))
         return True
 
     elif (callee == "Ed.WriteModuleRegister16Bit"):
@@ -922,10 +948,10 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
         value = line.args[2]
 
         if (value.IsIntConst()):
-            compileState.AddStatement("movw ${} %{}".format(value.constant, modRegHex))
+            compileState.AddInstruction("movw", Const(value.constant), ModReg(modRegHex))
         else:
             LoadWordVariableIntoAcc(value, caller, compileState)
-            compileState.AddStatement("movw %_cpu:acc %{}".format(modRegHex))
+            compileState.AddInstruction("movw", ACC, ModReg(modRegHex))
         return True
 
     elif (callee == "Ed.WriteModuleRegister8Bit"):
@@ -937,11 +963,11 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
         value = line.args[2]
 
         if (value.IsIntConst()):
-            compileState.AddStatement("movb ${} %{}".format(value.constant, modRegHex))
+            compileState.AddInstruction("movb", Const(value.constant), ModReg(modRegHex))
         else:
             LoadWordVariableIntoAcc(value, caller, compileState)
-            compileState.AddStatement("conv")
-            compileState.AddStatement("movb %_cpu:acc %{}".format(modRegHex))
+            compileState.AddInstruction("conv")
+            compileState.AddInstruction("movb", ACC, ModReg(modRegHex))
         return True
 
     elif (callee == "Ed.ObjectAddr"):
@@ -953,7 +979,7 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
             vFrom = line.args[0]
 
             LoadWordVariableIntoAcc(vFrom, caller, compileState)
-            compileState.AddStatement("andw $255")
+            compileState.AddInstruction("andw", Const(255))
             StoreAccIntoWordVariable(vTo, caller, compileState)
         return True
 
@@ -976,8 +1002,8 @@ def HandleSpecialCall(programIR, caller, callee, line, compileState):
 
 
 def AddInlineFunction(callee, compileState, line):
-    leftMotorControl = "%81"
-    rightMotorControl = "%31"
+    leftMotorControl = ModReg("81")
+    rightMotorControl = ModReg("31")
     motorStop = edpy_values.constants["Ed.MOTOR_STOP_CODE"]
     motorForward = edpy_values.constants["Ed.MOTOR_FOR_CODE"]
     motorBackward = edpy_values.constants["Ed.MOTOR_BACK_CODE"]
@@ -1018,8 +1044,8 @@ def AddInlineFunction(callee, compileState, line):
             leftCtrl = motorBackward | speed
             rightCtrl = motorForward | speed
 
-        compileState.AddStatement("movb ${} {}".format(leftCtrl, leftMotorControl))
-        compileState.AddStatement("movb ${} {}".format(rightCtrl, rightMotorControl))
+        compileState.AddInstruction("movb", Const(leftCtrl), leftMotorControl)
+        compileState.AddInstruction("movb", Const(rightCtrl), rightMotorControl)
 
         return True
 
@@ -1030,7 +1056,7 @@ def AddInlineFunction(callee, compileState, line):
         elif (direction == edpy_values.constants["Ed.BACKWARD"]):
             leftCtrl = motorBackward | speed
 
-        compileState.AddStatement("movb ${} {}".format(leftCtrl, leftMotorControl))
+        compileState.AddInstruction("movb", Const(leftCtrl), leftMotorControl)
         return True
 
     elif (callee == "Ed.DriveRightMotor_INLINE_UNLIMITED"):
@@ -1040,17 +1066,17 @@ def AddInlineFunction(callee, compileState, line):
         elif (direction == edpy_values.constants["Ed.BACKWARD"]):
             rightCtrl = motorBackward | speed
 
-        compileState.AddStatement("movb ${} {}".format(rightCtrl, rightMotorControl))
+        compileState.AddInstruction("movb", Const(rightCtrl), rightMotorControl)
         return True
 
     return False
 
 
 def AddSimpleDriveInlineFunction(callee, compileState, line):
-    leftMotorControl = "%81"
-    leftMotorDistance = "%82"
-    rightMotorControl = "%31"
-    rightMotorDistance = "%32"
+    leftMotorControl = ModReg("81")
+    leftMotorDistance = ModReg("82")
+    rightMotorControl = ModReg("31")
+    rightMotorDistance = ModReg("32")
     motorStop = 0xc0
     motorForward = 0x81
     motorBackward = 0x41
@@ -1060,48 +1086,48 @@ def AddSimpleDriveInlineFunction(callee, compileState, line):
 
     if (callee == "Ed.SimpleDriveStop"):
         compileState.AddStatement("# Inline version of {} on line:{}".format(callee, line))
-        compileState.AddStatement("movb ${} {}".format(motorStop, leftMotorControl))
-        compileState.AddStatement("movb ${} {}".format(motorStop, rightMotorControl))
+        compileState.AddInstruction("movb", Const(motorStop), leftMotorControl)
+        compileState.AddInstruction("movb", Const(motorStop), rightMotorControl)
         # M<ight not have to do the clearing of the distance depending on how the
         # firmware handles non-zero distances when not doing a distance limited drive.
-        compileState.AddStatement("movw $0 {}".format(leftMotorDistance))
-        compileState.AddStatement("movw $0 {}".format(rightMotorDistance))
+        compileState.AddInstruction("movw", Const(0), leftMotorDistance)
+        compileState.AddInstruction("movw", Const(0), rightMotorDistance)
         return True
 
     elif (callee == "Ed.SimpleDriveForward"):
         compileState.AddStatement("# Inline version of {} on line:{}".format(callee, line))
-        compileState.AddStatement("movb ${} {}".format(motorForward, leftMotorControl))
-        compileState.AddStatement("movb ${} {}".format(motorForward, rightMotorControl))
+        compileState.AddInstruction("movb", Const(motorForward), leftMotorControl)
+        compileState.AddInstruction("movb", Const(motorForward), rightMotorControl)
         return True
 
     elif (callee == "Ed.SimpleDriveForwardRight"):
         compileState.AddStatement("# Inline version of {} on line:{}".format(callee, line))
-        compileState.AddStatement("movb ${} {}".format(motorForward, leftMotorControl))
-        compileState.AddStatement("movb ${} {}".format(motorStop, rightMotorControl))
+        compileState.AddInstruction("movb", Const(motorForward), leftMotorControl)
+        compileState.AddInstruction("movb", Const(motorStop), rightMotorControl)
         return True
 
     elif (callee == "Ed.SimpleDriveForwardLeft"):
         compileState.AddStatement("# Inline version of {} on line:{}".format(callee, line))
-        compileState.AddStatement("movb ${} {}".format(motorStop, leftMotorControl))
-        compileState.AddStatement("movb ${} {}".format(motorForward, rightMotorControl))
+        compileState.AddInstruction("movb", Const(motorStop), leftMotorControl)
+        compileState.AddInstruction("movb", Const(motorForward), rightMotorControl)
         return True
 
     elif (callee == "Ed.SimpleDriveBackward"):
         compileState.AddStatement("# Inline version of {} on line:{}".format(callee, line))
-        compileState.AddStatement("movb ${} {}".format(motorBackward, leftMotorControl))
-        compileState.AddStatement("movb ${} {}".format(motorBackward, rightMotorControl))
+        compileState.AddInstruction("movb", Const(motorBackward), leftMotorControl)
+        compileState.AddInstruction("movb", Const(motorBackward), rightMotorControl)
         return True
 
     elif (callee == "Ed.SimpleDriveBackwardRight"):
         compileState.AddStatement("# Inline version of {} on line:{}".format(callee, line))
-        compileState.AddStatement("movb ${} {}".format(motorBackward, leftMotorControl))
-        compileState.AddStatement("movb ${} {}".format(motorStop, rightMotorControl))
+        compileState.AddInstruction("movb", Const(motorBackward), leftMotorControl)
+        compileState.AddInstruction("movb", Const(motorStop), rightMotorControl)
         return True
 
     elif (callee == "Ed.SimpleDriveBackwardLeft"):
         compileState.AddStatement("# Inline version of {} on line:{}".format(callee, line))
-        compileState.AddStatement("movb ${} {}".format(motorStop, leftMotorControl))
-        compileState.AddStatement("movb ${} {}".format(motorBackward, rightMotorControl))
+        compileState.AddInstruction("movb", Const(motorStop), leftMotorControl)
+        compileState.AddInstruction("movb", Const(motorBackward), rightMotorControl)
         return True
 
     return False
@@ -1124,68 +1150,68 @@ def LoadWordVariableIntoAcc(value, functionName, compileState, stackOffset=0):
     (vType, vName, vOffset, info) = GetVariableInfo(functionName, value, compileState)
     if (vType == "L"):
         # on the stack, get it from there
-        compileState.AddStatement("straw ${:d}".format(vOffset + stackOffset))
+        compileState.AddStackOp("straw", vOffset + stackOffset)
     elif (vType == "G"):
         # a simple global
-        compileState.AddStatement("movw @{} %_cpu:acc".format(vName))
+        compileState.AddInstruction("movw", Var(vName), ACC)
     elif (vType == "GC"):
         # a slice with constant index - add the offset to the value of the name
         # (the name contains the address of the start of the slice)
-        compileState.AddStatement("movw @{} %_cpu:acc".format(vName))
+        compileState.AddInstruction("movw", Var(vName), ACC)
         if (info != 0):
-            compileState.AddStatement("addw ${}".format(info))
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_16BIT))
-        compileState.AddStatement("movw %_index:16b1window %_cpu:acc")
+            compileState.AddInstruction("addw", Const(info))
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_16BIT), ModReg("_index:action"))
+        compileState.AddInstruction("movw", ModReg("_index:16b1window"), ACC)
     elif (vType == "GV"):
         # a slice with a variable index - first the variable index
         iType, iName, iOffset = info
         if (iType == "L"):
             # on the stack, get it from there
-            compileState.AddStatement("straw ${:d}".format(iOffset + stackOffset))
+            compileState.AddStackOp("straw", iOffset + stackOffset)
         else:  # 'G' only
-            compileState.AddStatement("movw @{} %_cpu:acc".format(iName))
+            compileState.AddInstruction("movw", Var(iName), ACC)
         # now the value of the INDEX is in the ACC
-        compileState.AddStatement("addw @{}".format(vName))
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
+        compileState.AddInstruction("addw", Var(vName))
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
         # trigger reading for cursor into window
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_16BIT))
-        compileState.AddStatement("movw %_index:16b1window %_cpu:acc")
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_16BIT), ModReg("_index:action"))
+        compileState.AddInstruction("movw", ModReg("_index:16b1window"), ACC)
     elif (vType == "LC"):
         # a slice with constant index - add the offset to the reference on the stack
         # (the name contains the address of the start of the slice)
-        compileState.AddStatement("straw ${:d}".format(vOffset + stackOffset))
+        compileState.AddStackOp("straw", vOffset + stackOffset)
         if (info != 0):
-            compileState.AddStatement("addw ${}".format(info))
+            compileState.AddInstruction("addw", Const(info))
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_16BIT))
-        compileState.AddStatement("movw %_index:16b1window %_cpu:acc")
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_16BIT), ModReg("_index:action"))
+        compileState.AddInstruction("movw", ModReg("_index:16b1window"), ACC)
     elif (vType == "LV"):
         # a slice reference on the stack with a variable index
         iType, iName, iOffset = info
         if (iType == "L"):
             # on the stack, get it from there
-            compileState.AddStatement("straw ${:d}".format(iOffset + stackOffset))
+            compileState.AddStackOp("straw", iOffset + stackOffset)
         else:  # 'G' only
-            compileState.AddStatement("movw @{} %_cpu:acc".format(iName))
+            compileState.AddInstruction("movw", Var(iName), ACC)
         # now the value of the INDEX is in the ACC - must store it
-        compileState.AddStatement("movw %_cpu:acc  @_CALC")
+        compileState.AddInstruction("movw", ACC, CALC)
 
         # now get the base address
-        compileState.AddStatement("straw ${:d}".format(vOffset + stackOffset))
+        compileState.AddStackOp("straw", vOffset + stackOffset)
 
         # compute the actual address
-        compileState.AddStatement("addw @_CALC")
+        compileState.AddInstruction("addw", CALC)
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
         # trigger reading for cursor into window
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_16BIT))
-        compileState.AddStatement("movw %_index:16b1window %_cpu:acc")
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_16BIT), ModReg("_index:action"))
+        compileState.AddInstruction("movw", ModReg("_index:16b1window"), ACC)
 
     elif (vType == "LO"):
         # object data refering to a local object
@@ -1204,35 +1230,35 @@ def LoadWordVariableIntoAcc(value, functionName, compileState, stackOffset=0):
 
         # self is on the stack, get it's value from there. That is the address of the object
         selfOffset = compileState.funVarLayout[functionName]["self"]
-        compileState.AddStatement("straw ${:d}".format(selfOffset + stackOffset))
+        compileState.AddStackOp("straw", selfOffset + stackOffset)
 
         # Add the object offset in to get the ADDRESS of the data
         if (vOffset > 0):
-            compileState.AddStatement("addw ${:d}".format(vOffset))
+            compileState.AddInstruction("addw", Const(vOffset))
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
         # trigger reading for cursor into window
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_16BIT))
-        compileState.AddStatement("movw %_index:16b1window %_cpu:acc")
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_16BIT), ModReg("_index:action"))
+        compileState.AddInstruction("movw", ModReg("_index:16b1window"), ACC)
 
     elif (vType == "GO"):
         # object data referring to a global object
         # print ("**", functionName, vType, vName, vOffset, info)
 
         # a simple global for the object
-        compileState.AddStatement("movw @{} %_cpu:acc".format(vName))
+        compileState.AddInstruction("movw", Var(vName), ACC)
 
         # Add the object offset in to get the ADDRESS of the data
         if (vOffset > 0):
-            compileState.AddStatement("addw ${:d}".format(vOffset))
+            compileState.AddInstruction("addw", Const(vOffset))
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
 
         # trigger reading for cursor into window
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_16BIT))
-        compileState.AddStatement("movw %_index:16b1window %_cpu:acc")
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_16BIT), ModReg("_index:action"))
+        compileState.AddInstruction("movw", ModReg("_index:16b1window"), ACC)
 
     else:
         CompileError_NO_RET(15, "Invalid word variable to load into ACC" + vType)
@@ -1242,83 +1268,83 @@ def StoreAccIntoWordVariable(variable, functionName, compileState, stackOffset=0
     (vType, vName, vOffset, info) = GetVariableInfo(functionName, variable, compileState)
     if (vType == "L"):
         # on the stack, write it to there
-        compileState.AddStatement("stwaw ${:d}".format(vOffset + stackOffset))
+        compileState.AddStackOp("stwaw", vOffset + stackOffset)
     elif (vType == "G"):
         # a simple global
-        compileState.AddStatement("movw %_cpu:acc @{}".format(vName))
+        compileState.AddInstruction("movw", ACC, Var(vName))
     elif (vType == "GC"):
         # store the acc in the window for the write
-        compileState.AddStatement("movw %_cpu:acc %_index:16b1window")
+        compileState.AddInstruction("movw", ACC, ModReg("_index:16b1window"))
 
         # a slice with constant index - add the offset to the value of the name
         # (the name contains the address of the start of the slice)
-        compileState.AddStatement("movw @{} %_cpu:acc".format(vName))
+        compileState.AddInstruction("movw", Var(vName), ACC)
         if (info != 0):
-            compileState.AddStatement("addw ${}".format(info))
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_16BIT))
+            compileState.AddInstruction("addw", Const(info))
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_16BIT), ModReg("_index:action"))
     elif (vType == "GV"):
         # store the acc in the window
-        compileState.AddStatement("movw %_cpu:acc %_index:16b1window")
+        compileState.AddInstruction("movw", ACC, ModReg("_index:16b1window"))
 
         # a slice with a variable index - first the variable index
         iType, iName, iOffset = info
         if (iType == "L"):
             # on the stack, get it from there
-            compileState.AddStatement("straw ${:d}".format(iOffset + stackOffset))
+            compileState.AddStackOp("straw", iOffset + stackOffset)
         else:  # 'G' only
-            compileState.AddStatement("movw @{} %_cpu:acc".format(iName))
+            compileState.AddInstruction("movw", Var(iName), ACC)
         # now the value of the INDEX is in the ACC
-        compileState.AddStatement("addw @{}".format(vName))
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
+        compileState.AddInstruction("addw", Var(vName))
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
         # trigger reading for cursor into window
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_16BIT))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_16BIT), ModReg("_index:action"))
     elif (vType == "LC"):
         # store the acc in the window
-        compileState.AddStatement("movw %_cpu:acc %_index:16b1window")
+        compileState.AddInstruction("movw", ACC, ModReg("_index:16b1window"))
 
         # a slice with constant index - add the offset to the reference on the stack
         # (the name contains the address of the start of the slice)
-        compileState.AddStatement("straw ${:d}".format(vOffset + stackOffset))
+        compileState.AddStackOp("straw", vOffset + stackOffset)
         if (info != 0):
-            compileState.AddStatement("addw ${}".format(info))
+            compileState.AddInstruction("addw", Const(info))
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_16BIT))
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_16BIT), ModReg("_index:action"))
     elif (vType == "LV"):
         # store the acc in the window
-        compileState.AddStatement("movw %_cpu:acc %_index:16b1window")
+        compileState.AddInstruction("movw", ACC, ModReg("_index:16b1window"))
 
         # a slice reference on the stack with a variable index
         iType, iName, iOffset = info
         if (iType == "L"):
             # on the stack, get it from there
-            compileState.AddStatement("straw ${:d}".format(iOffset + stackOffset))
+            compileState.AddStackOp("straw", iOffset + stackOffset)
         else:  # 'G' only
-            compileState.AddStatement("movw @{} %_cpu:acc".format(iName))
+            compileState.AddInstruction("movw", Var(iName), ACC)
         # now the value of the INDEX is in the ACC - must store it
-        compileState.AddStatement("movw %_cpu:acc  @_CALC")
+        compileState.AddInstruction("movw", ACC, CALC)
 
         # now get the base address
-        compileState.AddStatement("straw ${:d}".format(vOffset + stackOffset))
+        compileState.AddStackOp("straw", vOffset + stackOffset)
 
         # compute the actual address
-        compileState.AddStatement("addw @_CALC")
+        compileState.AddInstruction("addw", CALC)
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
         # trigger reading for cursor into window
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_16BIT))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_16BIT), ModReg("_index:action"))
 
     elif (vType == "LO"):
         # object data local to this object
         # print ("**", functionName, vType, vName, vOffset, info)
 
         # store the acc in the window
-        compileState.AddStatement("movw %_cpu:acc %_index:16b1window")
+        compileState.AddInstruction("movw", ACC, ModReg("_index:16b1window"))
 
         if (not vName.startswith("self.")):
             CompileError_NO_RET()
@@ -1333,37 +1359,37 @@ def StoreAccIntoWordVariable(variable, functionName, compileState, stackOffset=0
 
         # self is on the stack, get it's value from there. That is the address of the object
         selfOffset = compileState.funVarLayout[functionName]["self"]
-        compileState.AddStatement("straw ${:d}".format(selfOffset + stackOffset))
+        compileState.AddStackOp("straw", selfOffset + stackOffset)
 
         # Add the object offset in to get the ADDRESS of the data
         if (vOffset > 0):
-            compileState.AddStatement("addw ${:d}".format(vOffset))
+            compileState.AddInstruction("addw", Const(vOffset))
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
 
         # trigger writing window through cursor
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_16BIT))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_16BIT), ModReg("_index:action"))
 
     elif (vType == "GO"):
         # object data referring to a global object
         # print ("**", functionName, vType, vName, vOffset, info)
 
         # store the acc in the window
-        compileState.AddStatement("movw %_cpu:acc %_index:16b1window")
+        compileState.AddInstruction("movw", ACC, ModReg("_index:16b1window"))
 
         # a simple global for the object
-        compileState.AddStatement("movw @{} %_cpu:acc".format(vName))
+        compileState.AddInstruction("movw", Var(vName), ACC)
 
         # Add the object offset in to get the ADDRESS of the data
         if (vOffset > 0):
-            compileState.AddStatement("addw ${:d}".format(vOffset))
+            compileState.AddInstruction("addw", Const(vOffset))
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:16b1cursor")
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:16b1cursor"))
 
         # trigger writing window through cursor
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_16BIT))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_16BIT), ModReg("_index:action"))
 
     else:
         CompileError_NO_RET(16, "Invalid word variable to store ACC into:" + str(vType))
@@ -1372,67 +1398,67 @@ def StoreAccIntoWordVariable(variable, functionName, compileState, stackOffset=0
 def LoadByteVariableIntoAcc(value, functionName, compileState):
     if (value.IsStrConst()):
         # put it in the accumulator
-        compileState.AddStatement("movb ${} %_cpu:acc".format(ord(value.strConst[0])))
+        compileState.AddInstruction("movb", Const(ord(value.strConst[0])), ACC)
     else:  # must be a slice of a tune string - so will be a byte_count - either GC or GV
         (vType, vName, vOffset, info) = GetVariableInfo(functionName, value, compileState)
         if (vType == "GC"):
             # a slice with constant index - add the offset to the value of the name
             # (the name contains the address of the start of the slice)
-            compileState.AddStatement("movw @{} %_cpu:acc".format(vName))
+            compileState.AddInstruction("movw", Var(vName), ACC)
             if (info != 0):
-                compileState.AddStatement("addw ${}".format(info))
-            compileState.AddStatement("convl")
-            compileState.AddStatement("movb %_cpu:acc %_index:8b1cursor")
-            compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_8BIT))
-            compileState.AddStatement("movb %_index:8b1window %_cpu:acc")
+                compileState.AddInstruction("addw", Const(info))
+            compileState.AddInstruction("convl")
+            compileState.AddInstruction("movb", ACC, ModReg("_index:8b1cursor"))
+            compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_8BIT), ModReg("_index:action"))
+            compileState.AddInstruction("movb", ModReg("_index:8b1window"), ACC)
         elif (vType == "GV"):
             # a slice with a variable index - first the variable index
             iType, iName, iOffset = info
             if (iType == "L"):
                 # on the stack, get it from there
-                compileState.AddStatement("straw {:d}".format(iOffset))
+                compileState.AddInstruction("straw", Arg(iOffset))
             else:  # 'G' only
-                compileState.AddStatement("movw @{} %_cpu:acc".format(iName))
+                compileState.AddInstruction("movw", Var(iName), ACC)
             # now the value of the INDEX is in the ACC
-            compileState.AddStatement("addw @{}".format(vName))
-            compileState.AddStatement("convl")
-            compileState.AddStatement("movb %_cpu:acc %_index:8b1cursor")
-            compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_8BIT))
-            compileState.AddStatement("movb %_index:8b1window %_cpu:acc")
+            compileState.AddInstruction("addw", Var(vName))
+            compileState.AddInstruction("convl")
+            compileState.AddInstruction("movb", ACC, ModReg("_index:8b1cursor"))
+            compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_8BIT), ModReg("_index:action"))
+            compileState.AddInstruction("movb", ModReg("_index:8b1window"), ACC)
         elif (vType == "LC"):
             # a slice with constant index - add the offset to the reference on the stack
             # (the name contains the address of the start of the slice)
-            compileState.AddStatement("straw ${:d}".format(vOffset))
+            compileState.AddStackOp("straw", vOffset)
             if (info != 0):
-                compileState.AddStatement("addw ${}".format(info))
+                compileState.AddInstruction("addw", Const(info))
 
-            compileState.AddStatement("convl")
-            compileState.AddStatement("movb %_cpu:acc %_index:8b1cursor")
-            compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_8BIT))
-            compileState.AddStatement("movw %_index:8b1window %_cpu:acc")
+            compileState.AddInstruction("convl")
+            compileState.AddInstruction("movb", ACC, ModReg("_index:8b1cursor"))
+            compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_8BIT), ModReg("_index:action"))
+            compileState.AddInstruction("movw", ModReg("_index:8b1window"), ACC)
 
         elif (vType == "LV"):
             # a slice reference on the stack with a variable index
             iType, iName, iOffset = info
             if (iType == "L"):
                 # on the stack, get it from there
-                compileState.AddStatement("straw ${:d}".format(iOffset))
+                compileState.AddStackOp("straw", iOffset)
             else:  # 'G' only
-                compileState.AddStatement("movw @{} %_cpu:acc".format(iName))
+                compileState.AddInstruction("movw", Var(iName), ACC)
             # now the value of the INDEX is in the ACC - must store it
-            compileState.AddStatement("movw %_cpu:acc  @_CALC")
+            compileState.AddInstruction("movw", ACC, CALC)
 
             # now get the base address
-            compileState.AddStatement("straw ${:d}".format(vOffset))
+            compileState.AddStackOp("straw", vOffset)
 
             # compute the actual address
-            compileState.AddStatement("addw @_CALC")
+            compileState.AddInstruction("addw", CALC)
 
-            compileState.AddStatement("convl")
-            compileState.AddStatement("movb %_cpu:acc %_index:8b1cursor")
+            compileState.AddInstruction("convl")
+            compileState.AddInstruction("movb", ACC, ModReg("_index:8b1cursor"))
             # trigger reading for cursor into window
-            compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_READ_8BIT))
-            compileState.AddStatement("movw %_index:8b1window %_cpu:acc")
+            compileState.AddInstruction("bitset", Const(CONTROL_INDEX_READ_8BIT), ModReg("_index:action"))
+            compileState.AddInstruction("movw", ModReg("_index:8b1window"), ACC)
 
         else:
             CompileError_NO_RET(17, "Invalid byte variable to load into ACC" + vType)
@@ -1442,76 +1468,76 @@ def StoreAccIntoByteVariable(variable, functionName, compileState):
     (vType, vName, vOffset, info) = GetVariableInfo(functionName, variable, compileState)
     if (vType == "L"):
         # on the stack, write it to there
-        compileState.AddStatement("stwab ${:d}".format(vOffset))
+        compileState.AddStackOp("stwab", vOffset)
     elif (vType == "G"):
         # a simple global
-        compileState.AddStatement("movb %_cpu:acc @{}".format(vName))
+        compileState.AddInstruction("movb", ACC, Var(vName))
     elif (vType == "GC"):
         # store the acc in the window for the write
-        compileState.AddStatement("movb %_cpu:acc %_index:8b1window")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:8b1window"))
 
         # a slice with constant index - add the offset to the value of the name
         # (the name contains the address of the start of the slice)
-        compileState.AddStatement("movw @{} %_cpu:acc".format(vName))
+        compileState.AddInstruction("movw", Var(vName), ACC)
         if (info != 0):
-            compileState.AddStatement("addw ${}".format(info))
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:8b1cursor")
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_8BIT))
+            compileState.AddInstruction("addw", Const(info))
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:8b1cursor"))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_8BIT), ModReg("_index:action"))
     elif (vType == "GV"):
         # store the acc in the window
-        compileState.AddStatement("movb %_cpu:acc %_index:8b1window")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:8b1window"))
 
         # a slice with a variable index - first the variable index
         iType, iName, iOffset = info
         if (iType == "L"):
             # on the stack, get it from there
-            compileState.AddStatement("straw ${:d}".format(iOffset))
+            compileState.AddStackOp("straw", iOffset)
         else:  # 'G' only
-            compileState.AddStatement("movw @{} %_cpu:acc".format(iName))
+            compileState.AddInstruction("movw", Var(iName), ACC)
         # now the value of the INDEX is in the ACC
-        compileState.AddStatement("addw @{}".format(vName))
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:8b1cursor")
+        compileState.AddInstruction("addw", Var(vName))
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:8b1cursor"))
         # trigger reading for cursor into window
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_8BIT))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_8BIT), ModReg("_index:action"))
     elif (vType == "LC"):
         # store the acc in the window
-        compileState.AddStatement("movb %_cpu:acc %_index:8b1window")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:8b1window"))
 
         # a slice with constant index - add the offset to the reference on the stack
         # (the name contains the address of the start of the slice)
-        compileState.AddStatement("straw ${:d}".format(vOffset))
+        compileState.AddStackOp("straw", vOffset)
         if (info != 0):
-            compileState.AddStatement("addw ${}".format(info))
+            compileState.AddInstruction("addw", Const(info))
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:8b1cursor")
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_8BIT))
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:8b1cursor"))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_8BIT), ModReg("_index:action"))
     elif (vType == "LV"):
         # store the acc in the window
-        compileState.AddStatement("movb %_cpu:acc %_index:8b1window")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:8b1window"))
 
         # a slice reference on the stack with a variable index
         iType, iName, iOffset = info
         if (iType == "L"):
             # on the stack, get it from there
-            compileState.AddStatement("straw ${:d}".format(iOffset))
+            compileState.AddStackOp("straw", iOffset)
         else:  # 'G' only
-            compileState.AddStatement("movw @{} %_cpu:acc".format(iName))
+            compileState.AddInstruction("movw", Var(iName), ACC)
         # now the value of the INDEX is in the ACC - must store it
-        compileState.AddStatement("movw %_cpu:acc  @_CALC")
+        compileState.AddInstruction("movw", ACC, CALC)
 
         # now get the base address
-        compileState.AddStatement("straw ${:d}".format(vOffset))
+        compileState.AddStackOp("straw", vOffset)
 
         # compute the actual address
-        compileState.AddStatement("addw @_CALC")
+        compileState.AddInstruction("addw", CALC)
 
-        compileState.AddStatement("convl")
-        compileState.AddStatement("movb %_cpu:acc %_index:8b1cursor")
+        compileState.AddInstruction("convl")
+        compileState.AddInstruction("movb", ACC, ModReg("_index:8b1cursor"))
         # trigger reading for cursor into window
-        compileState.AddStatement("bitset ${} %_index:action".format(CONTROL_INDEX_WRITE_8BIT))
+        compileState.AddInstruction("bitset", Const(CONTROL_INDEX_WRITE_8BIT), ModReg("_index:action"))
 
     else:
         CompileError_NO_RET(18, "Invalid byte variable to store ACC into:" + str(vType))
@@ -1539,29 +1565,29 @@ def CompileCall(programIR, functionName, line, compileState):
         # print(index, vFrom, offset)
 
         if (vFrom.IsIntConst()):
-            compileState.AddStatement("movw ${} %_cpu:acc".format(vFrom.constant))
-            compileState.AddStatement("stwaw ${}".format(offset))
+            compileState.AddInstruction("movw", Const(vFrom.constant), ACC)
+            compileState.AddStackOp("stwaw", offset)
         elif (vFrom.IsStrConst()):
             # must be a single character
             if (len(vFrom.strConst) != 1):
                 CompileError_NO_RET(19, "String constant should have length of 1" + str(vFrom))
             else:
-                compileState.AddStatement("movw ${} %_cpu:acc".format(vFrom.constant))
-                compileState.AddStatement("stwaw ${}".format(offset))
+                compileState.AddInstruction("movw", Const(vFrom.constant), ACC)
+                compileState.AddStackOp("stwaw", offset)
         elif (vFrom.IsConstant()):
             CompileError_NO_RET(20, "Should not be a str/list constant here" + str(vFrom))
         else:
             # a variable of some
             LoadWordVariableIntoAcc(vFrom, functionName, compileState, calleeDepth)
-            compileState.AddStatement("stwaw ${}".format(offset))
+            compileState.AddStackOp("stwaw", offset)
         index += 1
 
     # call the function
-    compileState.AddStatement("suba {}".format(MakeFunctionLabel(callee)))
+    compileState.AddJump("suba", MakeFunctionLabel(callee))
 
     # Get the return value
     if ((line.target is not None) and compileState.funcReturnsValue[callee]):
-        compileState.AddStatement("straw ${}".format(0))
+        compileState.AddStackOp("straw", 0)
         StoreAccIntoWordVariable(line.target, functionName, compileState, calleeDepth)
 
     # remove the stack
@@ -1575,14 +1601,14 @@ def CompileReturn(programIR, functionName, line, compileState):
 
     if (not line.IsVoidReturn()):
         if (line.returnValue.IsIntConst()):
-            compileState.AddStatement("movw ${} %_cpu:acc".format(line.returnValue.constant))
+            compileState.AddInstruction("movw", Const(line.returnValue.constant), ACC)
         else:
             LoadWordVariableIntoAcc(line.returnValue, functionName, compileState)
         # move onto the stack to return to the caller
         # TODO what offset should be used
-        compileState.AddStatement("stwaw ${}".format(3))
+        compileState.AddStackOp("stwaw", 3)
 
-    compileState.AddStatement("ret")
+    compileState.AddInstruction("ret")
 
 
 def MakeControlLabel(num, op, type):
@@ -1595,21 +1621,21 @@ def CompileControlMarker(programIR, functionName, line, compileState):
         compileState.AddStatement("# CTRL_MARKER:" + str(line))
 
     if (line.name in  ("While", "For") and line.end == "end"):
-        compileState.AddStatement("bra {}".format(MakeControlLabel(line.num, line.name, "start")))
+        compileState.AddJump("bra", MakeControlLabel(line.num, line.name, "start"))
 
     if (line.end == "else"):
         # route code around the else
-        compileState.AddStatement("bra {}".format(MakeControlLabel(line.num, line.name, "end")))
+        compileState.AddJump("bra", MakeControlLabel(line.num, line.name, "end"))
 
     elif (line.end == "end"):
         elseLabel = MakeControlLabel(line.num, line.name, "else")
         if (elseLabel not in compileState.controlLabels):
             compileState.RecordControlLabel(elseLabel)
-            compileState.AddStatement(elseLabel)
+            compileState.AddLabel(elseLabel)
 
     newLabel = MakeControlLabel(line.num, line.name, line.end)
     compileState.RecordControlLabel(newLabel)
-    compileState.AddStatement(newLabel)
+    compileState.AddLabel(newLabel)
 
 
 def CompileForControl(programIR, functionName, line, compileState):
@@ -1622,37 +1648,37 @@ def CompileForControl(programIR, functionName, line, compileState):
         # know that the line.arrayValue is an indexed slice. And the index is a temp
         # Get the value of the temp
         if (vType == "GV"):
-            compileState.AddStatement("straw ${:d}".format(info[2]))  # value of the index
-            compileState.AddStatement("cmpw ${}".format(vOffset))      # vOffset is size for Globals
+            compileState.AddStackOp("straw", info[2])  # value of the index
+            compileState.AddInstruction("cmpw", Const(vOffset))      # vOffset is size for Globals
         else:  # must be "LV" - so size must be computed
-            compileState.AddStatement("straw ${:d}".format(vOffset))  # get the base
-            compileState.AddStatement("shrw $8")        # find the size of the slice
-            compileState.AddStatement("movw %_cpu:acc @_CALC")
-            compileState.AddStatement("straw ${:d}".format(info[2]))  # get the value of the index
-            compileState.AddStatement("cmpw @_CALC")
+            compileState.AddStackOp("straw", vOffset)  # get the base
+            compileState.AddInstruction("shrw", Const(8))        # find the size of the slice
+            compileState.AddInstruction("movw", ACC, CALC)
+            compileState.AddStackOp("straw", info[2])  # get the value of the index
+            compileState.AddInstruction("cmpw", CALC)
 
         # Check if RHS (max) is LessOrEqual to LHS (ACC, index), then goto end
         # Check if (current_index) >= (limit), if so then goto end
-        compileState.AddStatement("brle {}".format(MakeControlLabel(line.num, "For", "end")))
+        compileState.AddJump("brle", MakeControlLabel(line.num, "For", "end"))
 
     else:  # Constant limit - is our variable below the constant?
         # know that the current variable is a temp, limit may be anything
         # So: load limit into ACC, store in window, load variable into ACC, cmp them
 
         if (line.constantLimit.IsIntConst()):
-            compileState.AddStatement("movw ${} %_cpu:acc".format(line.constantLimit.constant))
+            compileState.AddInstruction("movw", Const(line.constantLimit.constant), ACC)
         else:
             LoadWordVariableIntoAcc(line.constantLimit, functionName, compileState)
 
         (vType, vName, vOffset, info) = GetVariableInfo(functionName, line.currentValue, compileState)
 
-        compileState.AddStatement("movw %_cpu:acc @_CALC")
-        compileState.AddStatement("straw ${:d}".format(vOffset))
-        compileState.AddStatement("cmpw @_CALC")
+        compileState.AddInstruction("movw", ACC, CALC)
+        compileState.AddStackOp("straw", vOffset)
+        compileState.AddInstruction("cmpw", CALC)
 
         # limit is in @_CALC, current value is in ACC. So
         # check if RHS (limit) is LessOrEqual to LHS (ACC, index), then goto end
-        compileState.AddStatement("brle {}".format(MakeControlLabel(line.num, "For", "end")))
+        compileState.AddJump("brle", MakeControlLabel(line.num, "For", "end"))
 
 
 def CompileLoopControl(programIR, functionName, line, compileState):
@@ -1661,10 +1687,10 @@ def CompileLoopControl(programIR, functionName, line, compileState):
 
     # see if line.test evaluates to 0
     if (line.test.IsIntConst()):
-        compileState.AddStatement("movw ${} %_cpu:acc".format(line.test.constant))
+        compileState.AddInstruction("movw", Const(line.test.constant), ACC)
     else:
         LoadWordVariableIntoAcc(line.test, functionName, compileState)
-    compileState.AddStatement("brz {}".format(MakeControlLabel(line.num, line.name, "else")))
+    compileState.AddJump("brz", MakeControlLabel(line.num, line.name, "else"))
 
 
 def CompileLoopModifier(programIR, functionName, line, compileState):
@@ -1674,9 +1700,9 @@ def CompileLoopModifier(programIR, functionName, line, compileState):
     if (line.name == "Pass"):
         pass  # nothing to do :)
     elif (line.name == "Break"):
-        compileState.AddStatement("bra {}".format(MakeControlLabel(line.num, line.name, "else")))
+        compileState.AddJump("bra", MakeControlLabel(line.num, line.name, "else"))
     elif (line.name == "Continue"):
-        compileState.AddStatement("bra {}".format(MakeControlLabel(line.num, line.name, "start")))
+        compileState.AddJump("bra", MakeControlLabel(line.num, line.name, "start"))
     else:
         CompileError_NO_RET(22, "Invalid name for loop modifier" + str(line))
 
@@ -1687,7 +1713,7 @@ def CompileBoolCheck(programIR, functionName, line, compileState):
 
     # value has a 0 or non-zero value. Load into acc
     if (line.value.IsIntConst()):
-        compileState.AddStatement("movw ${} %_cpu:acc".format(line.value.constant))
+        compileState.AddInstruction("movw", Const(line.value.constant), ACC)
     else:
         LoadWordVariableIntoAcc(line.value, functionName, compileState)
 
@@ -1705,23 +1731,23 @@ def CompileBoolCheck(programIR, functionName, line, compileState):
 
         if (line.op == "Or"):
             # FOR OR if ZERO, then we have to keep checking!
-            compileState.AddStatement("brz {}".format(continueProcessingLabel))
+            compileState.AddJump("brz", continueProcessingLabel)
 
             # The answer here is TRUE -- move that into the target
-            compileState.AddStatement("movw $1 %_cpu:acc")
+            compileState.AddInstruction("movw", Const(1), ACC)
             StoreAccIntoWordVariable(line.target, functionName, compileState)
         else:
             # FOR AND if NON-ZERO, then we have to keep checking!
-            compileState.AddStatement("brnz {}".format(continueProcessingLabel))
+            compileState.AddJump("brnz", continueProcessingLabel)
 
             # The answer here is FALSE -- move that into the target
-            compileState.AddStatement("movw $0 %_cpu:acc")
+            compileState.AddInstruction("movw", Const(0), ACC)
             StoreAccIntoWordVariable(line.target, functionName, compileState)
 
         # short curcuit the rest of the processing
-        compileState.AddStatement("bra {}".format(MakeControlLabel(line.num, line.op, "end")))
+        compileState.AddJump("bra", MakeControlLabel(line.num, line.op, "end"))
 
-        compileState.AddStatement("{}".format(continueProcessingLabel))
+        compileState.AddLabel(continueProcessingLabel)
 
 
 def CompileFunction(programIR, functionName, compileState):
@@ -1730,7 +1756,7 @@ def CompileFunction(programIR, functionName, compileState):
     compileState.AddStatement("")
     if (VERBOSE):
         compileState.AddStatement("# FUNCTION:" + functionName)
-    compileState.AddStatement(MakeFunctionLabel(functionName))
+    compileState.AddLabel(MakeFunctionLabel(functionName))
 
     # If __main__ then need to set the tempo
     if (functionName == "__main__"):
@@ -1773,11 +1799,11 @@ def CompileFunction(programIR, functionName, compileState):
           print("NOT HANDLED:", line)
 
     if (functionName == "__main__"):
-        compileState.AddStatement("stop")
+        compileState.AddInstruction("stop")
     else:
-        compileState.AddStatement("ret")
+        compileState.AddInstruction("ret")
 
-    compileState.AddStatement(MakeFunctionEndLabel(functionName))
+    compileState.AddLabel(MakeFunctionEndLabel(functionName))
 
     return 0
 
@@ -1797,14 +1823,14 @@ def MakeTempName(tempNumber):
 def SetupFunctionStack(compileState, functionName):
     stackSize = compileState.funStackSize[functionName]
     if (stackSize > 0):
-        compileState.AddStatement("stinc ${}".format(stackSize))
+        compileState.AddStackOp("stinc", stackSize)
     return stackSize
 
 
 def TakeDownFunctionStack(compileState, functionName):
     stackSize = compileState.funStackSize[functionName]
     if (stackSize > 0):
-        compileState.AddStatement("stdec ${}".format(stackSize))
+        compileState.AddStackOp("stdec", stackSize)
 
 
 def FindFirstAssignmentToGlobal(programIR, name, typeInfo):
@@ -2088,19 +2114,19 @@ def StartEventCall(compileState, module, bit, overrideMask=None, overrideValue=N
 
     compileState.AddStatement("BEGIN EVENT %{}:status, {:d}, {:d}".format(module, mask, value))
     if (not leaveBitSet):
-        compileState.AddStatement("bitclr ${:d} %{}:status".format(int(bit), module))
+        compileState.AddInstruction("bitclr", Const(int(bit)), ModReg("{}:status".format(module)))
 
 
 def FinishEventCall(compileState, label, stackElements):
     # note that nothing is returned from an event call
-    compileState.AddStatement("pushw @_CALC")
+    compileState.AddInstruction("pushw", CALC)
     if (stackElements > 0):
-        compileState.AddStatement("stinc ${:d}".format(stackElements))
-    compileState.AddStatement("suba " + label)
+        compileState.AddStackOp("stinc", stackElements)
+    compileState.AddJump("suba", label)
     if (stackElements > 0):
-        compileState.AddStatement("stdec ${:d}".format(stackElements))
-    compileState.AddStatement("popw @_CALC")
-    compileState.AddStatement("stop")
+        compileState.AddStackOp("stdec", stackElements)
+    compileState.AddInstruction("popw", CALC)
+    compileState.AddInstruction("stop")
     compileState.AddStatement("END EVENT")
 
 
@@ -2165,9 +2191,10 @@ def AddInEventHandlerWrappers(compileState):
         FinishEventCall(compileState, funLabel, stackElements)
 
 
-def CompileProgram(programIR, compileState, doOpts):
+def CompileProgram(programIR, compileState, doOpts, library):
     """Process the functions starting from main, building up
-       the compileState."""
+       the compileState. Internal functions in the library are
+       linked instead of compiled (and added to it if they aren't)."""
 
     bad = False
 
@@ -2200,11 +2227,23 @@ def CompileProgram(programIR, compileState, doOpts):
         if (fun in SPECIALLY_HANDLED_FUNCTIONS):
             continue
 
-        if (CompileFunction(programIR, fun, compileState) != 0):
+        if ((library is not None) and programIR.Function[fun].IsInternalFunction()):
+            key = library.Key(fun, programIR, doOpts)
+            if (library.Get(key) is not None):
+                compileState.AddStatement("")
+                compileState.AddStatement("LINK {} {}".format(fun, key))
+                continue
+
+            compileState.AddStatement("BEGIN OBJECT {} {}".format(fun, key))
+            if (CompileFunction(programIR, fun, compileState) != 0):
+                bad = True
+            compileState.AddStatement("END OBJECT")
+
+        elif (CompileFunction(programIR, fun, compileState) != 0):
             bad = True
 
 
-    compileState.AddStatement("stop")
+    compileState.AddInstruction("stop")
     compileState.AddStatement("END MAIN")
 
     AddInEventHandlerWrappers(compileState)
@@ -2220,39 +2259,42 @@ def CompileProgram(programIR, compileState, doOpts):
     return (bad is not False)
 
 
-def Compile(programIR, doOpts):
-    """Take a program.Program object and produce an assembler output file"""
+def Compile(programIR, doOpts, library=None, context=None):
+    """Take a program.Program object and produce an assembler output file.
+       library is an optional library.Library of the internal functions, context
+       the compilation.CompilationContext (the current one if None)."""
 
-    io.Out.Top(io.TS.CMP_START, "Starting compiler passes")
-    # programIR.Dump()
+    with compilation.Use(context):
+        io.Out.Top(io.TS.CMP_START, "Starting compiler passes")
+        # programIR.Dump()
 
-    rtc = 0
-    compileState = CompileState()
+        rtc = 0
+        compileState = CompileState()
 
-    try:
-        rtc = CompileProgram(programIR, compileState, doOpts)
+        try:
+            rtc = CompileProgram(programIR, compileState, doOpts, library)
 
-    except program.EdPyError:
-        rtc = 1
-        # compileState.Dump()
-        if (io.Out.IsReRaiseSet()):
-            raise
+        except program.EdPyError:
+            rtc = 1
+            # compileState.Dump()
+            if (io.Out.IsReRaiseSet()):
+                raise
 
-    except:
-        io.Out.Error(io.TS.CMP_INTERNAL_ERROR,
-                     "file::: Compiler internal error {0}", 702)
-        if (io.Out.IsReRaiseSet()):
-            raise
+        except:
+            io.Out.Error(io.TS.CMP_INTERNAL_ERROR,
+                         "file::: Compiler internal error {0}", 702)
+            if (io.Out.IsReRaiseSet()):
+                raise
 
-    if (io.Out.GetInfoDumpMask() & io.DUMP.COMPILER):
-        io.Out.DebugRaw("\nDump of internal representation after COMPILATION (rtc:{0}):".format(rtc))
-        compileState.Dump()
-        io.Out.DebugRaw("\n")
+        if (io.Out.GetInfoDumpMask() & io.DUMP.COMPILER):
+            io.Out.DebugRaw("\nDump of internal representation after COMPILATION (rtc:{0}):".format(rtc))
+            compileState.Dump()
+            io.Out.DebugRaw("\n")
 
-    if (rtc != 0):
-        io.Out.DebugRaw("WARNING - COMPILER finished with an ERROR!!!\n")
+        if (rtc != 0):
+            io.Out.DebugRaw("WARNING - COMPILER finished with an ERROR!!!\n")
 
-    return rtc, compileState.statements
+        return rtc, compileState.statements
 
 # Only to be used as a module
 if __name__ == '__main__':
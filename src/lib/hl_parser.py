@@ -27,9 +27,11 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
+import re
 import string
 import copy
 from . import io
+from . import compilation
 
 
 device_types = {  # 'not used':0,
@@ -53,9 +55,8 @@ reset_devices = {'_index': ('index', 12), '_devices': ('devices', 13),
 reset_locations = {'c': ('index', 12), 'd': ('devices', 13),
                    'e': ('timers', 14), 'f': ('cpu', 15)}
 
-devices = {}
-
-locations = {}
+# The devices and locations, and the mod/regs resolved since the devices
+# changed, are kept in the compilation.CompilationContext
 
 registers = {
     # not used in edison
@@ -113,12 +114,33 @@ registers = {
 
 
 def reset_devices_and_locations():
-    global devices
-    global locations
-    devices.clear()
-    locations.clear()
-    devices = copy.deepcopy(reset_devices)
-    locations = copy.deepcopy(reset_locations)
+    context = compilation.Current()
+    context.devices = copy.deepcopy(reset_devices)
+    context.locations = copy.deepcopy(reset_locations)
+    reset_mod_regs()
+
+
+def reset_mod_regs():
+    """The devices have changed so forget the resolved mod/regs"""
+    context = compilation.Current()
+    context.modRegs = {}
+    context.modRegTable = None
+
+
+def get_mod_reg_table():
+    """Flat table of 'name:register' to (modreg, size) for all of the devices
+       and locations. Devices come second as their names are checked first."""
+    context = compilation.Current()
+
+    if (context.modRegTable is None):
+        table = {}
+        for names in (context.locations, context.devices):
+            for name, (dtype, loc) in names.items():
+                for reg, (offset, size) in registers.get(dtype, {}).items():
+                    table[name + ':' + reg] = (offset + (loc << 4), size)
+        context.modRegTable = table
+
+    return context.modRegTable
 
 
 def AsmError_NO_RET(number, internalError=None, line=0):
@@ -131,6 +153,7 @@ def AsmError_NO_RET(number, internalError=None, line=0):
 
 def dump_reg_help():
     """Dump locations, type names and register names as a help to programmers"""
+    locations = compilation.Current().locations
     print("\nLocations:")
     print("  0-b : connectable module (use hex digit or name from DEVICE statement)")
     for i in 'cdef':
@@ -178,8 +201,8 @@ def dump_reg_help():
 
 
 def add_device(loc, dtype, name=None):
-    global devices
-    global locations
+    devices = compilation.Current().devices
+    locations = compilation.Current().locations
 
     if (dtype not in device_types):
         AsmError_NO_RET(200, "Unknown device type: " + dtype)
@@ -229,10 +252,12 @@ def add_device(loc, dtype, name=None):
     if (name):
         devices[name] = (dtype, loc)
 
+    reset_mod_regs()
     return True
 
 
 def get_location_type_and_size(location):
+    locations = compilation.Current().locations
     loc_hex = string.hexdigits[location]
     if (loc_hex in locations and locations[loc_hex][0] != 'motor_second'):
         dtype = locations[loc_hex][0]
@@ -242,6 +267,8 @@ def get_location_type_and_size(location):
 
 
 def dump_devices():
+    devices = compilation.Current().devices
+    locations = compilation.Current().locations
     print("\nDevice mappings:")
     for i in range(12):
         loc_hex = string.hexdigits[i]
@@ -255,6 +282,8 @@ def dump_devices():
 
 
 class word(object):
+    __slots__ = ("type_", "value_")
+
     def __init__(self, type, value):
         self.type_ = type
         self.value_ = value
@@ -316,6 +345,42 @@ def format_word_list(wlist):
     return output
 
 
+# Prefix used for each operand type when an instruction is written as text
+OPERAND_PREFIXES = {"const": "$", "label": ":", "var": "@", "modreg": "%", "arg": ""}
+
+
+class Instruction(object):
+    """An assembler line made by the compiler, kept as its (type, value)
+       parts. The op, or the label (without the first ':'), is also kept on
+       its own for the compiler optimisations, the other is None. The
+       assembler builds the words from the parts, skipping chop_line, and
+       the text is only made for the listing. Modreg parts are resolved when
+       the words are made, as the devices are only known at assembly time."""
+    __slots__ = ("op", "label", "parts")
+
+    def __init__(self, op, label, parts):
+        self.op = op
+        self.label = label
+        self.parts = parts
+
+    def get_words(self):
+        return make_words(self.parts)
+
+    def __str__(self):
+        text = [OPERAND_PREFIXES[t] + str(v) if t != "op" else v for (t, v) in self.parts]
+        return " ".join(text)
+
+
+def make_instruction(op, *operands):
+    """Make an Instruction from the op and (type, value) operands"""
+    return Instruction(op, None, (("op", op),) + operands)
+
+
+def make_label(label):
+    """Make an Instruction for a label line. The label includes the ':'"""
+    return Instruction(None, label[1:], (("label", label[1:]),))
+
+
 # local utility functions
 
 def parse_bases(snum, string=False):
@@ -339,18 +404,35 @@ def parse_bases(snum, string=False):
 
 
 def parse_mod_reg(smodreg):
-    # print("parse_mod_reg():", smodreg)
+    """Resolve a mod/reg. They are kept until the devices change, as
+       the same few are used by nearly every line."""
+    mod_regs = compilation.Current().modRegs
+    num = mod_regs.get(smodreg)
+    if (num is None):
+        num = resolve_mod_reg(smodreg)
+        mod_regs[smodreg] = num
+
+    return num
+
+
+def resolve_mod_reg(smodreg):
+    # print("resolve_mod_reg():", smodreg)
     # dump_devices()
     if ((len(smodreg) == 2) and
         (smodreg[0] in string.hexdigits) and
         (smodreg[1] in string.hexdigits)):
         num = int(smodreg, 16)
     else:
-        if (':' in smodreg):
+        found = get_mod_reg_table().get(smodreg.lower())
+        if (found is not None):
+            num = found[0]
+        elif (':' in smodreg):
             part = smodreg.lower().split(':', 2)
             if (len(part) != 2):
                 AsmError_NO_RET(212, "Invalid mod/reg syntax: " + smodreg)
                 return 0
+            devices = compilation.Current().devices
+            locations = compilation.Current().locations
             if (part[0] in devices):
                 dtype = devices[part[0]][0]
                 loc = devices[part[0]][1]
@@ -379,8 +461,20 @@ def parse_mod_reg(smodreg):
     return num
 
 
+# A component of a line without strings, anything up to a separator
+COMPONENT_RE = re.compile("[^ \t,]+")
+
+# The (type, value) parts of lines already lexed, see chop_line()
+LINE_CACHE_SIZE = 4096
+line_parts = {}
+
+
 def prechop_line(line):
     """Handle strings and comments"""
+    if ('"' not in line):
+        # no strings, so stop at a newline or comment and split on the separators
+        return COMPONENT_RE.findall(line.split('\n', 1)[0].split('#', 1)[0])
+
     in_string = ''
     in_escape = False
     components = []
@@ -424,7 +518,32 @@ def prechop_line(line):
 
 
 def chop_line(line):
-    """Filter out comments then create words from the line"""
+    """Filter out comments then create words from the line. The (type, value)
+       parts of a line are kept, as generated listings repeat lines a lot"""
+    parts = line_parts.get(line)
+    if (parts is None):
+        parts = lex_line(line)
+        if (len(line_parts) >= LINE_CACHE_SIZE):
+            line_parts.clear()
+        line_parts[line] = parts
+
+    return make_words(parts)
+
+
+def make_words(parts):
+    """Words from (type, value) parts. The modreg are resolved now as
+       the devices can change"""
+    words = []
+    for (type_, value) in parts:
+        if (type_ == "modreg"):
+            words.append(word(type_, parse_mod_reg(value)))
+        else:
+            words.append(word(type_, value))
+    return words
+
+
+def lex_line(line):
+    """Filter out comments then create (type, value) parts from the line"""
 
 #    segs_spaces = line.split()
 #    segs = []
@@ -447,18 +566,18 @@ def chop_line(line):
         # lines can start with a label or operator
         if (s.startswith(":")):
             # a jump label
-            words.append(word("label", s[1:]))
+            words.append(("label", s[1:]))
 
         elif (not words):
             # first one so must be the operator
-            words.append(word("op", s))
+            words.append(("op", s))
 
         elif ((s.startswith('"') and s.endswith('"')) or
               (s.startswith("'") and s.endswith("'"))):
             if (len(s) <= 2):
                 continue
             else:
-                words.append(word("string", s[1:-1]))
+                words.append(("string", s[1:-1]))
 
         elif (s.startswith("$")):
             # should be a constant
@@ -466,23 +585,22 @@ def chop_line(line):
                 num = ord(s[2])
             else:
                 num = parse_bases(s[1:])
-            words.append(word("const", num))
+            words.append(("const", num))
 
         elif (s.startswith("%")):
-            # a module/register
-            modreg = parse_mod_reg(s[1:])
-            words.append(word("modreg", modreg))
+            # a module/register, resolved in make_words()
+            words.append(("modreg", s[1:]))
 
         elif (s.startswith(":")):
             # a jump label
-            words.append(word("label", s[1:]))
+            words.append(("label", s[1:]))
 
         elif (s.startswith("@")):
             # a variable name - add another element to the word
-            words.append(word("var", s[1:]))
+            words.append(("var", s[1:]))
 
         else:
-            words.append(word("arg", s))
+            words.append(("arg", s))
 
     # print(words)
-    return words
+    return tuple(words)
@@ -31,6 +31,7 @@ import traceback
 import types
 
 from . import util
+from . import compilation
 
 # Translation string enumeration - returns a number
 TS = util.Enum("ELPY_SPECIAL_FAIL",
@@ -100,13 +101,15 @@ class JsonOutput(object):
     def SetWavFilename(self, wavFilename):
         self.wavFilename = wavFilename
 
-    def Convert(self):
-        structure = {
+    def GetStructure(self):
+        return {
             "error": self.error,
             "messages": self.messages,
             "wavFilename": self.wavFilename
         }
-        return json.JSONEncoder().encode(structure)
+
+    def Convert(self):
+        return json.JSONEncoder().encode(self.GetStructure())
 
 
 # ############ Output class ###############################################
@@ -152,6 +155,12 @@ class OutClass(object):
         else:
             self.FatalRaw("Invalid util.Enum LEVEL constant")
 
+    def GetSink(self):
+        return self.outputSink
+
+    def GetMaxLevel(self):
+        return self.maxOutputLevel
+
     def SetLangFileHandle(self, langFileHandle):
         self.langFileHandle = langFileHandle
 
@@ -182,6 +191,29 @@ class OutClass(object):
     def SetWavFilename(self, wavFilename):
         self.jsonOutput.SetWavFilename(wavFilename)
 
+    def GetJson(self):
+        """The output of the JSON sink, as a structure"""
+        return self.jsonOutput.GetStructure()
+
+    def Replay(self, error, messages):
+        """Output messages kept from an earlier compile. They were already
+           translated and formatted, as the JSON sink has them."""
+        for outText in messages:
+            if (len(self.outputString) > 0):
+                self.outputString += "{:s}|".format(outText)
+            else:
+                self.outputString = "|{:s}|".format(outText)
+
+            if (self.outputSink == SINK.CONSOLE or self.outputSink == SINK.BOTH):
+                print(outText)
+
+            if (self.outputSink == SINK.JSON or self.outputSink == SINK.BOTH):
+                self.jsonOutput.messages.append(outText)
+
+        if (error):
+            self.errorRaised = True
+            self.jsonOutput.ForceError(True)
+
     def Flush(self):
         if (self.outputSink == SINK.BOTH or self.outputSink == SINK.JSON):
             print(self.jsonOutput.Convert())
@@ -191,6 +223,9 @@ class OutClass(object):
            be used on translation errors!) to the stderr AND configured sync.
         """
         print("FATAL: " + rawText, file=sys.stderr)
+        # kept for the JSON output, so the reason isn't lost
+        self.errorRaised = True
+        self.jsonOutput.Out(LEVEL.ERROR, "FATAL: " + rawText)
         print("----------------\nStack Trace:")
         stack = traceback.format_stack()
         for l in stack[:-1]:
@@ -199,15 +234,21 @@ class OutClass(object):
 
     def DebugRaw(self, rawText, *args):
         """Output debug information without translation if the sink is CONSOLE.
+           rawText can be a function returning the text, so it's only built
+           when debug output is on.
         """
         if ((self.maxOutputLevel >= LEVEL.DEBUG) and
             (self.outputSink == SINK.CONSOLE or self.outputSink == SINK.BOTH)):
+            if (callable(rawText)):
+                rawText = rawText()
             if (not args):
                 print("**DebugRaw**:", rawText)
             else:
                 print("**DebugRaw**:", rawText, *args)
 
     def SetErrorRawContext(self, level, rawText):
+        """rawText can also be a function returning the text, which is only
+           called if the context is output"""
         if (level > 0 and level < 10):
             self.errorRawContextLevel = level
             self.errorRawContext[level - 1] = rawText
@@ -220,7 +261,10 @@ class OutClass(object):
             (self.outputSink == SINK.CONSOLE or self.outputSink == SINK.BOTH)):
 
             for level in range(self.errorRawContextLevel):
-                print("**ErrorRaw** - Context:", level, self.errorRawContext[level])
+                context = self.errorRawContext[level]
+                if (callable(context)):
+                    context = context()
+                print("**ErrorRaw** - Context:", level, context)
 
             if (not args):
                 print("**ErrorRaw**:", rawText)
@@ -344,5 +388,13 @@ class OutClass(object):
             print("**DebugDump** -- %s" % (data))
 
 
-# the singleton which everyone will use
-Out = OutClass()
+class OutProxy(object):
+    """Passes everything on to the OutClass of the compile running in this
+       thread (see compilation.CompilationContext)"""
+
+    def __getattr__(self, name):
+        return getattr(compilation.Current().out, name)
+
+
+# the object which everyone will use
+Out = OutProxy()
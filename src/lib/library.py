@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+# * **************************************************************** **
+# File: library.py
+# Requires: Python 2.7+ (but not Python 3.0+)
+# Note: For history, changes and dates for this file, consult git.
+# Author: Brian Danilko, Likeable Software (brian@likeablesoftware.com)
+# Copyright 2015-2017 Microbric Pty Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (in the doc/licenses directory)
+# for more details.
+#
+# * **************************************************************** */
+
+""" Module keeping the pre-assembled fragments of the internal Ed. functions. """
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import os
+import os.path
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from . import io
+from . import util
+from . import edpy_code
+from . import edpy_values
+from . import version
+
+# Change when the layout of a tokens.Fragment changes
+FRAGMENT_FORMAT = 1
+
+# The modules that make a fragment, from the converted Ed. code to the tokens
+FRAGMENT_MODULES = ("parser", "program", "optimiser", "compiler",
+                    "hl_parser", "token_assembler", "tokens", "token_bits")
+FRAGMENT_EXT = ".frag"
+
+fingerprint = None
+
+
+def Fingerprint():
+    """A hash of the internal Ed. code and values. Anything made from
+       them is out of date when this changes."""
+    global fingerprint
+
+    if (fingerprint is None):
+        h = hashlib.sha1()
+        h.update(edpy_code.CODE.encode("utf-8"))
+        for values in (edpy_values.signatures, edpy_values.constants,
+                       edpy_values.variables, edpy_values.notAvailableFunctions):
+            h.update(repr(sorted(values.items())).encode("utf-8"))
+        h.update(repr((edpy_values.versionStatement,
+                       edpy_values.moduleStatements)).encode("utf-8"))
+        fingerprint = h.hexdigest()
+
+    return fingerprint
+
+
+class Library(object):
+    """The fragments (tokens.Fragment) of the internal Ed. functions,
+       kept in a directory. A function is compiled and assembled normally
+       the first time it is used with a set of Ed. variable values, then
+       its fragment is linked into later programs."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fragments = {}
+
+    def Key(self, functionName, programIR, doOpts):
+        """The code of an internal function depends on the Ed. code and
+           values, the Ed. variables (which pick the Drive variants, etc.),
+           whether the compiler optimisations are on and the compiler itself,
+           so a library kept over an upgrade isn't linked"""
+        h = hashlib.sha1()
+        h.update(Fingerprint().encode("utf-8"))
+        h.update(version.SourceHash(*FRAGMENT_MODULES).encode("utf-8"))
+        h.update(repr((FRAGMENT_FORMAT, functionName, sorted(programIR.EdVariables.items()),
+                       bool(doOpts))).encode("utf-8"))
+        return h.hexdigest()
+
+    def GetFragmentPath(self, key):
+        return os.path.join(self.path, key + FRAGMENT_EXT)
+
+    def Get(self, key):
+        """Return the fragment for key, or None if it hasn't been built"""
+        if (key not in self.fragments):
+            try:
+                fh = open(self.GetFragmentPath(key), "rb")
+                try:
+                    self.fragments[key] = pickle.load(fh)
+                finally:
+                    fh.close()
+            except Exception:
+                # not built yet (or unreadable) - it will be assembled again
+                return None
+
+        return self.fragments[key]
+
+    def Add(self, fragment):
+        """Keep the fragment and write it to the directory. The write is
+           to a temporary file and then renamed, so other processes never
+           see a partial fragment."""
+        self.fragments[fragment.key] = fragment
+
+        try:
+            if (not os.path.isdir(self.path)):
+                os.makedirs(self.path)
+
+            fd, tmpPath = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+            fh = os.fdopen(fd, "wb")
+            try:
+                pickle.dump(fragment, fh, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fh.close()
+            util.SetNewFileMode(tmpPath)
+            os.rename(tmpPath, self.GetFragmentPath(fragment.key))
+
+        except (IOError, OSError) as e:
+            # Only slows down the next compile
+            io.Out.DebugRaw("Could not save fragment {}: {}".format(fragment.name, e))
+
+
+# Only to be used as a module
+if __name__ == '__main__':
+    io.Out.FatalRaw("This file is a module and can not be run as a script!")
@@ -28,6 +28,7 @@ from __future__ import absolute_import
 from . import io
 from . import program
 from . import edpy_values
+from . import compilation
 
 # ############ utility functions ########################################
 
@@ -2472,75 +2473,76 @@ def CheckEdAndObjectVariables(programIR):
 # DONE 11. Partition the variable use in each function -- args, temps, locals, globals. Args, temps
 #     and locals will be on the stack. Store this info in the ProgramIR
 
-def Optimise(programIR):
+def Optimise(programIR, context=None):
     """Take a program.Program object and modify it by running it through the optimiser
-       passes."""
+       passes. context is the compilation.CompilationContext (the current one if None)."""
 
-    io.Out.Top(io.TS.OPT_START, "Starting optimisation passes")
-    rtc = 0
+    with compilation.Use(context):
+        io.Out.Top(io.TS.OPT_START, "Starting optimisation passes")
+        rtc = 0
 
-    try:
-        programIR = EdPyConstantReplacement(programIR)
-        #programIR.Dump()
-        changed = True
+        try:
+            programIR = EdPyConstantReplacement(programIR)
+            #programIR.Dump()
+            changed = True
 
-        while changed:
-            changed = False
+            while changed:
+                changed = False
 
-            programIR, changes = ConstantRemoval(programIR)
-            changed = changed or changes
+                programIR, changes = ConstantRemoval(programIR)
+                changed = changed or changes
 
-            programIR, changes = SimpleVarRemoval(programIR)
-            changed = changed or changes
+                programIR, changes = SimpleVarRemoval(programIR)
+                changed = changed or changes
 
-        programIR, changes = RemoveUselessMarkers(programIR)
+            programIR, changes = RemoveUselessMarkers(programIR)
 
-        programIR, changes = SimpleCallCollapse(programIR)
+            programIR, changes = SimpleCallCollapse(programIR)
 
-        # Fixup calls to Ed.List, Ed.TuneString, creating objects and self calls inside classes
-        # This stage uses the edpy_values.signatures. After this stage it's not used again.
-        programIR = FixUpCalls(programIR)
+            # Fixup calls to Ed.List, Ed.TuneString, creating objects and self calls inside classes
+            # This stage uses the edpy_values.signatures. After this stage it's not used again.
+            programIR = FixUpCalls(programIR)
 
-        # Verify that Ed.variables are only allowed ones, and that exactly one
-        # value is written for each variable
-        # Then when Ed.EdisonDistance units are know, rewrite ALL drive functions (other
-        # then possible inline ones -- where all args are constant and they match a
-        # particular pattern) to have the correct suffixes (_CM, _INCH, _TIME).
-        # These do not have to be in edpy_values.signatures as FixupCalls is the only user of it.
-        programIR = VerifyEdisonVariables(programIR)
+            # Verify that Ed.variables are only allowed ones, and that exactly one
+            # value is written for each variable
+            # Then when Ed.EdisonDistance units are know, rewrite ALL drive functions (other
+            # then possible inline ones -- where all args are constant and they match a
+            # particular pattern) to have the correct suffixes (_CM, _INCH, _TIME).
+            # These do not have to be in edpy_values.signatures as FixupCalls is the only user of it.
+            programIR = VerifyEdisonVariables(programIR)
 
-        TypeVariables(programIR)
+            TypeVariables(programIR)
 
-        VerifyClassData(programIR)
+            VerifyClassData(programIR)
 
-        VerifyConstantRange(programIR)
+            VerifyConstantRange(programIR)
 
-        programIR = RemoveUncalledFunctions(programIR)
+            programIR = RemoveUncalledFunctions(programIR)
 
-        programIR = TempCollapsing(programIR)
+            programIR = TempCollapsing(programIR)
 
-    except program.EdPyError:
-        rtc = 1
-        # print("Exception")
-        if (io.Out.IsReRaiseSet()):
-            raise
+        except program.EdPyError:
+            rtc = 1
+            # print("Exception")
+            if (io.Out.IsReRaiseSet()):
+                raise
 
-    except:
-        rtc = 1
-        io.Out.Error(io.TS.CMP_INTERNAL_ERROR,
-                     "file::: Compiler internal error {0}", 700)
-        if (io.Out.IsReRaiseSet()):
-            raise
+        except:
+            rtc = 1
+            io.Out.Error(io.TS.CMP_INTERNAL_ERROR,
+                         "file::: Compiler internal error {0}", 700)
+            if (io.Out.IsReRaiseSet()):
+                raise
 
-    if (io.Out.GetInfoDumpMask() & io.DUMP.OPTIMISER):
-        io.Out.DebugRaw("\nDump of internal representation after OPTIMISATION (rtc:{0}):".format(rtc))
-        programIR.Dump()
-        io.Out.DebugRaw("\n")
+        if (io.Out.GetInfoDumpMask() & io.DUMP.OPTIMISER):
+            io.Out.DebugRaw("\nDump of internal representation after OPTIMISATION (rtc:{0}):".format(rtc))
+            programIR.Dump()
+            io.Out.DebugRaw("\n")
 
-    if (rtc != 0):
-        io.Out.DebugRaw("WARNING - OPTIMISER finished with an ERROR!!!\n")
+        if (rtc != 0):
+            io.Out.DebugRaw("WARNING - OPTIMISER finished with an ERROR!!!\n")
 
-    return rtc
+        return rtc
 
 
 def OptimiseFromFile(filename):
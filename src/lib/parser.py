@@ -27,11 +27,34 @@ from __future__ import absolute_import
 
 import ast
 import re
+import os
+import os.path
+import tempfile
 
-# from . import util
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from . import util
 from . import io
 from . import program
 from . import edpy_code
+from . import library
+from . import compilation
+from . import version
+
+FOR_INDEX_START = 10000         # for loop temps are numbered from after this
+
+# The converted Ed. routines are kept pickled in this file (next to the module,
+# like a .pyc) and invalidated when the Ed. code and values, or this module or
+# program.py, change
+INTERNAL_IR_VERSION = 1
+INTERNAL_IR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "edpy_code.ir")
+
+MARKER_KINDS = ("ControlMarker", "LoopControl", "LoopModifier", "ForControl", "BoolCheck")
+
+internalIR = None
 
 # ############ utility functions ########################################
 
@@ -194,7 +217,8 @@ class Converter(object):
         self.returnCode = 0
         self.ctlMarker = -1     # this value is pre-incremented before use
         self.loopStack = []     # used to associate break/continue with the enclosing while/for
-        self.forIndex = 10000   # temp var used in for loops. Stay out of normal temp var way
+        self.forIndex = FOR_INDEX_START   # temp var used in for loops. Stay out of normal temp var way
+        self.edFunctions = []   # (name, line, col) of the Ed functions in the order added
 
     def WalkProgram(self, node):
         """Want to see a module node"""
@@ -289,6 +313,35 @@ class Converter(object):
             self.AddFunctionStatement(newFunction, s)
 
         self.program.Function[nodeName] = newFunction
+        self.edFunctions.append((nodeName, node.lineno, node.col_offset))
+
+    def AddEdSnapshot(self, snapshot):
+        """Add the Ed routines from a snapshot (see BuildInternalIR()). The
+           control markers and for loop temps are moved to follow on from this
+           program's, so the result is the same as WalkEdRoutines()"""
+        lastMarker, lastForIndex, functions = snapshot
+        markerBase = self.ctlMarker + 1
+        forBase = self.forIndex - FOR_INDEX_START
+
+        for (nodeName, lineno, col, function) in functions:
+            if (nodeName in self.program.Function):
+                io.Out.Error(io.TS.PARSE_NAME_REUSED,
+                             "file:{0}:{1}: Syntax Error, two {2} with the same name",
+                             lineno, col, "FUNCTIONS")
+                raise program.ParseError
+
+            for op in function.body:
+                if (op.kind in MARKER_KINDS):
+                    op.num += markerBase
+                if (lastForIndex > FOR_INDEX_START):
+                    RelocateForTemps(op, lastForIndex, forBase)
+
+            self.program.Function[nodeName] = function
+
+        self.ctlMarker += lastMarker + 1
+        self.forIndex += lastForIndex - FOR_INDEX_START
+
+        return self.returnCode
 
     def AddFunction(self, node, className=""):
         """Add a function to the program"""
@@ -907,14 +960,102 @@ class Converter(object):
         self.program.Import.append(importName)
 
 
-def ConvertToIR(topNode, programIR, internalAst):
+def RelocateForTemps(op, lastForIndex, forBase):
+    """Move the for loop temps used in op by forBase"""
+    for value in op.__dict__.values():
+        if (isinstance(value, list)):
+            values = value
+        else:
+            values = [value]
+
+        for v in values:
+            if (isinstance(v, program.Value)):
+                if (isinstance(v.name, int) and FOR_INDEX_START < v.name <= lastForIndex):
+                    v.name += forBase
+                if (isinstance(v.indexVariable, int) and
+                    FOR_INDEX_START < v.indexVariable <= lastForIndex):
+                    v.indexVariable += forBase
+
+
+def BuildInternalIR():
+    """Convert the Ed routines on their own. Returns (last control marker,
+       last for index, [(name, line, col, Function)]) or None on an error"""
+    error, internalAst = NormalPythonParse(edpy_code.CODE, "INTERNAL_CODE")
+    if (error):
+        return None
+
+    c = Converter(program.Program())
+    try:
+        c.WalkEdRoutines(internalAst)
+    except Exception:
+        return None
+
+    functions = [(name, line, col, c.program.Function[name]) for (name, line, col) in c.edFunctions]
+    return (c.ctlMarker, c.forIndex, functions)
+
+
+def GetInternalIR(useFile=True):
+    """A fresh copy of the converted Ed routines, or None if they can't be
+       converted. They are pickled, in memory and in INTERNAL_IR_PATH (unless
+       useFile is False), and loading the pickle is much cheaper than parsing
+       and converting."""
+    global internalIR
+
+    if (internalIR is None):
+        # the snapshot is of program objects made by this module, so it's out
+        # of date when either of them changes, like a .pyc
+        key = "{}:{}:{}\n".format(INTERNAL_IR_VERSION, library.Fingerprint(),
+                                  version.SourceHash("parser", "program")).encode("utf-8")
+
+        if (useFile):
+            try:
+                fh = open(INTERNAL_IR_PATH, "rb")
+                try:
+                    data = fh.read()
+                finally:
+                    fh.close()
+                if (data.startswith(key)):
+                    internalIR = data[len(key):]
+            except (IOError, OSError):
+                pass
+
+        if (internalIR is None):
+            snapshot = BuildInternalIR()
+            if (snapshot is None):
+                return None
+
+            internalIR = pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)
+            if (not useFile):
+                return pickle.loads(internalIR)
+
+            # write to a temporary file and rename, so a partial file is never seen
+            try:
+                fd, tmpPath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(INTERNAL_IR_PATH))
+                fh = os.fdopen(fd, "wb")
+                try:
+                    fh.write(key + internalIR)
+                finally:
+                    fh.close()
+                util.SetNewFileMode(tmpPath)
+                os.rename(tmpPath, INTERNAL_IR_PATH)
+            except (IOError, OSError):
+                # read only install, so it will only be kept in memory
+                pass
+
+    return pickle.loads(internalIR)
+
+
+def ConvertToIR(topNode, programIR, internalAst, internalIR=None):
     c = Converter(programIR)
 
     try:
         rtc = c.WalkProgram(topNode)
         if (rtc == 0):
             # pass
-            rtc = c.WalkEdRoutines(internalAst)
+            if (internalIR is not None):
+                rtc = c.AddEdSnapshot(internalIR)
+            else:
+                rtc = c.WalkEdRoutines(internalAst)
 
     except program.EdPyError:
         # Error was already raised
@@ -932,23 +1073,25 @@ def ConvertToIR(topNode, programIR, internalAst):
     return rtc
 
 
-def Parse(filename, programIR):
-    """Take a filename and a program IR and fill the program IR"""
+def Parse(filename, programIR, context=None):
+    """Take a filename and a program IR and fill the program IR. context is
+       the compilation.CompilationContext (the current one if None)"""
 
-    io.Out.Top(io.TS.PARSE_START, "Starting parse of file:{0}", filename)
+    with compilation.Use(context):
+        io.Out.Top(io.TS.PARSE_START, "Starting parse of file:{0}", filename)
 
-    try:
-        fh = open(filename, "rb")
-        src = b"".join(fh.readlines())
-        fh.close()
-    except Exception:
-        io.Out.Error(io.TS.FILE_OPEN_ERROR, "file:0: Could not access file {0}", filename)
-        if (io.Out.IsReRaiseSet()):
-            raise
+        try:
+            fh = open(filename, "rb")
+            src = b"".join(fh.readlines())
+            fh.close()
+        except Exception:
+            io.Out.Error(io.TS.FILE_OPEN_ERROR, "file:0: Could not access file {0}", filename)
+            if (io.Out.IsReRaiseSet()):
+                raise
 
-        return 1
+            return 1
 
-    return ParseString(src, filename, programIR)
+        return ParseString(src, filename, programIR)
 
 
 def NormalPythonParse(programString, filename):
@@ -977,34 +1120,40 @@ def NormalPythonParse(programString, filename):
     return 0, a
 
 
-def ParseString(programString, filename, programIR):
+def ParseString(programString, filename, programIR, context=None):
     """Take programString (which is source lines ending in '\n'
-       concatenated together) convert to the internal rep (IR)"""
-
-    # First do the normal python parse of user's program
-    error, ast = NormalPythonParse(programString, filename)
-    if (error):
-        return error
-
-    # Now do the extra EdPy code which implements the Ed. functions
-    src = edpy_code.CODE
-
-    error, internalAst = NormalPythonParse(src, "INTERNAL_CODE")
-    if (error):
-        return error
-
-    rtc = ConvertToIR(ast, programIR, internalAst)
-    # io.Out.DebugRaw("Parse rtc:{}, ProgramIR:{}\n".format(rtc, programIR))
-
-    if (io.Out.GetInfoDumpMask() & io.DUMP.PARSER):
-        io.Out.DebugRaw("\nDump of internal representation after parsing (rtc:{0}):".format(rtc))
-        programIR.Dump()
-        io.Out.DebugRaw("\n")
-
-    if (rtc != 0):
-        io.Out.DebugRaw("WARNING - PARSER finished with an ERROR!!!\n")
-
-    return rtc
+       concatenated together) convert to the internal rep (IR), in context
+       (the current compilation.CompilationContext if None)"""
+
+    with compilation.Use(context):
+        # First do the normal python parse of user's program
+        error, ast = NormalPythonParse(programString, filename)
+        if (error):
+            return error
+
+        # Now do the extra EdPy code which implements the Ed. functions. Normally
+        # they are already converted, so only parse them if they can't be
+        internalAst = None
+        internalIR = GetInternalIR(compilation.Current().useFiles)
+        if (internalIR is None):
+            src = edpy_code.CODE
+
+            error, internalAst = NormalPythonParse(src, "INTERNAL_CODE")
+            if (error):
+                return error
+
+        rtc = ConvertToIR(ast, programIR, internalAst, internalIR)
+        # io.Out.DebugRaw("Parse rtc:{}, ProgramIR:{}\n".format(rtc, programIR))
+
+        if (io.Out.GetInfoDumpMask() & io.DUMP.PARSER):
+            io.Out.DebugRaw("\nDump of internal representation after parsing (rtc:{0}):".format(rtc))
+            programIR.Dump()
+            io.Out.DebugRaw("\n")
+
+        if (rtc != 0):
+            io.Out.DebugRaw("WARNING - PARSER finished with an ERROR!!!\n")
+
+        return rtc
 
 def CheckGetParamNames(node):
     assert node.args.vararg == None
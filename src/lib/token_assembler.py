@@ -28,6 +28,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 from . import io
+from . import compilation
 
 import os
 import os.path
@@ -41,13 +42,18 @@ ROW_LENGTH = 14
 COL_LENGTH = 6
 
 # File scope objects
-token_stream = None
 err = None
 
+# The token stream being assembled and the library.Library of pre-assembled
+# fragments (or None) are kept in the compilation.CompilationContext
+
+
+def current_token_stream():
+    return compilation.Current().tokenStream
+
 
 def reset_tokens():
-    global token_stream
-    token_stream = None
+    compilation.Current().tokenStream = None
 
 
 def AsmError_NO_RET(number, internalError=None, line=0):
@@ -115,100 +121,36 @@ def assem_line(line):
     """First scan of the operator to see which function to call"""
     io.Out.SetErrorRawContext(3, line)
 
-    words = hl_parser.chop_line(line)
+    if (isinstance(line, hl_parser.Instruction)):
+        # made by the compiler, so the words are already known
+        words = line.get_words()
+    else:
+        words = hl_parser.chop_line(line)
 
     if (not words):
         return
 
     t1 = words[0]
 
-    io.Out.SetErrorRawContext(4, hl_parser.format_word_list(words))
+    # only formatted if an error is output
+    io.Out.SetErrorRawContext(4, lambda: hl_parser.format_word_list(words))
 
     if (t1.type() == "label"):
         assem_spec_label(t1, words[1:], line=line)
 
     elif (t1.type() == "op"):
         op = t1.val()
-        words = words[1:]
-
-        if (op.endswith('b') or op.endswith('w')):
-            size = 0
-            if (op.endswith('w')):
-                size = 1
-
-            op = op[:-1]
-            if (op == "mov"):
-                assem_move(size, words, "", line=line)
-            elif (op == "mol"):
-                assem_move(size, words, "mol", line=line)
-            elif (op == "dat"):
-                assem_data(size, words, line=line)
-            elif (op in ["not", "dec", "inc"]):
-                assem_uni_math(op, size, words, line=line)
-            elif (op in ["add", "sub", "mul", "cmp"]):
-                assem_basic_math(op, size, words, line=line)
-            elif (op in ["shl", "shr", "div", "mod"]):
-                assem_other_math(op, size, words, line=line)
-            elif (op in ["push", "pop", "stra", "stwa"]):
-                assem_stack(op, size, words, line=line)
-            elif (op in ["or", "and", "xor"]):
-                assem_other_math(op, size, words, line=line)
-            elif (op == "out"):
-                assem_debug_output(op, size, words, line=line)
-            else:
-                AsmError_NO_RET(1, "Unknown operator:%s" % (op))
+        if (op in OP_TABLE):
+            handler, args = OP_TABLE[op]
+            handler(*(args + (words[1:],)), line=line)
+        elif (op.endswith('b') or op.endswith('w')):
+            AsmError_NO_RET(1, "Unknown operator:%s" % (op[:-1]))
         else:
-            if (op == "mova"):
-                assem_move(0, words, "lcd", line=line)
-            elif (op == "movtime"):
-                assem_move(1, words, "time", line=line)
-            elif (op in ["conv", "convl", "convm", "cmptime"]):
-                # conv 8->16, conv 16->8 lsb, conv 16->8 msb, cmp time
-                assem_conv(op, words, line=line)
-            elif (op in ["disable", "enable", "error"]):
-                assem_event(op, words, line=line)
-            elif (op in ["ret", "dbnz", "dsnz"]):
-                assem_jump(op, "", words, line=line)
-            elif (op in ["bra", "bre", "brne", "brgr", "brge", "brl", "brle", "brz", "brnz"]):
-                assem_jump("branch", op[2:], words, line=line)
-            elif (op in ["suba", "sube", "subne", "subgr", "subge", "subl", "suble", "subz", "subnz"]):
-                assem_jump("sub", op[3:], words, line=line)
-            elif (op in ["stop", "bitset", "bitclr"]):
-                assem_misc(op, words, line=line)
-            elif (op in ["or", "and", "xor"]):
-                # if there is no size after the op (which is now depricated) then treat it like a 'b'
-                assem_other_math(op, 0, words, line=line)
-            elif (op in ["stinc", "stdec", "push"]):
-                assem_stack_math(op, words, line=line)
-
-            elif (op in ["DATB", "DATW"]):
-                assem_spec_data(op[3], words, line=line)
-            elif (op == "DATA"):
-                assem_spec_data_lcd(op[3], words, line=line)
-            elif (op in ["BINB"]):
-                assem_spec_binary(op[3], words, line=line)
-            elif (len(op) == 7 and op[:6] == "RESERV"):
-                assem_spec_reserve(op[6], words, line=line)
-            elif (op in ["BEGIN", "END"]):
-                assem_spec_begin_end(op, words, line=line)
-            elif (op == "VERSION"):
-                assem_spec_version(words, line=line)
-            elif (op == "LIMITS"):
-                assem_spec_limits(words, line=line)
-            elif (op == "DEVICE"):
-                assem_spec_device(words, line=line)
-            elif (op == "INSERT"):
-                assem_spec_insert(words, line=line)
-#           elif (op == "COMMS"):
-#               assem_spec_comms(words, line=line)
-            elif (op == "FINISH"):
-                assem_spec_finish(words, line=line)
-            else:
-                AsmError_NO_RET(2, "Unknown operator:%s" % (op))
+            AsmError_NO_RET(2, "Unknown operator:%s" % (op))
 
 
-def assem_move(size, words, special, line):
-    io.Out.DebugRaw("Move size:%d, words:%s" % (size, hl_parser.format_word_list(words)))
+def assem_move(size, special, words, line):
+    io.Out.DebugRaw(lambda: "Move size:%d, words:%s" % (size, hl_parser.format_word_list(words)))
     if (len(words) != 2):
         AsmError_NO_RET(3, "Move needs 2 arguments")
 
@@ -262,7 +204,7 @@ def assem_move_from_acc(size, words, special, line):
         else:
             AsmError_NO_RET(6, "Destination must be a mod/reg or variable")
 
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 def assem_move_not_from_acc(size, words, special, line):
@@ -358,11 +300,11 @@ def assem_move_not_from_acc(size, words, special, line):
         sdindex += 1
 
     io.Out.DebugDumpObjectRaw(token, "move")
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 def assem_data(size, words, line):
-    io.Out.DebugRaw("data size:%s words:%s" % (size, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "data size:%s words:%s" % (size, hl_parser.format_word_list(words)))
 
     if (len(words) < 3):
         AsmError_NO_RET(11, "dat[bw] needs at least 3 arguments: var, len and value1")
@@ -445,14 +387,14 @@ def assem_data(size, words, line):
                     token_index += 2
                     val_index += 1
 
-            token.finish(token_stream)
+            token.finish(current_token_stream())
 
 
 uni_assem_map = {"not": 0, "inc": 1, "dec": 2}
 
 
 def assem_uni_math(op, size, words, line):
-    io.Out.DebugRaw("Mathu %s size:%d, words:%s" % (op, size, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Mathu %s size:%d, words:%s" % (op, size, hl_parser.format_word_list(words)))
     if (len(words) > 1):
         AsmError_NO_RET(15, "Unary Math has at most one argument")
 
@@ -465,7 +407,7 @@ def assem_uni_math(op, size, words, line):
     if (not words or
         (words[0].type() == "modreg" and words[0].val() == 0xf0)):
         token.add_bits(0, 2, 1, 0)
-        token.finish(token_stream)
+        token.finish(current_token_stream())
     elif (words[0].type() in ["var", "arg"]):
         token.add_bits(0, 2, 1, 1)
         if (words[0].type() == "arg"):
@@ -473,7 +415,7 @@ def assem_uni_math(op, size, words, line):
         else:
             token.add_byte(1, 0)
             token.add_vname(1, size, words[0].val())
-        token.finish(token_stream)
+        token.finish(current_token_stream())
     else:
         AsmError_NO_RET(16, "Unary Math - invalid argument type")
 
@@ -481,7 +423,7 @@ basic_assem_map = {"add": 0, "sub": 1, "mul": 2, "cmp": 3}
 
 
 def assem_basic_math(op, size, words, line):
-    io.Out.DebugRaw("Mathb %s size:%s, words:%s" % (op, size, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Mathb %s size:%s, words:%s" % (op, size, hl_parser.format_word_list(words)))
     if (len(words) != 1):
         AsmError_NO_RET(17, "Basic Math needs one argument")
 
@@ -499,7 +441,7 @@ def assem_basic_math(op, size, words, line):
         else:
             token.add_byte(1, 0)
             token.add_vname(1, size, words[0].val())
-        token.finish(token_stream)
+        token.finish(current_token_stream())
     elif (words[0].type() == "const"):
         token.add_bits(0, 2, 1, 1)
         if (size == 0):
@@ -507,7 +449,7 @@ def assem_basic_math(op, size, words, line):
         else:
             token.add_word(1, words[0].val())
 
-        token.finish(token_stream)
+        token.finish(current_token_stream())
     else:
         AsmError_NO_RET(18, "Basic Math - invalid argument type")
 
@@ -516,7 +458,7 @@ other2_assem_map = {"or": 0, "and": 1, "xor": 2}
 
 
 def assem_other_math(op, size, words, line):
-    io.Out.DebugRaw("Matho %s size:%d, words:%s" % (op, size, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Matho %s size:%d, words:%s" % (op, size, hl_parser.format_word_list(words)))
 
     if (len(words) != 1):
         AsmError_NO_RET(19, "Logic Math needs one arguement")
@@ -544,7 +486,7 @@ def assem_other_math(op, size, words, line):
         else:
             token.add_byte(1, 0)
             token.add_vname(1, size, words[0].val())
-        token.finish(token_stream)
+        token.finish(current_token_stream())
     elif (words[0].type() == "const"):
         token.add_bits(0, 2, 1, 1)
         if ((size == 0) or (op in ("shl", "shr"))):
@@ -553,13 +495,13 @@ def assem_other_math(op, size, words, line):
         else:
             token.add_word(1, words[0].val())
 
-        token.finish(token_stream)
+        token.finish(current_token_stream())
     else:
         AsmError_NO_RET(21, "Logic Math - invalid argument type")
 
 
 def assem_conv(op, words, line):
-    io.Out.DebugRaw("Conv %s words:%s" % (op, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Conv %s words:%s" % (op, hl_parser.format_word_list(words)))
 
     token = tokens.Token("conv", err, line)
 
@@ -586,11 +528,11 @@ def assem_conv(op, words, line):
             if (op == "convm"):
                 token.add_bits(0, 3, 1, 1)
 
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 def assem_stack(op, size, words, line):
-    io.Out.DebugRaw("Stack %s size:%d, words:%s" % (op, size, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Stack %s size:%d, words:%s" % (op, size, hl_parser.format_word_list(words)))
     # op in ['push', 'pop', 'stra', 'stwa'], size in [0, 1], one word
     if (len(words) != 1):
         AsmError_NO_RET(25, "Stack ops need 1 argument")
@@ -655,11 +597,11 @@ def assem_stack(op, size, words, line):
         else:
             AsmError_NO_RET(29, "Strw - invalid operand: %s" % (words[0].type()))
 
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 def assem_debug_output(op, size, words, line):
-    io.Out.DebugRaw("Debug output %s size:%d, words:%s" % (op, size, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Debug output %s size:%d, words:%s" % (op, size, hl_parser.format_word_list(words)))
     # op in ['out'], size in [0, 1], one word
     if (len(words) != 1):
         AsmError_NO_RET(30, "Debug output needs 1 argument")
@@ -677,11 +619,11 @@ def assem_debug_output(op, size, words, line):
     token.add_byte(1, 0)
     token.add_vname(1, size, words[0].val())
 
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 def assem_stack_math(op, words, line):
-    io.Out.DebugRaw("Stack math %s words:%s" % (op, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Stack math %s words:%s" % (op, hl_parser.format_word_list(words)))
     # op in ['stinc', 'stdec', 'push'], one word
     if (len(words) != 1):
         AsmError_NO_RET(32, "Stack ops need 1 argument")
@@ -715,11 +657,11 @@ def assem_stack_math(op, words, line):
         else:
             AsmError_NO_RET(36, "Stdec - invalid operand: %s" % (words[0].type()))
 
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 def assem_event(op, words, line):
-    io.Out.DebugRaw("Event %s words:%s" % (op, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Event %s words:%s" % (op, hl_parser.format_word_list(words)))
 
     token = tokens.Token("event", err, line)
 
@@ -749,14 +691,14 @@ def assem_event(op, words, line):
         else:  # (op == 'disable')
             token.add_bits(0, 2, 1, 0)
 
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 jcond_assem_map = {'a': 0, 'e': 1, 'ne': 2, 'gr': 3, 'ge': 4, 'l': 5, 'le': 6, 'z': 1, 'nz': 2}
 
 
 def assem_jump(op, cond, words, line):
-    io.Out.DebugRaw("Jump %s cond:%s, words:%s" % (op, cond, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Jump %s cond:%s, words:%s" % (op, cond, hl_parser.format_word_list(words)))
     # ops is one of: branch, sub, ret, dbnz, dsnz
     # cond is one of: a, e, ne, g, l, le, lg or empty for ret, d?nz
     token = tokens.Token("jump", err, line)
@@ -807,18 +749,18 @@ def assem_jump(op, cond, words, line):
         else:
             AsmError_NO_RET(42, "Jumps need either a constant or a label as argument, not a: " + words[0].type())
 
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 def assem_misc(op, words, line):
-    io.Out.DebugRaw("Misc op:%s words:%s" % (op, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Misc op:%s words:%s" % (op, hl_parser.format_word_list(words)))
     if (op == "stop"):
         if (len(words) != 0):
             AsmError_NO_RET(43, "Stop doesn't take arguments")
 
         token = tokens.Token("misc", err, line)
         token.add_bits(0, 0, 0xff, 0xff)
-        token.finish(token_stream)
+        token.finish(current_token_stream())
 
     elif (op in ["bitset", "bitclr"]):
         if (len(words) != 2):
@@ -839,7 +781,7 @@ def assem_misc(op, words, line):
 
         token.add_bits(0, 0, 0x7, bit)
         token.add_byte(1, modreg)
-        token.finish(token_stream)
+        token.finish(current_token_stream())
 
     else:
         AsmError_NO_RET(46, "Unknown misc operator: " + op)
@@ -852,11 +794,11 @@ def assem_spec_label(label, words, line):
     if (len(words) != 0):
         AsmError_NO_RET(47, "A label doesn't take any arguments")
 
-    token_stream.add_label(label.val())
+    current_token_stream().add_label(label.val())
 
 
 def assem_spec_data(which, words, line):
-    io.Out.DebugRaw("Spec_data which:%s words:%s" % (which, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_data which:%s words:%s" % (which, hl_parser.format_word_list(words)))
 
     if (len(words) < 2):
         AsmError_NO_RET(48, "DAT[BW] needs at least 2 arguments: name, start")
@@ -969,15 +911,15 @@ def assem_spec_data(which, words, line):
                     token_index += 2
                     val_index += 1
 
-            token.finish(token_stream)
+            token.finish(current_token_stream())
 
     # Add the info about the variable to the token_stream
     if (name != '*'):
-        token_stream.add_variable(space, name, start, real_length)
+        current_token_stream().add_variable(space, name, start, real_length)
 
 
 def assem_spec_data_lcd(which, words, line):
-    io.Out.DebugRaw("Spec_data_lcd which:%s words:%s" % (which, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_data_lcd which:%s words:%s" % (which, hl_parser.format_word_list(words)))
 
     if (len(words) < 4):
         AsmError_NO_RET(53, "DATA needs at least 4 arguments: row, col, len, val1")
@@ -1064,11 +1006,11 @@ def assem_spec_data_lcd(which, words, line):
                 token_index += 1
                 val_index += 1
 
-            token.finish(token_stream)
+            token.finish(current_token_stream())
 
 
 def assem_spec_binary(which, words, line):
-    io.Out.DebugRaw("Spec_binary which:%s words:%s" % (which, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_binary which:%s words:%s" % (which, hl_parser.format_word_list(words)))
 
     token = tokens.Token("binary", err, line)
     token_index = 0
@@ -1087,19 +1029,19 @@ def assem_spec_binary(which, words, line):
                 token.add_byte(token_index, w.anum())
                 token_index += 1
 
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 def assem_spec_reserve(which, words, line):
-    io.Out.DebugRaw("Spec_reserve which:%s words:%s" % (which, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_reserve which:%s words:%s" % (which, hl_parser.format_word_list(words)))
     if (len(words) != 2):
         AsmError_NO_RET(59, "RESERV[ABW] needs 2 arguments: start, length")
 
-    token_stream.reserve_name_space(tokens.space_types[which], words[0].anum(), words[1].anum())
+    current_token_stream().reserve_name_space(tokens.space_types[which], words[0].anum(), words[1].anum())
 
 
 def assem_spec_version(words, line):
-    io.Out.DebugRaw("Spec_version words:%s" % (hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_version words:%s" % (hl_parser.format_word_list(words)))
     if (len(words) != 2):
         AsmError_NO_RET(60, "VERSION needs 2 arguments: major, minor")
     major = words[0].anum()
@@ -1111,11 +1053,11 @@ def assem_spec_version(words, line):
     if (minor < 0 or minor > 15):
         AsmError_NO_RET(62, "minor version must be between 0 and 15 (not %d)" % major)
 
-    token_stream.add_version(major, minor)
+    current_token_stream().add_version(major, minor)
 
 
 def assem_spec_begin_end(op, words, line):
-    io.Out.DebugRaw("Spec_begin_end op:%s words:%s" % (op, hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_begin_end op:%s words:%s" % (op, hl_parser.format_word_list(words)))
     if (len(words) < 1):
         AsmError_NO_RET(63, "BEGIN/END need a type argument")
 
@@ -1123,10 +1065,10 @@ def assem_spec_begin_end(op, words, line):
         if (op == "BEGIN"):
             if (len(words) != 1):
                 AsmError_NO_RET(64, "FIRMWARE doesn't take any arguments.")
-            token_stream.add_begin("firmware")
+            current_token_stream().add_begin("firmware")
         else:
             # END MAIN
-            token_stream.add_end("firmware")
+            current_token_stream().add_end("firmware")
     elif (words[0].astr() == "EVENT"):
         if (op == "BEGIN"):
             if (len(words) != 4):
@@ -1134,26 +1076,54 @@ def assem_spec_begin_end(op, words, line):
             modreg = words[1].amodreg()
             mask = words[2].anum()
             value = words[3].anum()
-            token_stream.add_begin("event", modreg, mask, value)
+            current_token_stream().add_begin("event", modreg, mask, value)
         else:
             # END EVENT
-            token_stream.add_end("event")
+            current_token_stream().add_end("event")
 
     elif (words[0].astr() == "MAIN"):
         if (op == "BEGIN"):
             if (len(words) != 1):
                 AsmError_NO_RET(66, "MAIN doesn't take any arguments.")
-            token_stream.add_begin("main")
+            current_token_stream().add_begin("main")
         else:
             # END MAIN
-            token_stream.add_end("main")
+            current_token_stream().add_end("main")
+
+    elif (words[0].astr() == "OBJECT"):
+        if (op == "BEGIN"):
+            if (len(words) != 3):
+                AsmError_NO_RET(76, "OBJECT needs 2 arguments: name, key")
+            current_token_stream().begin_fragment(words[1].astr(), words[2].val())
+        else:
+            # END OBJECT
+            fragment = current_token_stream().end_fragment()
+            library = compilation.Current().library
+            if (fragment is not None and library is not None):
+                library.Add(fragment)
 
     else:
-        AsmError_NO_RET(67, "BEGIN/END needs one of: MAIN, EVENT, FIRMWARE")
+        AsmError_NO_RET(67, "BEGIN/END needs one of: MAIN, EVENT, FIRMWARE, OBJECT")
+
+
+def assem_spec_link(words, line):
+    io.Out.DebugRaw(lambda: "Spec_link words:%s" % (hl_parser.format_word_list(words)))
+    if (len(words) != 2):
+        AsmError_NO_RET(77, "LINK needs 2 arguments: name, key")
+
+    fragment = None
+    library = compilation.Current().library
+    if (library is not None):
+        fragment = library.Get(words[1].val())
+
+    if (fragment is None):
+        AsmError_NO_RET(78, "LINK has no fragment for %s" % (words[0].val()))
+
+    fragment.link(current_token_stream())
 
 
 def assem_spec_limits(words, line):
-    io.Out.DebugRaw("Spec_limits words:%s" % (hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_limits words:%s" % (hl_parser.format_word_list(words)))
     if (len(words) != 5):
         AsmError_NO_RET(68, "LIMITS needs exactly 5 arguments")
 
@@ -1165,11 +1135,11 @@ def assem_spec_limits(words, line):
     e_handlers = words[3].anum()
     t_bytes_limit = words[4].anum()
 
-    token_stream.set_limits(b_limit, w_limit, l_limit, e_handlers, t_bytes_limit)
+    current_token_stream().set_limits(b_limit, w_limit, l_limit, e_handlers, t_bytes_limit)
 
 
 def assem_spec_device(words, line):
-    io.Out.DebugRaw("Spec_device words:%s" % (hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_device words:%s" % (hl_parser.format_word_list(words)))
     if (len(words) == 2):
         name = ""
     elif (len(words) == 3):
@@ -1183,12 +1153,12 @@ def assem_spec_device(words, line):
     # error checking is done in the hl_parser
     # add the device to the high_level parser for parsing of subsequent names
     if (hl_parser.add_device(location, device_type, name)):
-        token_stream.add_device(hl_parser.device_types[device_type], location,
+        current_token_stream().add_device(hl_parser.device_types[device_type], location,
                                 hl_parser.device_storage[device_type])
 
 
 def assem_spec_insert(words, line):
-    io.Out.DebugRaw("Spec_insert words:%s" % (hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_insert words:%s" % (hl_parser.format_word_list(words)))
     if (len(words) != 2):
         AsmError_NO_RET(70, "INSERT needs type and filename arguments")
 
@@ -1207,11 +1177,11 @@ def assem_spec_insert(words, line):
 
     token = tokens.Token("binary", err, line)
     token.add_binary_file(f_name)
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
 
 def assem_spec_comms(words, line):
-    io.Out.DebugRaw("Spec_comms words:%s" % (hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_comms words:%s" % (hl_parser.format_word_list(words)))
     if (len(words) != 1):
         AsmError_NO_RET(74, "COMMS needs exactly 1 argument")
 
@@ -1219,103 +1189,108 @@ def assem_spec_comms(words, line):
     token.add_bits(0, 0, 0xf, 0x8)
 
     token.add_uword(1, words[0].anum())
-    token.finish(token_stream)
+    token.finish(current_token_stream())
 
-    token_stream.set_comms(words[0].anum())
+    current_token_stream().set_comms(words[0].anum())
 
 
 def assem_spec_finish(words, line):
-    io.Out.DebugRaw("Spec_finish words:%s" % (hl_parser.format_word_list(words)))
+    io.Out.DebugRaw(lambda: "Spec_finish words:%s" % (hl_parser.format_word_list(words)))
     if (len(words) != 0):
         AsmError_NO_RET(75, "FINISH doesn't have any arguments")
 
-    token_stream.finish_tokens()
+    current_token_stream().finish_tokens()
 
 
 # *********** Sequencing the assembly *********************************
 
-def assemble_file(srcPath, debug):
-    global token_stream
-
-    io.Out.Top(io.TS.ASM_START, "Starting assembler")
-    ok = True
-
-    try:
-        # setup the token stream
-        token_stream = tokens.TokenStream()
-        token_stream.clear()
-        ok = assem_file(srcPath, [])
-
-    except program.EdPyError:
-        ok = False
-        if (io.Out.IsReRaiseSet()):
-            raise
-
-    except:
-        ok = False
-        io.Out.Error(io.TS.CMP_INTERNAL_ERROR,
-                     "file::: Compiler internal error {0}", 703)
-        if (io.Out.IsReRaiseSet()):
-            raise
-
-    if (not ok):
-        # print("ERROR when assembling!")
-        return [], "", "", (0, 0)
-
-    # print (len(lines), lines[0])
-    return finish_assembley(srcPath, debug)
-
-
-def assemble_lines(lines, debug):
-    global token_stream
-
-    io.Out.Top(io.TS.ASM_START, "Starting assembler")
-    ok = True
-
-    try:
-        # setup the token stream
-        token_stream = tokens.TokenStream()
-        token_stream.clear()
-        ok = assem_lines(lines)
-
-    except program.EdPyError:
-        ok = False
-        if (io.Out.IsReRaiseSet()):
-            raise
-
-    except:
-        ok = False
-        io.Out.Error(io.TS.CMP_INTERNAL_ERROR,
-                     "file::: Compiler internal error {0}", 704)
-        if (io.Out.IsReRaiseSet()):
-            raise
-
-    if (not ok):
-        # print("ERROR when assembling!")
-        return [], "", "", (0, 0)
-
-    # print (len(lines), lines[0])
-    return finish_assembley("internal", debug)
+def assemble_file(srcPath, debug, context=None):
+    """Assemble the file in context, a compilation.CompilationContext (or the
+       current one if None)"""
+    with compilation.Use(context) as context:
+        io.Out.Top(io.TS.ASM_START, "Starting assembler")
+        ok = True
+
+        try:
+            # setup the token stream
+            context.tokenStream = tokens.TokenStream()
+            context.tokenStream.clear()
+            ok = assem_file(srcPath, [])
+
+        except program.EdPyError:
+            ok = False
+            if (io.Out.IsReRaiseSet()):
+                raise
+
+        except:
+            ok = False
+            io.Out.Error(io.TS.CMP_INTERNAL_ERROR,
+                         "file::: Compiler internal error {0}", 703)
+            if (io.Out.IsReRaiseSet()):
+                raise
+
+        if (not ok):
+            # print("ERROR when assembling!")
+            return bytearray(), "", (0, 0)
+
+        # print (len(lines), lines[0])
+        return finish_assembley(srcPath, debug)
+
+
+def assemble_lines(lines, debug, fragment_library=None, context=None):
+    """Assemble the lines in context, a compilation.CompilationContext (or the
+       current one if None)"""
+    with compilation.Use(context) as context:
+        context.library = fragment_library
+
+        io.Out.Top(io.TS.ASM_START, "Starting assembler")
+        ok = True
+
+        try:
+            # setup the token stream
+            context.tokenStream = tokens.TokenStream()
+            context.tokenStream.clear()
+            ok = assem_lines(lines)
+
+        except program.EdPyError:
+            ok = False
+            if (io.Out.IsReRaiseSet()):
+                raise
+
+        except:
+            ok = False
+            io.Out.Error(io.TS.CMP_INTERNAL_ERROR,
+                         "file::: Compiler internal error {0}", 704)
+            if (io.Out.IsReRaiseSet()):
+                raise
+
+        if (not ok):
+            # print("ERROR when assembling!")
+            return bytearray(), "", (0, 0)
+
+        # print (len(lines), lines[0])
+        return finish_assembley("internal", debug)
 
 
 def finish_assembley(source, debug):
     ok = True
     try:
-        token_analysis = tokens.TokenAnalyser(token_stream)
+        token_analysis = tokens.TokenAnalyser(current_token_stream())
         token_analysis.map_all_variables()
 
         if (debug and not io.Out.WasErrorRaised()):
             hl_parser.dump_devices()
             token_analysis.dump_variable_map()
+            token_analysis.dump_allocation_report()
 
         token_analysis.fixup_jumps()
 
         if (debug and not io.Out.WasErrorRaised()):
-            token_stream.dump_tokens(source)
+            current_token_stream().dump_tokens(source)
             token_analysis.dump_extras()
 
-        download_type, version, header, added_bytes = token_analysis.create_header()
-        # print(download_type, version, header)
+        download_type, version, download = token_analysis.create_header()
+        # print(download_type, version, download[:12])
 
     except:
         ok = False
@@ -1324,35 +1299,81 @@ def finish_assembley(source, debug):
 
     if (not ok):
         # print("ERROR when assembling!")
-        return [], "", "", (0, 0)
-
-    # get the token bytes
-    download_str = ""
-    download_bytes = []
-    for t in header:
-        download_bytes.append(t)
-        download_str += chr(t)
-
-    for t in token_stream.token_stream:
-        bytes = t.get_token_bits()
-        download_bytes.extend(bytes)
-        for b in bytes:
-            download_str += chr(b)
-
-    if (added_bytes > 0):
-        extra_bytes = [0xff] * added_bytes
-        download_bytes.extend(extra_bytes)
-        for b in extra_bytes:
-            download_str += chr(b)
-
-    return download_bytes, download_str, download_type, version
+        return bytearray(), "", (0, 0)
+
+    # The whole download as one bytearray: the version bytes, header, tokens and padding
+    return download, download_type, version
+
+
+# ********* Operator table ********************************************
+
+def build_op_table():
+    """Map every operator to (handler, args). The handler is called with the
+       args, then the words after the operator."""
+    table = {}
+
+    # operators that have a size: b (byte, 0) or w (word, 1)
+    for suffix, size in (('b', 0), ('w', 1)):
+        table["mov" + suffix] = (assem_move, (size, ""))
+        table["mol" + suffix] = (assem_move, (size, "mol"))
+        table["dat" + suffix] = (assem_data, (size,))
+        for op in ["not", "dec", "inc"]:
+            table[op + suffix] = (assem_uni_math, (op, size))
+        for op in ["add", "sub", "mul", "cmp"]:
+            table[op + suffix] = (assem_basic_math, (op, size))
+        for op in ["shl", "shr", "div", "mod", "or", "and", "xor"]:
+            table[op + suffix] = (assem_other_math, (op, size))
+        for op in ["push", "pop", "stra", "stwa"]:
+            table[op + suffix] = (assem_stack, (op, size))
+        table["out" + suffix] = (assem_debug_output, ("out", size))
+
+    table["mova"] = (assem_move, (0, "lcd"))
+    table["movtime"] = (assem_move, (1, "time"))
+
+    # conv 8->16, conv 16->8 lsb, conv 16->8 msb, cmp time
+    for op in ["conv", "convl", "convm", "cmptime"]:
+        table[op] = (assem_conv, (op,))
+    for op in ["disable", "enable", "error"]:
+        table[op] = (assem_event, (op,))
+    for op in ["ret", "dbnz", "dsnz"]:
+        table[op] = (assem_jump, (op, ""))
+    for op in ["bra", "bre", "brne", "brgr", "brge", "brl", "brle", "brz", "brnz"]:
+        table[op] = (assem_jump, ("branch", op[2:]))
+    for op in ["suba", "sube", "subne", "subgr", "subge", "subl", "suble", "subz", "subnz"]:
+        table[op] = (assem_jump, ("sub", op[3:]))
+    for op in ["stop", "bitset", "bitclr"]:
+        table[op] = (assem_misc, (op,))
+    for op in ["or", "and", "xor"]:
+        # if there is no size after the op (which is now depricated) then treat it like a 'b'
+        table[op] = (assem_other_math, (op, 0))
+    for op in ["stinc", "stdec", "push"]:
+        table[op] = (assem_stack_math, (op,))
+
+    table["DATB"] = (assem_spec_data, ("B",))
+    table["DATW"] = (assem_spec_data, ("W",))
+    table["DATA"] = (assem_spec_data_lcd, ("A",))
+    table["BINB"] = (assem_spec_binary, ("B",))
+    for which in tokens.space_types:
+        table["RESERV" + which] = (assem_spec_reserve, (which,))
+    table["BEGIN"] = (assem_spec_begin_end, ("BEGIN",))
+    table["END"] = (assem_spec_begin_end, ("END",))
+    table["VERSION"] = (assem_spec_version, ())
+    table["LIMITS"] = (assem_spec_limits, ())
+    table["DEVICE"] = (assem_spec_device, ())
+    table["INSERT"] = (assem_spec_insert, ())
+    table["LINK"] = (assem_spec_link, ())
+    # table["COMMS"] = (assem_spec_comms, ())
+    table["FINISH"] = (assem_spec_finish, ())
+
+    return table
+
+OP_TABLE = build_op_table()
 
 
 # ********* Main and tests ********************************************
 
 
 def test():
-    global token_stream
     global err
 
     test_simp = ["incb %acc", "movb 12,@lil_count", "decw 1001/2", " # a comment line",
@@ -1412,8 +1433,8 @@ def test():
 
     io.Out.DebugRaw("Starting test")
 
-    token_stream = tokens.TokenStream()
-    token_stream.clear()
+    compilation.Current().tokenStream = tokens.TokenStream()
+    current_token_stream().clear()
 
     test_lines = []
 
@@ -1431,10 +1452,10 @@ def test():
     for t in test_lines:
         assem_line(t)
 
-    token_stream.dump_tokens()
-    io.Out.DebugDumpObjectRaw(token_stream, "TokenStream")
+    current_token_stream().dump_tokens()
+    io.Out.DebugDumpObjectRaw(current_token_stream(), "TokenStream")
 
-    token_analysis = tokens.TokenAnalyser(token_stream)
+    token_analysis = tokens.TokenAnalyser(current_token_stream())
     token_analysis.map_all_variables()
     token_analysis.dump_variable_map()
     token_analysis.fixup_jumps()
@@ -1442,5 +1463,5 @@ def test():
     token_analysis.fixup_jumps()        # Fixup globals which may change because of section headers
     token_analysis.fixup_crcs()         # Finally the crcs -- nothing will change now
 
-    token_stream.dump_tokens()
+    current_token_stream().dump_tokens()
     io.Out.DebugDumpObjectRaw(token_analysis, "Token_analyser")
@@ -33,6 +33,10 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
+import bisect
+import itertools
+import os
+
 from . import io
 from . import program
 
@@ -60,6 +64,32 @@ def is_bad_length_for_crc(data_len):
 # print("Test 766:", is_bad_length_for_crc(766))
 # print("Test 767:", is_bad_length_for_crc(767))
 
+# INSERT BINARY files are only read once per process. Indexed on the absolute path,
+# holding ((mtime, size), bytes) so a changed file is read again.
+binary_files = {}
+
+
+def load_binary_file(f_name):
+    """Return the contents of f_name as a bytearray. It's shared by every
+       token that inserts the file, so must not be changed."""
+    path = os.path.abspath(f_name)
+    info = os.stat(path)
+    key = (info.st_mtime, info.st_size)
+    if (path in binary_files and binary_files[path][0] == key):
+        return binary_files[path][1]
+
+    # read straight into the final buffer
+    data = bytearray(info.st_size)
+    fh = open(path, 'rb')
+    count = fh.readinto(data)
+    fh.close()
+    if (count != len(data)):
+        # the file changed while being read
+        del data[count:]
+
+    binary_files[path] = (key, data)
+    return data
+
 # No LCD,  so lcd limit == 0
 LIMIT_NAMES = ("Bytes", "Words", "LCD chars", "Event handlers", "Token bytes")
 MAX_LIMITS = (256, 256, 0, 16, 4096)
@@ -77,17 +107,95 @@ def AsmError_NO_RET(number, internalError=None, line=0):
     raise program.AssemblerError
 
 
-def calculate_crc(bytes):
-    crc = 0xffff
-    for i in range(len(bytes)):
-        crc = crc ^ (bytes[i] << 8)
+# CRC-16 CCITT (polynomial 0x1021, start 0xffff), msb first. The table has
+# the crc change for every value of the top byte xor'ed with a data byte.
+def make_crc_table():
+    table = []
+    for value in range(256):
+        crc = value << 8
         for j in range(8):
             if (crc & 0x8000 != 0):
                 crc = ((crc << 1) ^ 0x1021)
             else:
                 crc = crc << 1
+        table.append(crc & 0xffff)
+    return table
+
+CRC_TABLE = make_crc_table()
+
+
+class Crc16(object):
+    """Incremental CRC, so the crc can be updated as the bytes are produced"""
 
-    return crc & 0xffff
+    def __init__(self, bytes=None):
+        self.crc = 0xffff
+        self.length = 0
+        if (bytes):
+            self.update(bytes)
+
+    def update(self, bytes, start=0):
+        """Add bytes[start:] (without copying them)"""
+        crc = self.crc
+        table = CRC_TABLE
+        for b in itertools.islice(bytes, start, None):
+            crc = ((crc << 8) & 0xffff) ^ table[(crc >> 8) ^ b]
+
+        self.crc = crc
+        self.length += len(bytes) - start
+
+    def value(self):
+        return self.crc
+
+
+def calculate_crc(bytes):
+    return Crc16(bytes).value()
+
+
+class FenwickTree(object):
+    """Prefix sums of a list of numbers, in O(log n) for a change to a
+       number, appending a number, and a sum"""
+
+    def __init__(self, values=()):
+        self.build(list(values))
+
+    def build(self, values):
+        self.values = values
+        self.tree = [0] * (len(values) + 1)
+        for i in range(len(values)):
+            index = i + 1
+            self.tree[index] += values[i]
+            parent = index + (index & -index)
+            if (parent < len(self.tree)):
+                self.tree[parent] += self.tree[index]
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, index, delta):
+        self.values[index] += delta
+        index += 1
+        while (index < len(self.tree)):
+            self.tree[index] += delta
+            index += index & -index
+
+    def append(self, value):
+        # the new node holds the sum of the values that it covers
+        index = len(self.tree)
+        self.values.append(value)
+        self.tree.append(value + self.prefix(index - 1) - self.prefix(index - (index & -index)))
+
+    def insert(self, index, value):
+        # everything after index moves, so just rebuild - O(n)
+        self.values.insert(index, value)
+        self.build(self.values)
+
+    def prefix(self, index):
+        """Sum of the values before index"""
+        total = 0
+        while (index > 0):
+            total += self.tree[index]
+            index -= index & -index
+        return total
 
 
 def word_to_bytes(word):
@@ -95,6 +203,93 @@ def word_to_bytes(word):
     return (((word >> 8) & 0xff), (word & 0xff))
 
 
+# The two bytes in front of every download: the version and its complement
+def version_bytes(version):
+    version_number = (version[0] << 4) + version[1]
+    return (version_number, 255 - version_number)
+
+
+class FreeBlocks(object):
+    """The free blocks of a name space, indexed on their start address (to
+       find the block that holds an address) and on (length, start) for
+       a best fit in O(log n)"""
+
+    def __init__(self, limit):
+        self.starts = [0]               # sorted starts of the free blocks
+        self.ends = {0: limit}          # the end of each block indexed on its start
+        self.by_size = [(limit, 0)]     # sorted (length, start) of the free blocks
+
+    def add(self, start, end):
+        bisect.insort(self.starts, start)
+        self.ends[start] = end
+        bisect.insort(self.by_size, (end - start, start))
+
+    def remove(self, start):
+        end = self.ends.pop(start)
+        del self.starts[bisect.bisect_left(self.starts, start)]
+        del self.by_size[bisect.bisect_left(self.by_size, (end - start, start))]
+        return end
+
+    def find(self, address):
+        """Return (start, end) of the free block holding address, or None"""
+        i = bisect.bisect_right(self.starts, address) - 1
+        if (i >= 0):
+            start = self.starts[i]
+            if (address < self.ends[start]):
+                return (start, self.ends[start])
+        return None
+
+    def best_fit(self, length):
+        """Return (start, end) of the smallest free block that has room for length
+           (the lowest address one if there are several), or None"""
+        i = bisect.bisect_left(self.by_size, (length, -1))
+        if (i >= len(self.by_size)):
+            return None
+        f_length, start = self.by_size[i]
+        return (start, start + f_length)
+
+    def blocks(self):
+        """All of the free blocks as (start, end) in address order"""
+        return [(start, self.ends[start]) for start in self.starts if self.ends[start] > start]
+
+
+class Fragment(object):
+    """A relocatable object: the tokens assembled from one function and the
+       labels it defines. The jumps and variables in the tokens are still
+       by name (the relocation records) and are resolved with the rest of
+       the stream. Labels local to the section are kept without the
+       section suffix and renamed when linked, so they can't clash."""
+
+    def __init__(self, name, key, tokens, labels):
+        self.name = name
+        self.key = key
+        self.tokens = tokens            # (type, bytes, var_info, jump_label) for each token
+        self.labels = labels            # (index in tokens, label name) in index order
+
+    def relocate_label(self, label):
+        if (label.startswith(':')):
+            return label
+        else:
+            return "%s@%s" % (label, self.name)
+
+    def link(self, token_stream):
+        """Add the tokens and labels to the end of token_stream"""
+        labels = list(self.labels)
+        for i, (type, bits, var_info, jump) in enumerate(self.tokens):
+            while (labels and labels[0][0] == i):
+                token_stream.add_label(self.relocate_label(labels.pop(0)[1]))
+
+            token = Token(type)
+            token.bits = bytearray(bits)
+            token.var_info = list(var_info)
+            if (jump):
+                token.set_jump_label(jump[0], self.relocate_label(jump[1]), jump[2])
+            token.finish(token_stream)
+
+        for index, label in labels:
+            token_stream.add_label(self.relocate_label(label))
+
+
 class TokenStream(object):
     def __init__(self):
         self.clear()
@@ -112,6 +307,8 @@ class TokenStream(object):
         self.section_count = 0          # The number of the current section
         self.version = None             # The version number as (major, minor)
         self.download_type = None       # Can only have one type per download
+        self.token_lengths = FenwickTree()  # Byte length of each token, for offsets
+        self.fragment = None            # (name, key, start, section, labels) of a fragment being made
 
     def add_token(self, token, explicit_placement=-1):
         spec_type = token.get_type()
@@ -141,17 +338,32 @@ class TokenStream(object):
 
         if (explicit_placement < 0):
             self.token_stream.append(token)
+            self.token_lengths.append(token.get_byte_len())
         else:
             if (explicit_placement >= len(self.token_stream)):
                 AsmError_NO_RET(104, "Explicitly placing a token after the end of the stream.")
             else:
                 self.token_stream.insert(explicit_placement, token)
+                self.token_lengths.insert(explicit_placement, token.get_byte_len())
 
     def add_token_in_fixups(self, token, explicit_placement):
         if (explicit_placement >= len(self.token_stream)):
             AsmError_NO_RET(105, "Explicitly placing a token after the end of the stream.")
         else:
             self.token_stream.insert(explicit_placement, token)
+            self.token_lengths.insert(explicit_placement, token.get_byte_len())
+
+    def token_resized(self, index):
+        """The token at index has changed size (a jump became big)"""
+        token = self.token_stream[index]
+        self.token_lengths.add(index, token.get_byte_len() - self.token_lengths.values[index])
+
+    def get_offset(self, marker):
+        """Byte offset of the token at marker (a stream_marker() value)"""
+        return self.token_lengths.prefix(marker)
+
+    def get_label_offset(self, name):
+        return self.get_offset(self.labels[name])
 
     def add_label(self, name):
         if ((len(self.current_sections) == 0) or
@@ -170,6 +382,72 @@ class TokenStream(object):
 
         self.labels[new_name] = self.stream_marker()
 
+    def get_byte_len(self):
+        return self.get_offset(len(self.token_stream))
+
+    def begin_fragment(self, name, key):
+        if (self.fragment is not None):
+            AsmError_NO_RET(138, "Fragment %s must end before another begins." % (self.fragment[0]))
+
+        self.fragment = (name, key, self.stream_marker(), self.section_count, set(self.labels))
+
+    def end_fragment(self):
+        """Return the Fragment of the tokens and labels added since begin_fragment(),
+           or None if they can't be relocated"""
+        if (self.fragment is None):
+            AsmError_NO_RET(139, "Not making a fragment, so can't end it.")
+
+        name, key, start, section, before = self.fragment
+        self.fragment = None
+
+        if (section != self.section_count):
+            return None
+
+        suffix = "_%d" % (section)
+        labels = []
+        for label, marker in self.labels.items():
+            if (label not in before):
+                if (not label.startswith(':')):
+                    label = label[:-len(suffix)]
+                labels.append((marker - start, label))
+        labels.sort()
+
+        local = set([l for (i, l) in labels])
+        fragment_tokens = []
+        for t in self.token_stream[start:]:
+            jump = t.jump_label
+            if (jump and not jump[1].startswith(':')):
+                label = jump[1][:-len(suffix)]
+                if (label not in local):
+                    # jumps to a label outside of the fragment
+                    return None
+                jump = (jump[0], label, jump[2])
+
+            if (t.bits is None):
+                return None
+
+            fragment_tokens.append((t.type, bytes(t.bits), list(t.var_info), jump))
+
+        return Fragment(name, key, fragment_tokens, labels)
+
+    def serialize(self, preamble, header, added_bytes):
+        """Return one bytearray with the preamble, header, every token and then
+           added_bytes of padding. Everything else works on this buffer."""
+        download = bytearray(len(preamble) + len(header) + self.get_byte_len() + added_bytes)
+
+        download[0:len(preamble)] = bytearray(preamble)
+        index = len(preamble)
+        download[index:index + len(header)] = bytearray(header)
+        index += len(header)
+
+        for t in self.token_stream:
+            bits = t.get_token_bits()
+            download[index:index + len(bits)] = bits
+            index += len(bits)
+
+        download[index:] = bytearray([0xff] * added_bytes)
+        return download
+
     def stream_marker(self):
         return len(self.token_stream)
 
@@ -324,6 +602,7 @@ class TokenAnalyser(object):
         self.token_stream = token_stream
         self.name_space_map = [{}, {}, {}]
         self.name_space_max = [0, 0, 0]
+        self.name_space_free = [None, None, None]
 
     def verify(self):
         return True
@@ -357,13 +636,35 @@ class TokenAnalyser(object):
 
             print
 
+    def dump_allocation_report(self):
+        print("\nAllocation report:\n")
+        for i in range(2):                    # skip LCD
+            limit = self.token_stream.limits[i]
+            blocks = self.name_space_free[i].blocks()
+            free = sum([end - start for start, end in blocks])
+            largest = max([end - start for start, end in blocks] + [0])
+
+            # fragmentation is how much of the free space is NOT in the largest block
+            if (free > 0):
+                fragmentation = 100 * (free - largest) // free
+            else:
+                fragmentation = 0
+
+            print("Space:", space_names[i])
+            print("  limit:%d, used:%d, name_space_max:%d" % (limit, limit - free, self.name_space_max[i]))
+            print("  free:%d in %d blocks, largest:%d, fragmentation:%d%%" %
+                  (free, len(blocks), largest, fragmentation))
+            for start, end in blocks:
+                print("  free at %d-%d" % (start, end - 1))
+
     def map_variables_in_space(self, space, v_map):
         # create a map for the variables and fit them in
         io.Out.SetErrorRawContext(2, "Mapping variables in %s space" % (space_names[space]))
         limit = self.token_stream.limits[space]
         variables = self.token_stream.name_space[space]
 
-        fixed_v_free = [(0, limit, limit)]
+        v_free = FreeBlocks(limit)
+        self.name_space_free[space] = v_free
 
         # fit in the reserved and fixed variables
         for type, name, start, length in variables:
@@ -372,108 +673,64 @@ class TokenAnalyser(object):
                 continue
 
             end = start + length
-            copy_to_end = False
-            v_free = fixed_v_free
-            fixed_v_free = []
-
-            # print("v_free", v_free)
-            # print("v_map", v_map)
-
-            for f_start, f_length, f_end in v_free:
-                if (copy_to_end):
-                    fixed_v_free.append((f_start, f_length, f_end))
-                    continue
-
-                if (start >= f_start and start < f_end):
-                    # this is the block
-                    if (end <= f_end):
-                        # and it fits!
-                        if (type == "data"):
-                            if (name in v_map):
-                                if (v_map[name][0] != start or v_map[name][1] != length):
-                                    # the name is already used and the declarations are different!
-                                    AsmError_NO_RET(123, "Data variable %s declared twice and differently!" % (name))
-                            else:
-                                v_map[name] = (start, length)
-
-                        if (start == f_start):
-                            if (end == f_end):
-                                # just remove this entry from the free list
-                                pass
-                            else:
-                                # remove the front end of the free block
-                                fixed_v_free.append((end, f_length - length, f_end))
-
-                        elif (end == f_end):
-                            # remove the back end of the free block
-                            fixed_v_free.append((f_start, f_length - length, start))
-                        else:
-                            # in the middle, create two smaller free blocks
-                            fixed_v_free.append((f_start, start - f_start, start))
-                            fixed_v_free.append((end, f_end - end, f_end))
-
-                        # found the data, copy the rest to the end
-                        copy_to_end = True
+            block = v_free.find(start)
+            if (block is None):
+                continue
 
+            f_start, f_end = block
+            if (end <= f_end):
+                # and it fits!
+                if (type == "data"):
+                    if (name in v_map):
+                        if (v_map[name][0] != start or v_map[name][1] != length):
+                            # the name is already used and the declarations are different!
+                            AsmError_NO_RET(123, "Data variable %s declared twice and differently!" % (name))
                     else:
-                        if (type == "data"):
-                            io.Out.ErrorRaw("Fixed data variable %s at %d didn't fit!" % (name, start))
-                            io.Out.Error(io.TS.ASM_MEM_OVERFLOW,
-                                         "file::: Overflowed {0} memory", "fixed")
-                            raise program.AssemblerError
-                        else:
-                            io.Out.ErrorRaw("No room for Reserved data space at %d" % (start))
-                            io.Out.Error(io.TS.ASM_MEM_OVERFLOW,
-                                         "file::: Overflowed {0} memory", "rsvd")
-                            raise program.AssemblerError
+                        v_map[name] = (start, length)
+
+                # remove the block, and put back what is left on either side
+                v_free.remove(f_start)
+                if (start > f_start):
+                    v_free.add(f_start, start)
+                if (end < f_end):
+                    v_free.add(end, f_end)
+
+            else:
+                if (type == "data"):
+                    io.Out.ErrorRaw("Fixed data variable %s at %d didn't fit!" % (name, start))
+                    io.Out.Error(io.TS.ASM_MEM_OVERFLOW,
+                                 "file::: Overflowed {0} memory", "fixed")
+                    raise program.AssemblerError
+                else:
+                    io.Out.ErrorRaw("No room for Reserved data space at %d" % (start))
+                    io.Out.Error(io.TS.ASM_MEM_OVERFLOW,
+                                 "file::: Overflowed {0} memory", "rsvd")
+                    raise program.AssemblerError
 
         # Now try to fit in the floating variables. Use a best-fit strategy where the smallest
         # hole is used for each request. Also the block sizes are tried largest to smallest
         floats = [(x[1], x[3]) for x in variables if x[0] == "data" if x[2] < 0]
         floats.sort(key=lambda x: x[1], reverse=True)
-        v_free = fixed_v_free
 
         for name, length in floats:
 
             # find the best fit!
-            i = 0
-            best_index = -1
-            for i in range(len(v_free)):
-                f_length = v_free[i][1]
-                if (f_length >= length):
-                    if (f_length == length):
-                        # perfect fit!
-                        best_index = i
-                        break
-
-                    elif (best_index == -1):
-                        best_index = i
-                    else:
-                        if (f_length < v_free[best_index][1]):
-                            best_index = i
-
-            # best_index == -1 if nothing fit
-            if (best_index == -1):
+            best = v_free.best_fit(length)
+            if (best is None):
                 AsmError_NO_RET(124, "Float data variable %s (len:%d) didn't fit!" % (name, length))
 
             # Add to the map and adjust free spaces
-            f_start, f_length, f_end = v_free[best_index]
+            f_start, f_end = best
             if (name in v_map):
                 # the name is already used!
                 AsmError_NO_RET(125, "Data variable %s declared twice!" % (name))
             else:
                 v_map[name] = (f_start, length)
 
-            if (length == f_length):
-                # just remove this entry from the free list
-                del v_free[best_index]
-
-            else:
-                # put it at the start
-                v_free[best_index] = (f_start + length, f_length - length, f_end)
-
-            # print("v_free", v_free)
-            # print("v_map", v_map)
+            # put it at the start
+            v_free.remove(f_start)
+            if (f_start + length < f_end):
+                v_free.add(f_start + length, f_end)
 
         # Write the max index for this space
         max = 0
@@ -486,64 +743,58 @@ class TokenAnalyser(object):
 
         return True
 
-    def calc_cumulative_lengths(self, c_lengths):
-        # i = 0
-        # calculate cumulative lengths
-        cumulative_length = 0
-        for t in self.token_stream.token_stream:
-            c_lengths.append(cumulative_length)
-            cumulative_length += t.get_byte_len()
-        c_lengths.append(cumulative_length)
-        # print(c_lengths)
-
     def fixup_jumps(self):
         # fixup the jumps
         io.Out.SetErrorRawContext(2, "Fixing up jumps")
         # print(self.token_stream.labels)
 
-        # First get a cumulative byte length for each index
-        c_lengths = []
-        self.calc_cumulative_lengths(c_lengths)
+        stream = self.token_stream.token_stream
+        labels = self.token_stream.labels
 
         # Verify that the labels exist
-        for t in self.token_stream.token_stream:
+        jumps = []
+        for i in range(len(stream)):
+            t = stream[i]
             if (t.has_jump_label()):
                 index, name, big = t.get_jump_label()
-                if (name not in self.token_stream.labels):
+                if (name not in labels):
                     AsmError_NO_RET(126, "Reference to an unknown label:%s" % (name))
+                jumps.append(i)
+
+        # Branch relaxation. All jumps start small (unless they were made big)
+        # and a small jump that doesn't fit becomes big. A token never gets
+        # smaller, so a jump that became big stays big, and only the small
+        # jumps that span the token that grew have to be checked again.
+        small_jumps = [i for i in jumps if not stream[i].get_jump_label()[2]]
+        to_check = list(small_jumps)
+        while (to_check):
+            i = to_check.pop()
+            t = stream[i]
+            index, name, big = t.get_jump_label()
+            if (big):
+                continue
 
-        # do multiple passes until all jumps can be satisfied (start with byte)
-        while (1):
-            c_lengths = []
-            self.calc_cumulative_lengths(c_lengths)
-
-            #
-            i = 0
-            while (i < len(self.token_stream.token_stream)):
-                t = self.token_stream.token_stream[i]
-                if (t.has_jump_label()):
-                    index, name, big = t.get_jump_label()
-                    my_address = c_lengths[i + 1]  # The PC is pointing to start of next token
-                    target_address = c_lengths[self.token_stream.labels[name]]
-                    offset = target_address - my_address
-
-                    # does it fit?
-                    if (not big):
-                        if ((offset > MAX_SBYTE) or (offset < MIN_SBYTE)):
-                            # must become big now - will have to re-compute everyone
-                            t.fixup_jump(True, offset)
-                            break
-                        else:
-                            # small is OK
-                            t.fixup_jump(False, offset)
-                    else:
-                        # keep it big as the size never gets smaller
-                        t.fixup_jump(True, offset)
-                i += 1
+            my_address = self.token_stream.get_offset(i + 1)  # The PC is pointing to start of next token
+            target_address = self.token_stream.get_label_offset(name)
+            offset = target_address - my_address
 
-            if (i >= len(self.token_stream.token_stream)):
-                # no more fixups needed
-                break
+            if ((offset > MAX_SBYTE) or (offset < MIN_SBYTE)):
+                # must become big now
+                t.fixup_jump(True, offset)
+                self.token_stream.token_resized(i)
+
+                # A small jump spans at most MAX_SBYTE + 1 bytes, and every token is at
+                # least a byte, so only the small jumps close to this token can be affected
+                first = bisect.bisect_left(small_jumps, i - MAX_SBYTE - 2)
+                last = bisect.bisect_right(small_jumps, i + MAX_SBYTE + 2)
+                to_check.extend(small_jumps[first:last])
+
+        # Now every jump fits, so put in the final offsets
+        for i in jumps:
+            t = stream[i]
+            index, name, big = t.get_jump_label()
+            offset = self.token_stream.get_label_offset(name) - self.token_stream.get_offset(i + 1)
+            t.fixup_jump(big, offset)
 
         return True
 
@@ -580,38 +831,13 @@ class TokenAnalyser(object):
                                     "major versions 0x6 (not 0x%x)" % (self.token_stream.version[0]))
 
         header_list = []
-        added_bytes = 0
         if (self.token_stream.download_type[0] == "firmware"):
             # header is just size and crc
-            bytes = []
-            for t in self.token_stream.token_stream:
-                bytes.extend(t.get_token_bits())
-
-            # skip bad crc lengths
-            if (is_bad_length_for_crc(len(bytes))):
-                print("Warning - skipping bad CRC length at {} bytes.".format(len(bytes)))
-                added_bytes = 1
-                bytes.extend([0xff])
-
+            download_type = "firmware"
             header_list.extend([0, 0, 0, 0])
-            header_list[0], header_list[1] = word_to_bytes(len(bytes))
-            crc = calculate_crc(bytes)
-            header_list[2], header_list[3] = word_to_bytes(crc)
-            return ("firmware", self.token_stream.version, header_list, added_bytes)
 
         else:
-            bytes = []
-            for t in self.token_stream.token_stream:
-                bytes.extend(t.get_token_bits())
-
-
-            # # TEST CODE - get to a bad crc length
-            # print("Token bytes:", len(bytes))
-            # if (len(bytes) < 760):
-            #     added_bytes = 760-len(bytes)
-            #     print("Added", added_bytes, "bytes")
-            #     bytes.extend([0xff] * added_bytes)
-            #     print("Bytes now:", len(bytes))
+            download_type = "program"
 
             # data_bytes(2), data_crc(2), 8-bit vars, 16-bit vars, program_offset(2)
             header_list.extend([0, 0, 0, 0, 0, 0, 0, 0])
@@ -622,18 +848,14 @@ class TokenAnalyser(object):
             header_list[4] = self.name_space_max[0]
             header_list[5] = self.name_space_max[1]
 
-            # need locations for event and program offsets
-            c_lengths = []
-            self.calc_cumulative_lengths(c_lengths)
-
             # build the event list but first with offsets from start of code tokens
             for i in range(len(self.token_stream.section_breaks)):
                 stype, start_token, stop_token = self.token_stream.section_breaks[i]
                 if (stype == "main"):
-                    main_offset = c_lengths[start_token]
+                    main_offset = self.token_stream.get_offset(start_token)
                 else:
                     modreg, mask, value = self.token_stream.section_args[i]
-                    event_list.append((c_lengths[start_token], modreg, mask, value))
+                    event_list.append((self.token_stream.get_offset(start_token), modreg, mask, value))
 
             final_header_bytes = len(header_list) + len(event_list) * 5 + 2
 
@@ -649,20 +871,33 @@ class TokenAnalyser(object):
             # mark end of events
             header_list.extend([0, 0])
 
-            # finally update the length and crc
-            new_bytes = header_list[4:] + bytes
+        # The length and crc cover the header after the crc, the tokens and any padding
+        added_bytes = 0
+        data_len = len(header_list) - 4 + self.token_stream.get_byte_len()
+
+        # # TEST CODE - get to a bad crc length
+        # print("Token bytes:", data_len)
+        # if (data_len < 760):
+        #     added_bytes = 760 - data_len
+        #     print("Added", added_bytes, "bytes")
+        #     data_len += added_bytes
+        #     print("Bytes now:", data_len)
+
+        # skip bad crc lengths
+        if (is_bad_length_for_crc(data_len)):
+            print("Warning - skipping bad CRC length at {} bytes.".format(data_len))
+            added_bytes += 1
 
-            # skip bad crc lengths
-            if (is_bad_length_for_crc(len(new_bytes))):
-                print("Warning - skipping bad CRC length at {} bytes.".format(len(new_bytes)))
-                added_bytes += 1
-                new_bytes.extend([0xff])
+        # write everything once, then fill in the length and crc
+        preamble = version_bytes(self.token_stream.version)
+        download = self.token_stream.serialize(preamble, header_list, added_bytes)
 
-            header_list[0], header_list[1] = word_to_bytes(len(new_bytes))
-            crc = calculate_crc(new_bytes)
-            header_list[2], header_list[3] = word_to_bytes(crc)
+        crc = Crc16()
+        crc.update(download, len(preamble) + 4)
+        download[len(preamble):len(preamble) + 2] = bytearray(word_to_bytes(crc.length))
+        download[len(preamble) + 2:len(preamble) + 4] = bytearray(word_to_bytes(crc.value()))
 
-            return ("program", self.token_stream.version, header_list, added_bytes)
+        return (download_type, self.token_stream.version, download)
 
     def dump_extras(self):
         print("Section breaks:", self.token_stream.section_breaks)
@@ -670,16 +905,21 @@ class TokenAnalyser(object):
 
 
 class Token(object):
+    """One token. The bytes are kept in a bytearray and every add_*() and
+       fixup_*() writes straight into it."""
+
+    __slots__ = ("valid", "bits", "var_info", "jump_label", "type", "binary_file", "source_line")
+
     def __init__(self, type, err_reporter=None, src=None):
         self.valid = True
-        self.token_info = []
+        self.bits = bytearray(1)
         self.var_info = []
         self.jump_label = None
         self.type = type
-        self.cached_bits = []
         self.binary_file = None
 
-        if (src and src.endswith('\n')):
+        # a compiler Instruction is kept as it is, its text is only made if dumped
+        if (isinstance(src, basestring) and src.endswith('\n')):
             self.source_line = src[:-1]
         else:
             self.source_line = src
@@ -687,32 +927,27 @@ class Token(object):
     def mark_invalid(self):
         self.valid = False
 
-    def invalidate_cache(self):
-        self.cached_bits = []
-
     def get_type(self):
         return self.type
 
+    def set_field(self, index, shift, mask, value):
+        if (index >= len(self.bits)):
+            self.bits.extend(bytearray(index + 1 - len(self.bits)))
+
+        self.bits[index] = (self.bits[index] & ~(mask << shift)) | ((value & mask) << shift)
+
     def add_byte(self, index, value):
         # print("DEBUG - add_byte() - index:%s, value:%s" % (index, value))
         if (value < MIN_BYTE or value > MAX_BYTE):
             self.mark_invalid()
             AsmError_NO_RET(130, "Out of range for a byte: %d" % (value))
         else:
-            self.token_info.append((index, 0, 0xff, value))
+            self.set_field(index, 0, 0xff, value)
 
-        self.invalidate_cache()
-
-    def find_index(self, index):
-        found = -1
-        for i in range(len(self.token_info)):
-            if (self.token_info[i][0] == index):
-                found = i
-                break
-        if (found == -1):
+    def check_index(self, index):
+        if (index >= len(self.bits)):
             self.mark_invalid()
             AsmError_NO_RET(131, "Variable index: %d invalid" % (index))
-        return found
 
     def fixup_crc(self, size, index, value):
         if (size == 8):
@@ -720,30 +955,26 @@ class Token(object):
                 self.mark_invalid()
                 AsmError_NO_RET(132, "Out of range for byte: %d" % (value))
             else:
-                del self.token_info[self.find_index(index)]
-                self.token_info.append((index, 0, 0xff, value))
+                self.check_index(index)
+                self.bits[index] = value
 
         else:
             if (value < 0 or value > MAX_UWORD):
                 self.mark_invalid()
                 AsmError_NO_RET(133, "Out of range for an unsigned word: %d" % (value))
             else:
-                del self.token_info[self.find_index(index)]
-                del self.token_info[self.find_index(index + 1)]
-                self.token_info.append((index, 0, 0xff, (value >> 8) & 255))
-                self.token_info.append((index + 1, 0, 0xff, value & 255))
-
-        self.invalidate_cache()
+                self.check_index(index + 1)
+                self.bits[index] = (value >> 8) & 255
+                self.bits[index + 1] = value & 255
 
     def fixup_var_byte(self, index, value):
-        i = self.find_index(index)
-        new_number = self.token_info[i][3] + value
+        self.check_index(index)
+        new_number = self.bits[index] + value
         if (new_number < MIN_BYTE or new_number > MAX_BYTE):
             self.mark_invalid()
             AsmError_NO_RET(134, "Out of range for a byte: %d" % (new_number))
 
-        self.token_info[i] = (index, 0, 0xff, new_number)
-        self.invalidate_cache()
+        self.bits[index] = new_number
 
     def fixup_jump(self, big, offset):
         j_index, j_name, j_big = self.jump_label
@@ -753,56 +984,44 @@ class Token(object):
                 AsmError_NO_RET(135, "Impossible - the jump size got SMALLER")
 
             # make the small into big
-            del self.token_info[self.find_index(j_index)]
+            self.check_index(j_index)
             self.add_bits(0, 4, 1, 1)
             self.add_word(j_index, offset)
             self.jump_label = (j_index, j_name, big)
 
         elif (big):
             # update the big one
-            del self.token_info[self.find_index(j_index)]
-            del self.token_info[self.find_index(j_index + 1)]
+            self.check_index(j_index + 1)
             self.add_word(j_index, offset)
         else:
             # update the small one
-            del self.token_info[self.find_index(j_index)]
+            self.check_index(j_index)
             if (offset < 0):
                 # convert to a signed offset
                 offset += 256
             self.add_byte(j_index, offset)
-            self.token_info.append((j_index, 0, 0xff, offset))
-
-        self.invalidate_cache()
 
     def add_word(self, index, value):
         if (value < MIN_WORD or value > MAX_WORD):
             self.mark_invalid()
             AsmError_NO_RET(136, "Out of range for a word: %d" % (value))
         else:
-            self.token_info.append((index, 0, 0xff, (value >> 8) & 255))
-            self.token_info.append((index + 1, 0, 0xff, value & 255))
-
-        self.invalidate_cache()
+            self.set_field(index, 0, 0xff, (value >> 8) & 255)
+            self.set_field(index + 1, 0, 0xff, value & 255)
 
     def add_uword(self, index, value):
         if (value < 0 or value > MAX_UWORD):
             self.mark_invalid()
             AsmError_NO_RET(137, "Out of range for an unsigned word: %d" % (value))
         else:
-            self.token_info.append((index, 0, 0xff, (value >> 8) & 255))
-            self.token_info.append((index + 1, 0, 0xff, value & 255))
-
-        self.invalidate_cache()
+            self.set_field(index, 0, 0xff, (value >> 8) & 255)
+            self.set_field(index + 1, 0, 0xff, value & 255)
 
     def add_bits(self, index, shift, mask, value):
-        self.token_info.append((index, shift, mask, value))
-        self.invalidate_cache()
+        self.set_field(index, shift, mask, value)
 
-    # Adds a name reference to the token[index]. The address of the name is added to the
-    # value of the byte at that index.
     def add_vname(self, index, space, name):
         self.var_info.append((index, space, name))
-        self.invalidate_cache()
 
     def clear_vnames(self):
         self.var_info = []
@@ -810,7 +1029,6 @@ class Token(object):
     def set_jump_label(self, index, name, big=False):
         # start off with a small jump
         self.jump_label = (index, name, big)
-        self.invalidate_cache()
 
     def get_jump_label(self):
         return self.jump_label
@@ -829,38 +1047,18 @@ class Token(object):
             io.Out.DebugRaw("Dropping invalid token")
 
     def get_byte_len(self):
-        if (len(self.cached_bits) == 0):
-            self.get_token_bits()
-
-        return len(self.cached_bits)
+        return len(self.get_token_bits())
 
     def get_token_bits(self):
-        if (len(self.cached_bits) == 0):
-            if (self.binary_file):
-                fh = file(self.binary_file, 'rb')
-                tmp_ascii = fh.read()
-                for t in tmp_ascii:
-                    self.cached_bits.append(ord(t))
-
-                fh.close()
-            else:
-                length = 1
-                self.cached_bits = [0]
-                for index, shift, mask, value in self.token_info:
-                    while (index + 1 > length):
-                        self.cached_bits.append(0)
-                        length += 1
-
-                    work = self.cached_bits[index]
-                    work = work & ~(mask << shift)
-                    work = work | ((value & mask) << shift)
-                    self.cached_bits[index] = work
+        if (self.bits is None):
+            self.bits = load_binary_file(self.binary_file)
 
-        return self.cached_bits
+        return self.bits
 
     def add_binary_file(self, f_name):
         # save the file_name and bring it out when we get length or bits
         self.binary_file = f_name
+        self.bits = None
 
     def print_token(self):
         length = self.get_byte_len()
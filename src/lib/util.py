@@ -28,6 +28,7 @@ import sys
 import datetime
 import os
 import os.path
+import threading
 
 
 class Enum(object):
@@ -73,6 +74,8 @@ class SimpleLog(object):
         self.start = datetime.datetime.now()
         self.fileName = fileName
         self.maxBytes = maxBytes
+        # shared by the compiles running in a server
+        self.lock = threading.Lock()
 
     def formatTimestamp(self, ts=None):
         if (ts is None):
@@ -108,24 +111,38 @@ class SimpleLog(object):
         if (not self.use):
             return
 
-        if (self.fh is None):
-            self.open()
+        with self.lock:
+            if (self.fh is None):
+                self.open()
 
-        if (self.fh is not None):
-            now = datetime.datetime.now()
-            delta = now - self.start
-            print("{:s} dur:{:s} pid:{} msg:{:s}".format(self.formatTimestamp(now),
-                                                         self.formatDelta(delta),
-                                                         os.getpid(), line), file=self.fh)
-            self.fh.flush()
+            if (self.fh is not None):
+                now = datetime.datetime.now()
+                delta = now - self.start
+                print("{:s} dur:{:s} pid:{} msg:{:s}".format(self.formatTimestamp(now),
+                                                             self.formatDelta(delta),
+                                                             os.getpid(), line), file=self.fh)
+                self.fh.flush()
 
     def close(self):
         if (not self.use):
             return
 
-        if (self.fh is not None):
-            self.fh.close()
-            self.fh = None
+        with self.lock:
+            if (self.fh is not None):
+                self.fh.close()
+                self.fh = None
+
+
+# The process umask. Setting it is the only way to read it, so it's done
+# once on import
+FILE_UMASK = os.umask(0)
+os.umask(FILE_UMASK)
+
+
+def SetNewFileMode(path):
+    """Files made with tempfile.mkstemp are only readable by the owner. Give
+       one the mode that open() would have, so a shared install can use it."""
+    os.chmod(path, 0o666 & ~FILE_UMASK)
 
 
 def LowerStr(inString):
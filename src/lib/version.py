@@ -0,0 +1,61 @@
+#!/usr/bin/env python2
+# * **************************************************************** **
+# File: version.py
+# Requires: Python 2.7+ (but not Python 3.0+)
+# Note: For history, changes and dates for this file, consult git.
+# Author: Brian Danilko, Likeable Software (brian@likeablesoftware.com)
+# Copyright 2015-2017 Microbric Pty Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License (in the doc/licenses directory)
+# for more details.
+#
+# * **************************************************************** */
+
+
+""" Module with the compiler version and hashes of the compiler's own source. Imports nothing else from lib. """
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import os.path
+
+VERSION = "1.2.11"
+
+# (module names) -> hash
+sourceHashes = {}
+
+
+def SourceHash(*moduleNames):
+    """A hash of the source of the lib modules, so anything they made is out
+       of date when one of them changes. A module without its source (only
+       the compiled file was installed) is represented by VERSION."""
+    if (moduleNames not in sourceHashes):
+        h = hashlib.sha1()
+        h.update(VERSION.encode("utf-8"))
+        for name in moduleNames:
+            h.update(name.encode("utf-8"))
+            try:
+                fh = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name + ".py"), "rb")
+                try:
+                    h.update(fh.read())
+                finally:
+                    fh.close()
+            except (IOError, OSError):
+                pass
+        sourceHashes[moduleNames] = h.hexdigest()
+
+    return sourceHashes[moduleNames]
+
+
+# Only to be used as a module
+if __name__ == '__main__':
+    print("This file is a module and can not be run as a script!")